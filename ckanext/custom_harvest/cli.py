@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+import click
+
+from ckan import model
+from ckanext.harvest.model import HarvestJob, HarvestSource
+
+from ckanext.custom_harvest import parallel_import
+
+
+def get_commands():
+    return [custom_harvest]
+
+
+@click.group(name='custom-harvest')
+def custom_harvest():
+    '''Commands for the custom harvesters.
+    '''
+    pass
+
+
+@custom_harvest.command('import')
+@click.pass_context
+@click.option('-s', '--source', 'source_id', metavar='SOURCE_ID_OR_NAME',
+              help='Import again the current objects of a harvest source')
+@click.option('-j', '--job', 'job_id', metavar='JOB_ID',
+              help='Fetch and import the objects a finished harvest job did not import')
+@click.option('-w', '--workers', type=int, default=None,
+              help='Number of worker processes (default: number of CPUs)')
+def import_(ctx, source_id, job_id, workers):
+    '''Imports harvest objects with a pool of worker processes.
+
+    Objects are split between the workers by guid, so each dataset is
+    always handled by the same worker.
+    '''
+    if bool(source_id) == bool(job_id):
+        raise click.UsageError('Provide either --source or --job')
+    if workers is not None and workers < 1:
+        raise click.UsageError('--workers must be at least 1')
+
+    flask_app = ctx.meta['flask_app']
+    with flask_app.test_request_context():
+        if source_id:
+            source = _get_source(source_id)
+            objects = parallel_import.get_source_objects(source.id)
+        else:
+            job = HarvestJob.get(job_id)
+            if not job:
+                raise click.BadParameter('Harvest job not found: %s' % job_id)
+            if job.status != 'Finished':
+                # Its objects are still in the fetch queue
+                raise click.BadParameter(
+                    'Harvest job %s is not finished, stop it first with '
+                    '"ckan harvester job-abort"' % job_id)
+            objects = parallel_import.get_job_objects(job.id)
+
+        imported, errored = parallel_import.import_objects(
+            objects, workers=workers, reimport=bool(source_id))
+    click.secho('Imported {0} harvest objects, {1} errors'.format(
+        imported, errored), fg='red' if errored else 'green')
+
+
+@custom_harvest.command('reindex')
+@click.pass_context
+@click.option('-s', '--source', 'source_id', required=True,
+              metavar='SOURCE_ID_OR_NAME',
+              help='Harvest source whose datasets are reindexed')
+@click.option('-w', '--workers', type=int, default=None,
+              help='Number of worker processes (default: number of CPUs)')
+@click.option('-b', '--batch-size', type=int, default=None,
+              help='Number of datasets indexed at a time (default: '
+                   'ckanext.custom_harvest.index_batch_size)')
+def reindex(ctx, source_id, workers, batch_size):
+    '''Reindexes the datasets of a harvest source.
+
+    Only the datasets of the current objects of the source are sent to the
+    search index, in batches spread over a pool of worker processes, and
+    the index is committed once at the end.
+    '''
+    if workers is not None and workers < 1:
+        raise click.UsageError('--workers must be at least 1')
+    if batch_size is not None and batch_size < 1:
+        raise click.UsageError('--batch-size must be at least 1')
+
+    flask_app = ctx.meta['flask_app']
+    with flask_app.test_request_context():
+        source = _get_source(source_id)
+        indexed, errored = parallel_import.reindex_source(
+            source.id, workers=workers, batch_size=batch_size)
+    click.secho('Reindexed {0} datasets, {1} errors'.format(
+        indexed, errored), fg='red' if errored else 'green')
+
+
+def _get_source(source_id_or_name):
+    source = HarvestSource.get(source_id_or_name)
+    if not source:
+        # Harvest sources share the id of their dataset, which can be
+        # looked up by name
+        package = model.Package.get(source_id_or_name)
+        if package:
+            source = HarvestSource.get(package.id)
+    if not source:
+        raise click.BadParameter(
+            'Harvest source not found: %s' % source_id_or_name)
+    return source
@@ -1,15 +1,24 @@
 from builtins import str
 import re
 import json
+import logging
 
 from abc import ABCMeta, abstractmethod
-from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
 from datetime import datetime
+from functools import lru_cache
 
 from ckan import model
 from ckan import plugins as p
 from ckan.lib.munge import substitute_ascii_equivalents
-from ckan.logic import NotFound, get_action
+from ckan.logic import NotFound, ValidationError, get_action
+
+from ckanext.custom_harvest.harvest_config import as_harvest_config, tag_key
+from ckanext.custom_harvest.resource_formats import FormatClassifier
+
+
+log = logging.getLogger(__name__)
 
 
 def munge_to_length(string, min_length, max_length):
@@ -21,23 +30,232 @@ def munge_to_length(string, min_length, max_length):
     return string
 
 
+# Tags repeat a lot across the datasets of a source, so munged tags are
+# cached
+MUNGE_TAG_CACHE_SIZE = 4096
+
+INVALID_TAG_CHARACTERS = re.compile(r'[^a-zA-Z0-9\- ]')
+
+
+@lru_cache(maxsize=MUNGE_TAG_CACHE_SIZE)
 def munge_tag(tag):
     tag = substitute_ascii_equivalents(tag)
     tag = tag.lower().strip()
-    tag = re.sub(r'[^a-zA-Z0-9\- ]', '', tag)
+    tag = INVALID_TAG_CHARACTERS.sub('', tag)
     tag = munge_to_length(tag, model.MIN_TAG_LENGTH, model.MAX_TAG_LENGTH)
     return tag
 
 
+class ExtrasIndex(object):
+    '''
+    The extras of a dataset, in order and indexed by key, so that processors
+    can look up, replace and remove extras without scanning the list of
+    extras. Repeated keys are kept, and looking up or removing a key finds
+    its first extra, as on the list.
+    '''
+
+    def __init__(self):
+        # Extras by position, position of the first extra of each key and
+        # positions of the next ones for the keys that repeat
+        self._extras = {}
+        self._first_positions = {}
+        self._next_positions = {}
+        self._next_position = 0
+
+    @classmethod
+    def from_list(cls, extras):
+        extras = extras or []
+        extras_index = cls()
+        extras_index._extras = dict(enumerate(extras))
+        extras_index._next_position = len(extras)
+        # Going backwards, the first extra of each key is set last
+        extras_index._first_positions = dict(
+            (extras[position]['key'], position)
+            for position in range(len(extras) - 1, -1, -1))
+        if len(extras_index._first_positions) < len(extras):
+            for position, extra in enumerate(extras):
+                if extras_index._first_positions[extra['key']] != position:
+                    extras_index._next_positions.setdefault(
+                        extra['key'], []).append(position)
+        return extras_index
+
+    def __iter__(self):
+        return iter(self._extras.values())
+
+    def __len__(self):
+        return len(self._extras)
+
+    def get(self, key):
+        position = self._first_positions.get(key)
+        if position is not None:
+            return self._extras[position]
+
+    def append(self, extra):
+        position = self._next_position
+        self._next_position += 1
+        self._extras[position] = extra
+        key = extra['key']
+        if key in self._first_positions:
+            self._next_positions.setdefault(key, []).append(position)
+        else:
+            self._first_positions[key] = position
+
+    def pop(self, key):
+        position = self._first_positions.pop(key, None)
+        if position is None:
+            return None
+        next_positions = self._next_positions.get(key)
+        if next_positions:
+            self._first_positions[key] = next_positions.pop(0)
+            if not next_positions:
+                del self._next_positions[key]
+        return self._extras.pop(position)
+
+    def set(self, extra):
+        '''
+        Removes the first extra with the key of the given one and adds this
+        one at the end
+        '''
+        key = extra['key']
+        extras = self._extras
+        first_positions = self._first_positions
+        position = first_positions.get(key)
+        if position is not None:
+            del extras[position]
+            next_positions = self._next_positions.get(key)
+            if next_positions:
+                next_positions.append(self._next_position)
+                first_positions[key] = next_positions.pop(0)
+            else:
+                first_positions[key] = self._next_position
+        else:
+            first_positions[key] = self._next_position
+        extras[self._next_position] = extra
+        self._next_position += 1
+
+    def to_list(self):
+        return list(self._extras.values())
+
+
+def iter_extras(package_dict):
+    return iter(package_dict.get('extras', []))
+
+
 def get_extra(key, package_dict):
-    for extra in package_dict.get('extras', []):
+    extras = package_dict.get('extras', [])
+    if isinstance(extras, ExtrasIndex):
+        return extras.get(key)
+    for extra in extras:
         if extra['key'] == key:
             return extra
 
 
+def pop_extra(key, package_dict):
+    '''
+    Removes the first extra with the given key from a dataset, returning it
+    '''
+    extras = package_dict.get('extras', [])
+    if isinstance(extras, ExtrasIndex):
+        return extras.pop(key)
+    existing_extra = get_extra(key, package_dict)
+    if existing_extra:
+        extras.remove(existing_extra)
+    return existing_extra
+
+
+def set_extra(extra, package_dict):
+    '''
+    Adds an extra at the end of the extras of a dataset, replacing the first
+    extra with the same key
+    '''
+    extras = package_dict.setdefault('extras', [])
+    if isinstance(extras, ExtrasIndex):
+        extras.set(extra)
+        return
+    pop_extra(extra['key'], package_dict)
+    extras.append(extra)
+
+
+class ProcessorPipeline(object):
+    '''
+    The config processors that have something to do for a harvest config,
+    applied in order to each package dict
+    '''
+
+    def __init__(self, processors, config):
+        self.config = config
+        self.processors = [
+            processor for processor in processors if processor.is_active(config)]
+        self.steps = [processor.modify_package_dict for processor in self.processors]
+        self.uses_extras = any(processor.uses_extras for processor in self.processors)
+        self.uses_source_extras = any(
+            processor.uses_source_extras for processor in self.processors)
+
+    def __call__(self, package_dict, source_dict):
+        if not self.uses_extras:
+            if 'extras' not in package_dict:
+                package_dict['extras'] = []
+            config = self.config
+            for step in self.steps:
+                step(package_dict, config, source_dict)
+            return package_dict
+
+        # Extras are indexed by key while the processors run and written
+        # back as a list at the end. The source dict is shallow copied so
+        # that it is left as is.
+        package_dict['extras'] = ExtrasIndex.from_list(package_dict.get('extras'))
+        if self.uses_source_extras:
+            source_dict = dict(source_dict)
+            source_dict['extras'] = ExtrasIndex.from_list(source_dict.get('extras'))
+        config = self.config
+        try:
+            for step in self.steps:
+                step(package_dict, config, source_dict)
+        finally:
+            extras = package_dict.get('extras')
+            if isinstance(extras, ExtrasIndex):
+                package_dict['extras'] = extras.to_list()
+        return package_dict
+
+
+def build_pipeline(processors, config):
+    '''
+    Returns the pipeline of the given processors for a config, built once
+    and kept on the compiled config
+    '''
+    config = as_harvest_config(config)
+    key = tuple(processors)
+    pipeline = config.pipelines.get(key)
+    if pipeline is None:
+        pipeline = config.pipelines[key] = ProcessorPipeline(processors, config)
+    return pipeline
+
+
 class BaseConfigProcessor:
     __metaclass__ = ABCMeta
 
+    # Config keys the processor acts upon. Processors with config keys are
+    # only run for a harvest source if at least one of them has a value in
+    # its config, the others are always run.
+    config_keys = ()
+
+    # Whether the processor only checks the config, for settings applied
+    # elsewhere, and is never run
+    check_only = False
+
+    # Whether the processor looks up the extras of the package dict or of the
+    # source dict, which are then indexed by key while the pipeline runs
+    uses_extras = False
+    uses_source_extras = False
+
+    @classmethod
+    def is_active(cls, config):
+        if cls.check_only:
+            return False
+        if not cls.config_keys:
+            return True
+        return any(config.get(key) for key in cls.config_keys)
+
     @staticmethod
     @abstractmethod
     def check_config(config_obj):
@@ -51,6 +269,8 @@ class BaseConfigProcessor:
 
 class DefaultTags(BaseConfigProcessor):
 
+    config_keys = ('default_tags',)
+
     @staticmethod
     def check_config(config_obj):
         if 'default_tags' in config_obj:
@@ -63,16 +283,21 @@ class DefaultTags(BaseConfigProcessor):
     @staticmethod
     def modify_package_dict(package_dict, config, source_dict):
         # Set default tags if needed
-        default_tags = config.get('default_tags', [])
+        default_tags = as_harvest_config(config).default_tags_by_key
         if default_tags:
             if 'tags' not in package_dict:
                 package_dict['tags'] = []
+            tag_keys = set(tag_key(t) for t in package_dict['tags'])
+            # copies, as the default tags are shared by all the datasets of
+            # the job and the next processors may change them
             package_dict['tags'].extend(
-                [t for t in default_tags if t not in package_dict['tags']])
+                [dict(t) for key, t in default_tags.items() if key not in tag_keys])
 
 
 class CleanTags(BaseConfigProcessor):
 
+    config_keys = ('clean_tags',)
+
     @staticmethod
     def check_config(config_obj):
         if 'clean_tags' in config_obj:
@@ -82,28 +307,94 @@ class CleanTags(BaseConfigProcessor):
     @staticmethod
     def modify_package_dict(package_dict, config, source_dict):
         if config.get('clean_tags', False):
-            # clean tags of invalid characters
-            tags = package_dict.get('tags', [])
-
-            try:
-                def _update_tag(tag_dict, key, newvalue):
-                    # update the dict and return it
-                    tag_dict[key] = newvalue
-                    return tag_dict
+            # clean tags of invalid characters, dropping the tags that end
+            # up the same as a previous one
+            tags = []
+            seen = set()
+            for tag in package_dict.get('tags', []):
+                if isinstance(tag, dict):
+                    # package_show form
+                    name = munge_tag(tag['name'])
+                else:
+                    # REST format: 'tags' is a list of strings
+                    name = tag = munge_tag(tag)
+                if name == '' or name in seen:
+                    continue
+                seen.add(name)
+                if isinstance(tag, dict):
+                    tag['name'] = name
+                tags.append(tag)
 
-                # assume it's in the package_show form
-                tags = [_update_tag(t, 'name', munge_tag(t['name'])) for t in tags if munge_tag(t['name']) != '']
+            package_dict['tags'] = tags
 
-            except TypeError:  # a TypeError is raised if `t` above is a string
-                # REST format: 'tags' is a list of strings
-                tags = [munge_tag(t) for t in tags if munge_tag(t) != '']
-                tags = list(set(tags))
 
-            package_dict['tags'] = tags
+# Largest number of groups group_list returns with all their fields, unless
+# the site allows more
+GROUP_BATCH_SIZE = 25
+
+
+def resolve_groups(group_names_or_ids):
+    '''
+    Returns the dicts of the given groups, in the same order. Groups are
+    looked up by name in batches with group_list, and the ones not found
+    that way, like the ones given by id, with group_show.
+
+    Raises ValueError if a group doesn't exist.
+    '''
+    context = {'model': model, 'user': p.toolkit.c.user}
+    groups_by_ref = {}
+    names = list(dict.fromkeys(group_names_or_ids))
+    for start in range(0, len(names), GROUP_BATCH_SIZE):
+        batch = names[start:start + GROUP_BATCH_SIZE]
+        for group in get_action('group_list')(
+                dict(context), {'groups': batch, 'all_fields': True, 'limit': len(batch)}):
+            groups_by_ref[group['name']] = group
+
+    group_dicts = []
+    for group_name_or_id in group_names_or_ids:
+        group = groups_by_ref.get(group_name_or_id)
+        if group is None:
+            try:
+                group = get_action('group_show')(dict(context), {'id': group_name_or_id})
+            except NotFound:
+                raise ValueError('Default group not found')
+            groups_by_ref[group_name_or_id] = group
+        group = dict(group)
+        group.pop('users', None)
+        group_dicts.append(group)
+    return group_dicts
+
+
+# Fields of the scheming dataset schemas, by dataset type and field name
+_schema_fields = {}
+
+
+def get_schema_fields(dataset_type):
+    '''
+    Returns the fields of the scheming schema of a dataset type by field
+    name, loaded once until the plugins are configured again
+    '''
+    schema_fields = _schema_fields.get(dataset_type)
+    if schema_fields is None:
+        try:
+            schema_result = get_action('scheming_dataset_schema_show')(
+                {}, {'type': dataset_type})
+        except Exception:
+            raise ValueError('The {} dataset schema is not available'.format(dataset_type))
+        schema_fields = _schema_fields[dataset_type] = dict(
+            (dataset_field['field_name'], dataset_field)
+            for dataset_field in schema_result.get('dataset_fields') or [])
+    return schema_fields
+
+
+def clear_schema_fields():
+    _schema_fields.clear()
 
 
 class DefaultGroups(BaseConfigProcessor):
 
+    config_keys = ('default_groups',)
+
     @staticmethod
     def check_config(config_obj):
         if 'default_groups' in config_obj:
@@ -112,34 +403,29 @@ class DefaultGroups(BaseConfigProcessor):
             if config_obj['default_groups'] and not isinstance(config_obj['default_groups'][0], str):
                 raise ValueError('default_groups must be a list of group names/ids (i.e. strings)')
 
-            # Check if default groups exist
-            context = {'model': model, 'user': p.toolkit.c.user}
-            config_obj['default_group_dicts'] = []
-            for group_name_or_id in config_obj['default_groups']:
-                try:
-                    group = get_action('group_show')(context, {'id': group_name_or_id})
-                    if 'users' in group:
-                        del group['users']
-                    # save the dict to the config object, as we'll need it
-                    # in the import_stage of every dataset
-                    config_obj['default_group_dicts'].append(group)
-                except NotFound:
-                    raise ValueError('Default group not found')
+            # Check if default groups exist, saving their dicts to the config
+            # object, as we'll need them in the import_stage of every dataset
+            config_obj['default_group_dicts'] = resolve_groups(config_obj['default_groups'])
 
     @staticmethod
     def modify_package_dict(package_dict, config, source_dict):
         default_groups = config.get('default_groups', [])
         if default_groups:
+            config = as_harvest_config(config)
             if 'groups' not in package_dict:
                 package_dict['groups'] = []
-            existing_group_ids = [g['id'] for g in package_dict['groups']]
+            existing_group_ids = set(g['id'] for g in package_dict['groups'])
             package_dict['groups'].extend(
-                [{'name': g['name']} for g in config['default_group_dicts']
-                 if g['id'] not in existing_group_ids])
+                [group_ref for group_id, group_ref
+                 in zip(config.default_group_ids, config.default_group_refs)
+                 if group_id not in existing_group_ids])
 
 
 class DefaultExtras(BaseConfigProcessor):
 
+    config_keys = ('default_extras',)
+    uses_extras = True
+
     @staticmethod
     def check_config(config_obj):
         if 'default_extras' in config_obj:
@@ -156,19 +442,21 @@ class DefaultExtras(BaseConfigProcessor):
             package_dict['extras'] = []
 
         if default_extras:
-            override_extras = config.get('override_extras', False)
+            override_extras = as_harvest_config(config).override_extras
             for key, value in default_extras.items():
                 existing_extra = get_extra(key, package_dict)
                 if existing_extra and not override_extras:
                     continue  # no need for the default
-                if existing_extra:
-                    package_dict['extras'].remove(existing_extra)
 
-                package_dict['extras'].append({'key': key, 'value': value})
+                set_extra({'key': key, 'value': value}, package_dict)
 
 
 class CopyExtras(BaseConfigProcessor):
 
+    config_keys = ('copy_extras',)
+    uses_extras = True
+    uses_source_extras = True
+
     @staticmethod
     def check_config(config_obj):
         if 'copy_extras' in config_obj:
@@ -187,20 +475,21 @@ class CopyExtras(BaseConfigProcessor):
             package_dict['extras'] = []
 
         copy_extras = config.get('copy_extras', False)
-        override_extras = config.get('override_extras', False)
         if copy_extras:
-            for extra in source_dict.get('extras', []):
+            override_extras = as_harvest_config(config).override_extras
+            for extra in iter_extras(source_dict):
                 if extra.get('key') not in exclude_keys:
                     existing_extra = get_extra(extra.get('key'), package_dict)
                     if existing_extra and not override_extras:
                         continue  # no need to copy
-                    if existing_extra:
-                        package_dict['extras'].remove(existing_extra)
-                    package_dict['extras'].append(extra)
+                    set_extra(extra, package_dict)
 
 
 class DefaultValues(BaseConfigProcessor):
 
+    config_keys = ('default_values',)
+    uses_extras = True
+
     @staticmethod
     def check_config(config_obj):
         if 'default_values' in config_obj:
@@ -222,13 +511,145 @@ class DefaultValues(BaseConfigProcessor):
                 for key in default_field:
                     package_dict[key] = default_field[key]
                     # Remove from extras any keys present in the config
-                    existing_extra = get_extra(key, package_dict)
-                    if existing_extra:
-                        package_dict['extras'].remove(existing_extra)
+                    pop_extra(key, package_dict)
+
+
+def get_compiled(config, key, compile_config):
+    '''
+    Returns the value compiled from a config by the given function, compiled
+    once and kept on the compiled config
+    '''
+    config = as_harvest_config(config)
+    compiled = config.compiled.get(key)
+    if compiled is None:
+        compiled = config.compiled[key] = compile_config(config)
+    return compiled
+
+
+# Format of the issued and modified dates of the source datasets
+SOURCE_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+# Mapped fields taken from a date of the source dataset, with the format
+# they are given in
+DATE_FIELDS = {
+    'issued_date': ('issued', '%Y-%m-%d'),
+    'issued_time': ('issued', '%H:%M:%S.%fZ'),
+    'modified_date': ('modified', '%Y-%m-%d'),
+    'modified_time': ('modified', '%H:%M:%S.%fZ'),
+}
+
+# Values of source fields mapped to composite fields that are left out
+NULL_VALUES = ('none', 'null')
+
+# Returned by the accessors of composite subfields that have no value
+MISSING = object()
+
+
+class SourceDates(dict):
+    '''
+    The dates of a source dataset, parsed on first use so that each one is
+    parsed once per dataset
+    '''
+
+    def __init__(self, source_dict):
+        super(SourceDates, self).__init__()
+        self.source_dict = source_dict
+
+    def __missing__(self, key):
+        value = self.source_dict.get(key)
+        date = self[key] = datetime.strptime(value, SOURCE_DATE_FORMAT) if value else None
+        return date
+
+
+def _joined(value):
+    # If value is a list, convert to string
+    if isinstance(value, list):
+        return ', '.join(str(x) for x in value)
+    return value
+
+
+def _map_field_accessor(source_field, default_value):
+    '''
+    Returns a function that gets the value of a mapped field from a source
+    dataset and its parsed dates
+    '''
+    if source_field.startswith('extras.'):
+        # This is an extra field
+        extra_key = source_field[7:]
+
+        def get_value(source_dict, dates):
+            source_extra = get_extra(extra_key, source_dict)
+            return _joined(source_extra.get('value')) if source_extra else None
+
+    elif source_field.startswith('organization.'):
+        org_key = source_field.split('.')[1]
+
+        def get_value(source_dict, dates):
+            return _joined((source_dict.get('organization') or {}).get(org_key) or None)
+
+    else:
+        def get_value(source_dict, dates):
+            return _joined(source_dict.get(source_field) or default_value)
+
+    if source_field in DATE_FIELDS:
+        # If configured convert timestamp to separate date and time formats
+        date_key, date_format = DATE_FIELDS[source_field]
+        get_field_value = get_value
+
+        def get_value(source_dict, dates):
+            date = dates[date_key]
+            if date is None:
+                return get_field_value(source_dict, dates)
+            return date.strftime(date_format)
+
+    return get_value
+
+
+def compile_map_fields(config):
+    return [
+        (_map_field_accessor(source_field, default_value), target_field, to_extras)
+        for source_field, target_field, default_value, to_extras in config.map_fields
+    ]
+
+
+def _composite_subfield_accessor(mapped_field):
+    '''
+    Returns a function that gets the value of a composite subfield from a
+    source dataset, or MISSING
+    '''
+    if mapped_field.startswith('extras.'):
+        extra_key = mapped_field[7:]
+
+        def get_value(source_dict):
+            source_extra = get_extra(extra_key, source_dict)
+            if source_extra and source_extra.get('value') not in NULL_VALUES:
+                return source_extra.get('value')
+            return MISSING
+
+    else:
+        def get_value(source_dict):
+            value = source_dict.get(mapped_field)
+            if value and value not in NULL_VALUES:
+                return value
+            return MISSING
+
+    return get_value
+
+
+def compile_composite_mapping(config):
+    return [
+        (field_name, [(subfield, _composite_subfield_accessor(mapped_field))
+                      for subfield, mapped_field in subfields])
+        for field_name, subfields in config.composite_field_mapping
+    ]
 
 
 class MappingFields(BaseConfigProcessor):
 
+    config_keys = ('map_fields',)
+    uses_extras = True
+    uses_source_extras = True
+
     @staticmethod
     def check_config(config_obj):
         if 'map_fields' in config_obj:
@@ -251,116 +672,66 @@ class MappingFields(BaseConfigProcessor):
     @staticmethod
     def modify_package_dict(package_dict, config, source_dict):
         # Map fields from source to target
-        map_fields = config.get('map_fields', [])
-        if map_fields:
-            for map_field in map_fields:
-                source_field = map_field.get('source')
-                target_field = map_field.get('target')
-                default_value = map_field.get('default')
-
-                value = None
-
-                if source_field.startswith('extras.'):
-                    # This is an extra field
-                    source_extra = get_extra(source_field[7:], source_dict)
-                    if source_extra:
-                        value = source_extra.get('value')
-                elif source_field.startswith('organization.'):
-                    org_key = source_field.split('.')[1]
-                    if source_dict.get('organization', {}).get(org_key):
-                        value = source_dict.get('organization', {}).get(org_key)
-                elif source_dict.get(source_field):
-                    value = source_dict.get(source_field)
-                else:
-                    value = default_value
-
-                # If value is a list, convert to string
-                if isinstance(value, list):
-                    value = ', '.join(str(x) for x in value)
-
-                # If configured convert timestamp to separate date and time formats
-                if source_dict.get('issued'):
-                    if map_field.get('source') == 'issued_date':
-                        value = datetime.strptime(
-                            source_dict.get('issued'),
-                            '%Y-%m-%dT%H:%M:%S.%fZ'
-                        ).strftime('%Y-%m-%d')
-                    if map_field.get('source') == 'issued_time':
-                        value = datetime.strptime(
-                            source_dict.get('issued'),
-                            '%Y-%m-%dT%H:%M:%S.%fZ'
-                        ).strftime('%H:%M:%S.%fZ')
-
-                if source_dict.get('modified'):
-                    if map_field.get('source') == 'modified_date':
-                        value = datetime.strptime(
-                            source_dict.get('modified'),
-                            '%Y-%m-%dT%H:%M:%S.%fZ'
-                        ).strftime('%Y-%m-%d')
-                    if map_field.get('source') == 'modified_time':
-                        value = datetime.strptime(
-                            source_dict.get('modified'),
-                            '%Y-%m-%dT%H:%M:%S.%fZ'
-                        ).strftime('%H:%M:%S.%fZ')
-
-                # Remove from extras any keys present in the config
-                existing_extra = get_extra(target_field, package_dict)
-                if existing_extra:
-                    package_dict['extras'].remove(existing_extra)
-
-                if map_field.get('extras', False):
-                    # Map value to extras
-                    package_dict['extras'].append({'key': target_field, 'value': value})
-                else:
-                    # Map value to dataset field
-                    package_dict[target_field] = value
+        if not config.get('map_fields'):
+            return
+        dates = SourceDates(source_dict)
+        for get_value, target_field, to_extras in \
+                get_compiled(config, 'map_fields', compile_map_fields):
+            value = get_value(source_dict, dates)
+
+            # Remove from extras any keys present in the config
+            pop_extra(target_field, package_dict)
+
+            if to_extras:
+                # Map value to extras
+                set_extra({'key': target_field, 'value': value}, package_dict)
+            else:
+                # Map value to dataset field
+                package_dict[target_field] = value
 
 
 class CompositeMapping(BaseConfigProcessor):
 
+    config_keys = ('composite_field_mapping',)
+    uses_extras = True
+    uses_source_extras = True
+
     @staticmethod
     def check_config(config_obj):
         if 'composite_field_mapping' in config_obj:
             if not isinstance(config_obj['composite_field_mapping'], list):
                 raise ValueError('composite_field_mapping must be a *list* of dictionaries')
             # Check if composite fields exist in the dataset schema
-            try:
-                schema_result = get_action('scheming_dataset_schema_show')({}, {'type': 'dataset'})
-                dataset_schema = schema_result.get('dataset_fields')
-            except:
-                pass
             for composite_map in config_obj.get('composite_field_mapping', []):
                 if not isinstance(composite_map, dict):
                     raise ValueError('composite_field_mapping must be a *list* of dictionaries')
-                field_found = False
                 field_name = list(composite_map)[0]
-                for dataset_field in dataset_schema:
-                    if dataset_field['field_name'] == field_name:
-                        field_found = True
-                        if dataset_field['preset'] != 'composite':
-                            raise ValueError('The field {} must be a composite field'.format(field_name))
-                if not field_found:
+                dataset_field = get_schema_fields('dataset').get(field_name)
+                if dataset_field is None:
                     raise ValueError('The field {} was not found in the dataset schema'.format(field_name))
+                if dataset_field.get('preset') != 'composite':
+                    raise ValueError('The field {} must be a composite field'.format(field_name))
 
     @staticmethod
     def modify_package_dict(package_dict, config, source_dict):
-        composite_mapping = config.get('composite_field_mapping', [])
-        for composite_map in composite_mapping:
-            field_name = list(composite_map)[0]
+        if not config.get('composite_field_mapping'):
+            return
+        for field_name, subfields in get_compiled(
+                config, 'composite_field_mapping', compile_composite_mapping):
             value_dict = {}
-            for subfield in list(composite_map.get(field_name)):
-                mapped_field = composite_map.get(field_name).get(subfield)
-                if mapped_field.startswith('extras.'):
-                    source_extra = get_extra(mapped_field[7:], source_dict)
-                    if source_extra and source_extra.get('value') not in ['none', 'null']:
-                        value_dict[subfield] = source_extra.get('value')
-                elif source_dict.get(mapped_field) and source_dict.get(mapped_field) not in ['none', 'null']:
-                    value_dict[subfield] = source_dict.get(mapped_field)
+            for subfield, get_value in subfields:
+                value = get_value(source_dict)
+                if value is not MISSING:
+                    value_dict[subfield] = value
             package_dict[field_name] = json.dumps(value_dict, ensure_ascii=False)
 
 
 class ContactPoint(BaseConfigProcessor):
 
+    config_keys = ('contact_point',)
+    uses_extras = True
+    uses_source_extras = True
+
     @staticmethod
     def check_config(config_obj):
         if 'contact_point' in config_obj:
@@ -402,9 +773,7 @@ class ContactPoint(BaseConfigProcessor):
             package_dict[target_name] = contact_point_name
 
             # Remove contact name from extras
-            existing_extra = get_extra(target_name, package_dict)
-            if existing_extra:
-                package_dict['extras'].remove(existing_extra)
+            pop_extra(target_name, package_dict)
 
         # Get contact point email
         if target_email:
@@ -422,13 +791,106 @@ class ContactPoint(BaseConfigProcessor):
             package_dict[target_email] = contact_point_email
 
             # Remove contact email from extras
-            existing_extra = get_extra(target_email, package_dict)
-            if existing_extra:
-                package_dict['extras'].remove(existing_extra)
+            pop_extra(target_email, package_dict)
+
+
+class GroupIndex(object):
+    '''
+    The local groups by name and by case-folded title, so that remote groups
+    are matched without listing all the local groups for each dataset.
+
+    Groups are loaded on first use, unless given, and groups created while
+    harvesting are added to the index.
+    '''
+
+    def __init__(self, groups=None):
+        self.by_name = None
+        self.by_title = None
+        self._site_user_name = None
+        if groups is not None:
+            self._index(groups)
+
+    def _index(self, groups):
+        self.by_name = {}
+        self.by_title = {}
+        for group in groups:
+            self.add(group)
+
+    def load(self):
+        groups = model.Session.query(
+            model.Group.id, model.Group.name, model.Group.title) \
+            .filter(model.Group.is_organization.is_(False)) \
+            .filter(model.Group.type == 'group') \
+            .filter(model.Group.state == 'active') \
+            .order_by(model.Group.name)
+        self._index(
+            {'id': group.id, 'name': group.name, 'title': group.title}
+            for group in groups)
+
+    def add(self, group):
+        if self.by_name is None:
+            self.load()
+        group_ref = {'id': group['id'], 'name': group['name']}
+        self.by_name.setdefault(group['name'], group_ref)
+        title = (group.get('title') or '').casefold()
+        if title:
+            self.by_title.setdefault(title, group_ref)
+
+    def match(self, source_group):
+        '''
+        Returns the id and name of the local group with the name of the
+        given remote group or, failing that, with its title
+        '''
+        if self.by_name is None:
+            self.load()
+        group_ref = self.by_name.get(source_group.get('name'))
+        if group_ref is None:
+            title = (source_group.get('title') or '').casefold()
+            if title:
+                group_ref = self.by_title.get(title)
+        return group_ref
+
+    @property
+    def site_user_name(self):
+        if self._site_user_name is None:
+            site_user = get_action('get_site_user')(
+                {'model': model, 'ignore_auth': True, 'defer_commit': True}, {})
+            self._site_user_name = site_user['name']
+        return self._site_user_name
+
+
+# Index of the local groups shared by the datasets imported in the same
+# harvest job, see group_index_scope
+_group_index = ContextVar('group_index', default=None)
+
+
+@contextmanager
+def group_index_scope(group_index):
+    '''
+    Makes RemoteGroups use the given group index while in the block
+    '''
+    token = _group_index.set(group_index)
+    try:
+        yield group_index
+    finally:
+        _group_index.reset(token)
+
+
+def get_group_index():
+    '''
+    Returns the group index of the current scope, or a new one outside of a
+    group_index_scope
+    '''
+    group_index = _group_index.get()
+    if group_index is None:
+        group_index = GroupIndex()
+    return group_index
 
 
 class RemoteGroups(BaseConfigProcessor):
 
+    config_keys = ('remote_groups',)
+
     @staticmethod
     def check_config(config_obj):
         if 'remote_groups' in config_obj:
@@ -447,38 +909,43 @@ class RemoteGroups(BaseConfigProcessor):
         # check if remote groups exist locally
         validated_groups = []
 
-        existing_groups = get_action('group_list')({}, {'all_fields': True})
+        group_index = get_group_index()
         for source_group in source_dict['groups']:
-            found_group = False
-            for existing_group in existing_groups:
-                # Found local group
-                title_match = (source_group.get('title', '').lower() == existing_group.get('title', '').lower())
-                name_match = (source_group.get('name') == existing_group.get('name'))
-                if title_match or name_match:
-                    found_group = True
-                    validated_groups.append({'id': existing_group['id'], 'name': existing_group['name']})
-                    break
-
-            if remote_groups == 'create' and not found_group:
+            # Found local group
+            group_ref = group_index.match(source_group)
+            if group_ref is not None:
+                validated_groups.append(dict(group_ref))
+
+            elif remote_groups == 'create':
                 # Group does not exist, create it
+                context = {'model': model, 'user': group_index.site_user_name}
+                group_dict = {
+                    'name': source_group.get('name'),
+                    'title': source_group.get('title'),
+                    'description': source_group.get('description')
+                }
                 try:
-                    site_user = get_action('get_site_user')({'model': model, 'ignore_auth': True, 'defer_commit': True}, {})
-                    user_name = site_user['name']
-                    group_dict = {
-                        'name': source_group.get('name'),
-                        'title': source_group.get('title'),
-                        'description': source_group.get('description')
-                    }
-                    new_group = get_action('group_create')({'model': model, 'user': user_name}, group_dict)
-                    validated_groups.append({'id': new_group['id'], 'name': new_group['name']})
-                except Exception:
-                    pass
+                    new_group = get_action('group_create')(dict(context), group_dict)
+                except ValidationError:
+                    # The group may have been created since the index was
+                    # loaded, e.g. by another process importing a dataset
+                    # of the same source
+                    try:
+                        new_group = get_action('group_show')(
+                            dict(context), {'id': group_dict['name']})
+                    except NotFound:
+                        log.warning('Remote group %s could not be created', group_dict['name'])
+                        continue
+                group_index.add(new_group)
+                validated_groups.append({'id': new_group['id'], 'name': new_group['name']})
 
         package_dict['groups'].extend(validated_groups)
 
 
 class OrganizationFilter(BaseConfigProcessor):
 
+    check_only = True
+
     @staticmethod
     def check_config(config_obj):
         if 'organizations_filter_include' in config_obj \
@@ -491,8 +958,14 @@ class OrganizationFilter(BaseConfigProcessor):
         pass
 
 
+def compile_format_classifier(config):
+    return FormatClassifier(format_rank=config.resource_format_rank)
+
+
 class ResourceFormatOrder(BaseConfigProcessor):
 
+    config_keys = ('resource_format_order',)
+
     @staticmethod
     def check_config(config_obj):
         if 'resource_format_order' in config_obj:
@@ -501,30 +974,19 @@ class ResourceFormatOrder(BaseConfigProcessor):
 
     @staticmethod
     def modify_package_dict(package_dict, config, source_dict):
-        resource_order = config.get('resource_format_order')
-        if not resource_order:
+        if not config.get('resource_format_order'):
             return package_dict
-        resource_order = [res_format.strip().lower() for res_format in resource_order]
-
-        # create OrderedDict to group resources by format
-        result = OrderedDict([(res_format, []) for res_format in resource_order])
-        result['unspecified_format'] = []
-
-        for resource in package_dict['resources']:
-            res_format = resource.get('format', '').strip().lower()
-            if res_format not in resource_order:
-                result['unspecified_format'].append(resource)
-                continue
-            result[res_format].append(resource)
-
-        # add resources by format order, unspecified formats appear at the end
-        package_dict['resources'] = []
-        for val in result.values():
-            package_dict['resources'] += val
+        # order resources by the rank of their format, unspecified formats
+        # appear at the end
+        format_classifier = get_compiled(
+            config, 'resource_format_order', compile_format_classifier)
+        package_dict['resources'] = format_classifier.order(package_dict['resources'])
 
 
 class KeepExistingResources(BaseConfigProcessor):
 
+    check_only = True
+
     @staticmethod
     def check_config(config_obj):
         if 'keep_existing_resources' in config_obj:
@@ -538,6 +1000,8 @@ class KeepExistingResources(BaseConfigProcessor):
 
 class UploadToDatastore(BaseConfigProcessor):
 
+    check_only = True
+
     @staticmethod
     def check_config(config_obj):
         if 'upload_to_datastore' in config_obj:
@@ -546,4 +1010,19 @@ class UploadToDatastore(BaseConfigProcessor):
 
     @staticmethod
     def modify_package_dict(package_dict, config, source_dict):
-        pass
\ No newline at end of file
+        pass
+
+
+class DeferredIndexing(BaseConfigProcessor):
+
+    check_only = True
+
+    @staticmethod
+    def check_config(config_obj):
+        if 'deferred_indexing' in config_obj:
+            if not isinstance(config_obj.get('deferred_indexing'), bool):
+                raise ValueError('deferred_indexing must be boolean')
+
+    @staticmethod
+    def modify_package_dict(package_dict, config, source_dict):
+        pass
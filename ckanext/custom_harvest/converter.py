@@ -1,20 +1,198 @@
+import time
 import logging
-import mimetypes
 from ckan.common import config
 from ckan.plugins import toolkit
 
+from ckanext.custom_harvest.resource_formats import FormatClassifier, guess_format
+
 
 log = logging.getLogger(__name__)
-mimetypes.init()
+
+DEFAULT_LICENSE_CACHE_TTL = 300
+
+# Config options the converter settings are built from
+SETTINGS_OPTIONS = (
+    'ckan.plugins',
+    'ckanext.format_filter.filter_type',
+    'ckanext.format_filter.whitelist',
+    'ckanext.format_filter.blacklist',
+)
+
+_license_index = None
+_settings = None
+
+
+def settings_fingerprint(config_obj):
+    return tuple(config_obj.get(option) for option in SETTINGS_OPTIONS)
+
+
+class ConverterSettings(object):
+    '''
+    The config values used by the converter, parsed once so that converting
+    a dataset or a resource doesn't parse any config
+    '''
+
+    def __init__(self, config_obj):
+        self.fingerprint = settings_fingerprint(config_obj)
+        self.plugins = frozenset(toolkit.aslist(config_obj.get('ckan.plugins', '')))
+        self.fluent = 'fluent' in self.plugins
+        self.filter_type = config_obj.get('ckanext.format_filter.filter_type')
+        self.whitelist = frozenset(convert_to_filter_list(
+            config_obj.get('ckanext.format_filter.whitelist', '')))
+        self.blacklist = frozenset(convert_to_filter_list(
+            config_obj.get('ckanext.format_filter.blacklist', '')))
+
+    def disallow_file_format(self, file_format):
+        if self.filter_type == 'whitelist':
+            return file_format not in self.whitelist
+        elif self.filter_type == 'blacklist':
+            return file_format in self.blacklist
+        return False
+
+
+def configure(config_obj):
+    '''
+    Builds the converter settings when the plugin is loaded, dropping
+    anything cached from a previous config
+    '''
+    global _settings
+    _settings = ConverterSettings(config_obj)
+    clear_license_index()
+
+
+def get_converter_settings():
+    '''
+    Returns the converter settings, built again if the config changed since
+    they were built
+    '''
+    global _settings
+    if _settings is None or _settings.fingerprint != settings_fingerprint(config):
+        _settings = ConverterSettings(config)
+    return _settings
+
+
+class LicenseIndex(object):
+    '''
+    The licenses of the site, indexed so that the license of a remote
+    dataset is found with dictionary lookups
+    '''
+
+    def __init__(self, licenses, ttl=DEFAULT_LICENSE_CACHE_TTL):
+        self.expires = time.monotonic() + ttl
+        self.by_id = {}
+        self.by_url = {}
+        # The license field of a remote dataset can hold either the url or
+        # the title of a license, the first license matching wins
+        self.by_url_or_title = {}
+        for license in licenses:
+            license_id = license.get('id')
+            if not license_id:
+                continue
+            self.by_id.setdefault(license_id, license_id)
+            if license.get('url'):
+                self.by_url.setdefault(license['url'], license_id)
+            for key in (license.get('url'), license.get('title')):
+                if key:
+                    self.by_url_or_title.setdefault(key, license_id)
+
+    def expired(self):
+        return time.monotonic() >= self.expires
+
+    def match(self, source_dict):
+        '''
+        Returns the id of the license of a remote dataset on this site,
+        matching its license url or title, then its license_id, then its
+        license_url, or None if it has no known license
+        '''
+        license_id = None
+        if source_dict.get('license'):
+            license_id = self.by_url_or_title.get(source_dict['license'])
+        if not license_id and source_dict.get('license_id'):
+            license_id = self.by_id.get(source_dict['license_id'])
+        if not license_id and source_dict.get('license_url'):
+            license_id = self.by_url.get(source_dict['license_url'])
+        return license_id
+
+
+def get_license_cache_ttl():
+    try:
+        return float(config.get('ckanext.custom_harvest.license_cache_ttl',
+                                DEFAULT_LICENSE_CACHE_TTL))
+    except (TypeError, ValueError):
+        return DEFAULT_LICENSE_CACHE_TTL
+
+
+def get_license_index():
+    '''
+    Returns the index of the site licenses, built once per process and
+    refreshed when it is older than the configured TTL
+    '''
+    global _license_index
+    if _license_index is None or _license_index.expired():
+        _license_index = LicenseIndex(
+            toolkit.get_action('license_list')({}, {}), get_license_cache_ttl())
+    return _license_index
+
+
+def clear_license_index():
+    global _license_index
+    _license_index = None
+
+
+class BatchLookups(object):
+    '''
+    Lookups shared by the conversion of a batch of datasets: the converter
+    settings, the classifier of resource formats and the license index
+    '''
+
+    def __init__(self, format_classifier=None):
+        self.settings = get_converter_settings()
+        self.format_classifier = format_classifier or \
+            get_format_classifier(self.settings)
+        self._license_index = None
+
+    @property
+    def license_index(self):
+        # Only fetched if a dataset of the batch has a license
+        if self._license_index is None:
+            self._license_index = get_license_index()
+        return self._license_index
+
+
+def get_format_classifier(settings=None, format_rank=None, xloader_formats=frozenset()):
+    '''
+    Returns a classifier of resource formats dropping the formats filtered
+    out by the converter settings
+    '''
+    settings = settings or get_converter_settings()
+    return FormatClassifier(settings.disallow_file_format, format_rank, xloader_formats)
+
+
+def package_search_to_ckan(source_dict, format_classifier=None):
+    return _convert(source_dict, BatchLookups(format_classifier))
+
+
+def package_search_to_ckan_batch(source_dicts):
+    '''
+    Converts a batch of remote datasets, such as a page of package_search
+    results, resolving the lookups they share once for the whole batch.
+
+    Returns a generator, so datasets are converted as they are consumed.
+    '''
+    lookups = BatchLookups()
+    for source_dict in source_dicts:
+        yield _convert(source_dict, lookups)
 
 
-def package_search_to_ckan(source_dict):
+def _convert(source_dict, lookups):
+    settings = lookups.settings
+    format_classifier = lookups.format_classifier
     package_dict = {}
 
     package_dict['title'] = source_dict.get('title')
     package_dict['notes'] = source_dict.get('notes', '')
 
-    if 'fluent' in config.get('ckan.plugins'):
+    if settings.fluent:
         package_dict['title_translated'] = {'en': source_dict.get('title')}
         package_dict['notes_translated'] = {'en': source_dict.get('notes', '') or ''}
     
@@ -34,14 +212,11 @@ def package_search_to_ckan(source_dict):
         if extra.get('key') == 'spatial' and extra.get('value'):
             package_dict['extras'].append({'key': extra.get('key'), 'value': extra.get('value')})
     
-    if source_dict.get('license'):
-        for license in toolkit.get_action('license_list')({}, {}):
-            if license.get('url') == source_dict.get('license'):
-                package_dict['license_id'] = license.get('id')
-                break
-            elif license.get('title') == source_dict.get('license'):
-                package_dict['license_id'] = license.get('id')
-                break
+    if source_dict.get('license') or source_dict.get('license_id') or \
+            source_dict.get('license_url'):
+        license_id = lookups.license_index.match(source_dict)
+        if license_id:
+            package_dict['license_id'] = license_id
 
     package_dict['resources'] = []
     for source_resource in source_dict.get('resources', []):
@@ -50,13 +225,10 @@ def package_search_to_ckan(source_dict):
         if source_resource.get('format'):
             format = source_resource.get('format')
         elif source_resource.get('mimetype'):
-            ext = mimetypes.guess_extension(source_resource.get('mimetype'))
-            if ext:
-                format = ext[1:]
+            format = guess_format(source_resource.get('mimetype'))
 
         # skip disallowed formats
-        clean_format = ''.join(format.split()).lower()
-        if disallow_file_format(clean_format):
+        if format_classifier.classify(format).disallowed:
             log.debug('Skip disallowed format %s: %s' % (
                 format, source_resource.get('url'))
             )
@@ -69,7 +241,7 @@ def package_search_to_ckan(source_dict):
             'format': format,
         }
 
-        if 'fluent' in config.get('ckan.plugins'):
+        if settings.fluent:
             resource['name_translated'] = {'en': source_resource.get('name')}
             resource['description_translated'] = {'en': source_resource.get('description', '') or ''}
 
@@ -87,14 +259,7 @@ def package_search_to_ckan(source_dict):
 
 
 def disallow_file_format(file_format):
-    if config.get('ckanext.format_filter.filter_type') == 'whitelist':
-        if file_format in get_whitelist():
-            return False
-        return True
-    elif config.get('ckanext.format_filter.filter_type') == 'blacklist':
-        if file_format in get_blacklist():
-            return True
-    return False
+    return get_converter_settings().disallow_file_format(file_format)
 
 
 def get_whitelist():
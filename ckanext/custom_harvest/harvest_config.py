@@ -0,0 +1,122 @@
+import hashlib
+import logging
+
+from ckan.lib.helpers import json
+
+
+log = logging.getLogger(__name__)
+
+# Compiled configurations by harvest source id, as (digest, HarvestConfig)
+_compiled_configs = {}
+
+
+def tag_key(tag):
+    '''
+    Key a tag is merged on, given in the package_show form or as a string,
+    so that tags differing only in case, whitespace or other keys of the
+    tag dict are taken as the same tag
+    '''
+    name = tag.get('name') if isinstance(tag, dict) else tag
+    return (name or '').strip().lower()
+
+
+class HarvestConfig(dict):
+    '''
+    Harvest source configuration, parsed once and shared by the config
+    processors of every dataset imported from the source.
+
+    It behaves as the dict loaded from the source config and additionally
+    holds values that are normalized up front so that processors don't have
+    to work them out again for each dataset.
+    '''
+
+    def __init__(self, config_obj=None):
+        super(HarvestConfig, self).__init__(config_obj or {})
+
+        self.override_extras = bool(self.get('override_extras', False))
+
+        # Default tags by tag key, the first of any duplicates being kept
+        self.default_tags_by_key = {}
+        for tag in self.get('default_tags') or []:
+            self.default_tags_by_key.setdefault(tag_key(tag), tag)
+
+        # Formats are compared with the resource formats lower-cased
+        self.resource_format_order = [
+            res_format.strip().lower()
+            for res_format in self.get('resource_format_order') or []
+        ]
+        # Ranks are dense, repeated formats keeping their first position
+        self.resource_format_rank = dict(
+            (res_format, rank) for rank, res_format
+            in enumerate(dict.fromkeys(self.resource_format_order)))
+
+        self.default_group_refs = [
+            {'name': group['name']}
+            for group in self.get('default_group_dicts') or []
+        ]
+        self.default_group_ids = [
+            group['id'] for group in self.get('default_group_dicts') or []
+        ]
+
+        self.map_fields = [
+            (map_field.get('source'), map_field.get('target'),
+             map_field.get('default'), map_field.get('extras', False))
+            for map_field in self.get('map_fields') or []
+        ]
+
+        self.composite_field_mapping = []
+        for composite_map in self.get('composite_field_mapping') or []:
+            field_name = list(composite_map)[0]
+            subfields = composite_map[field_name]
+            if isinstance(subfields, dict):
+                subfields = list(subfields.items())
+            self.composite_field_mapping.append((field_name, subfields))
+
+        # Processor pipelines built for this config
+        self.pipelines = {}
+
+        # Values compiled by the config processors for this config, by key
+        self.compiled = {}
+
+
+def as_harvest_config(config):
+    '''
+    Returns the given config as a HarvestConfig, compiling it if a plain
+    dict was provided
+    '''
+    if isinstance(config, HarvestConfig):
+        return config
+    return HarvestConfig(config)
+
+
+def config_digest(config_str):
+    return hashlib.sha1((config_str or '').encode('utf-8')).hexdigest()
+
+
+def get_harvest_config(config_str, source_id=None):
+    '''
+    Returns the compiled configuration for the given config string.
+
+    Configurations are cached per harvest source and keyed on a hash of the
+    config string, so editing the source compiles it again.
+    '''
+    if not config_str:
+        return HarvestConfig()
+
+    digest = config_digest(config_str)
+    cached = _compiled_configs.get(source_id)
+    if cached and cached[0] == digest:
+        return cached[1]
+
+    compiled_config = HarvestConfig(json.loads(config_str))
+    log.debug('Using config: %r', compiled_config)
+    if source_id:
+        _compiled_configs[source_id] = (digest, compiled_config)
+    return compiled_config
+
+
+def clear_cache(source_id=None):
+    if source_id:
+        _compiled_configs.pop(source_id, None)
+    else:
+        _compiled_configs.clear()
@@ -7,7 +7,10 @@ from ckanext.harvest.harvesters import HarvesterBase
 from ckanext.harvest.model import HarvestObject
 
 from ckan.lib.helpers import json
+from ckanext.custom_harvest import metrics
+from ckanext.custom_harvest.harvest_config import get_harvest_config
 from ckanext.custom_harvest.configuration_processors import (
+    build_pipeline,
     DefaultTags, CleanTags,
     DefaultExtras, CopyExtras,
     DefaultGroups, DefaultValues,
@@ -17,7 +20,8 @@ from ckanext.custom_harvest.configuration_processors import (
     OrganizationFilter,
     ResourceFormatOrder,
     KeepExistingResources,
-    UploadToDatastore
+    UploadToDatastore,
+    DeferredIndexing
 )
 
 
@@ -42,7 +46,8 @@ class CustomHarvester(HarvesterBase):
         OrganizationFilter,
         ResourceFormatOrder,
         KeepExistingResources,
-        UploadToDatastore
+        UploadToDatastore,
+        DeferredIndexing
     ]
 
     def _get_object_extra(self, harvest_object, key):
@@ -55,6 +60,18 @@ class CustomHarvester(HarvesterBase):
                 return extra.value
         return None
 
+    @classmethod
+    def _save_gather_error(cls, message, job):
+        metrics.ERRORS.inc(source=job.source_id, stage='gather')
+        return super(CustomHarvester, cls)._save_gather_error(message, job)
+
+    @classmethod
+    def _save_object_error(cls, message, obj, stage='Fetch', line=None):
+        metrics.ERRORS.inc(source=getattr(obj, 'harvest_source_id', None),
+                           stage=(stage or '').lower())
+        return super(CustomHarvester, cls)._save_object_error(
+            message, obj, stage, line)
+
     def get_original_url(self, harvest_object_id):
         obj = model.Session.query(HarvestObject). \
             filter(HarvestObject.id == harvest_object_id).\
@@ -101,23 +118,26 @@ class CustomHarvester(HarvesterBase):
             creating or updating the actual package.
         '''
 
+        config = self._get_config(harvest_object.job.source)
+
+        # Modify package_dict using the config_processors active for
+        # this config
+        pipeline = build_pipeline(self.config_processors, config)
+        return pipeline(package_dict, source_dict)
+
+    def _get_config(self, harvest_source):
+        '''
+        Returns the compiled config of a harvest source, or an empty config
+        if it can't be parsed. Configs are cached per source, so this is
+        cheap to call for every object.
+        '''
         try:
-            self._set_config(harvest_object.job.source.config)
-        except:
-            self._set_config('')
-
-        # Modify package_dict using config_processors
-        for processor in self.config_processors:
-            processor.modify_package_dict(package_dict, self.config, source_dict)
-
-        return package_dict
-
-    def _set_config(self, config_str):
-        if config_str:
-            self.config = json.loads(config_str)
-            log.debug('Using config: %r', self.config)
-        else:
-            self.config = {}
+            return get_harvest_config(harvest_source.config, harvest_source.id)
+        except Exception:
+            return get_harvest_config('')
+
+    def _set_config(self, config_str, source_id=None):
+        self.config = get_harvest_config(config_str, source_id)
 
     def validate_config(self, config):
         if not config:
@@ -1,3 +1,4 @@
+import time
 import uuid
 import logging
 import requests
@@ -11,10 +12,16 @@ from ckan import plugins as p
 from ckan.lib.helpers import json
 from ckan.lib.navl import dictization_functions
 from ckanext.harvest.model import HarvestObject, HarvestObjectExtra
-from ckanext.harvest.logic.schema import unicode_safe
 from ckanext.custom_harvest import converter
+from ckanext.custom_harvest import import_context as harvest_import_context
+from ckanext.custom_harvest import indexing
+from ckanext.custom_harvest import memory_profiling
+from ckanext.custom_harvest import metrics
+from ckanext.custom_harvest import timing
 from ckanext.custom_harvest import utils
+from ckanext.custom_harvest.configuration_processors import group_index_scope
 from ckanext.custom_harvest.harvesters.base import CustomHarvester
+from ckanext.custom_harvest.resource_formats import FormatClassifier
 
 
 log = logging.getLogger(__name__)
@@ -35,7 +42,7 @@ class PackageSearchHarvester(CustomHarvester):
             'form_config_interface': 'Text'
         }
 
-    def _get_content(self, url):
+    def _get_content(self, url, source_id=None):
         headers = {}
         api_key = self.config.get('api_key')
         if api_key:
@@ -49,19 +56,25 @@ class PackageSearchHarvester(CustomHarvester):
             raise ContentFetchError('Request error: %s' % e)
         except Exception as e:
             raise ContentFetchError('HTTP general exception: %s' % e)
+        metrics.BYTES_DOWNLOADED.inc(len(http_request.content), source=source_id)
         return http_request.text
 
-    def _set_config(self, config_str):
-        if config_str:
-            self.config = json.loads(config_str)
-            log.debug('Using config: %r', self.config)
-        else:
-            self.config = {}
-
     def gather_stage(self, harvest_job):
         log.debug('In PackageSearchHarvester gather_stage (%s)',
                   harvest_job.source.url)
 
+        # The timings are kept until the job is finished, to be reported
+        # along with the ones of the import stage
+        timings = timing.get_job_timings(harvest_job.id)
+        profile = memory_profiling.get_job_profile(harvest_job.id)
+        try:
+            with timings.phase('gather: total'):
+                return self._gather(harvest_job, timings, profile)
+        finally:
+            memory_profiling.release_job_profile(harvest_job.id)
+            metrics.write_metrics()
+
+    def _gather(self, harvest_job, timings, profile=memory_profiling.NULL_PROFILE):
         ids = []
 
         # Get the previous guids for this source
@@ -71,13 +84,15 @@ class PackageSearchHarvester(CustomHarvester):
             .filter(HarvestObject.harvest_source_id == harvest_job.source.id)
         guid_to_package_id = {}
 
-        for guid, package_id in query:
-            guid_to_package_id[guid] = package_id
+        with timings.phase('gather: load guids'):
+            for guid, package_id in query:
+                guid_to_package_id[guid] = package_id
+        profile.snapshot('gather: after loading guids')
 
         guids_in_db = list(guid_to_package_id.keys())
         guids_in_source = []
 
-        self._set_config(harvest_job.source.config)
+        self._set_config(harvest_job.source.config, harvest_job.source.id)
 
         # Get source URL
         parsed_url = urlparse(harvest_job.source.url)
@@ -114,12 +129,16 @@ class PackageSearchHarvester(CustomHarvester):
 
         # Request all remote packages
         try:
-            pkg_dicts = self._search_for_datasets(
-                base_search_url,
-                query,
-                fq_terms,
-                ext_bbox
-            )
+            with timings.phase('gather: search'):
+                pkg_dicts = self._search_for_datasets(
+                    base_search_url,
+                    query,
+                    fq_terms,
+                    ext_bbox,
+                    timings,
+                    harvest_job.source.id,
+                    profile
+                )
             log.info('Found %s datasets at CKAN: %s',
                         len(pkg_dicts), base_search_url)
         except SearchError as e:
@@ -137,31 +156,34 @@ class PackageSearchHarvester(CustomHarvester):
 
         # Create harvest objects for each dataset
         try:
-            guids_in_source = []
-            for pkg_dict in pkg_dicts:
-                guid = pkg_dict.get('name')
-                log.info('Got identifier: {0}'.format(guid.encode('utf8')))
-                guids_in_source.append(guid)
-                log.info('Creating HarvestObject for %s %s', pkg_dict['name'], pkg_dict['id'])
-                if guid in guids_in_db:
-                    # Dataset needs to be updated
-                    obj = HarvestObject(guid=guid, job=harvest_job,
-                                        package_id=guid_to_package_id[guid],
-                                        content=json.dumps(pkg_dict),
-                                        extras=[
-                                            HarvestObjectExtra(key='status', value='change'),
-                                            HarvestObjectExtra(key='base_search_url', value=base_search_url)
-                                        ])
-                else:
-                    # Dataset needs to be created
-                    obj = HarvestObject(guid=guid, job=harvest_job,
-                                        content=json.dumps(pkg_dict),
-                                        extras=[
-                                            HarvestObjectExtra(key='status', value='new'),
-                                            HarvestObjectExtra(key='base_search_url', value=base_search_url)
-                                        ])
-                obj.save()
-                ids.append(obj.id)
+            with timings.phase('gather: create objects'):
+                guids_in_source = []
+                for pkg_dict in pkg_dicts:
+                    guid = pkg_dict.get('name')
+                    log.info('Got identifier: {0}'.format(guid.encode('utf8')))
+                    guids_in_source.append(guid)
+                    log.info('Creating HarvestObject for %s %s', pkg_dict['name'], pkg_dict['id'])
+                    if guid in guids_in_db:
+                        # Dataset needs to be updated
+                        obj = HarvestObject(guid=guid, job=harvest_job,
+                                            package_id=guid_to_package_id[guid],
+                                            content=json.dumps(pkg_dict),
+                                            extras=[
+                                                HarvestObjectExtra(key='status', value='change'),
+                                                HarvestObjectExtra(key='base_search_url', value=base_search_url)
+                                            ])
+                        metrics.OBJECTS_CREATED.inc(source=harvest_job.source.id, status='change')
+                    else:
+                        # Dataset needs to be created
+                        obj = HarvestObject(guid=guid, job=harvest_job,
+                                            content=json.dumps(pkg_dict),
+                                            extras=[
+                                                HarvestObjectExtra(key='status', value='new'),
+                                                HarvestObjectExtra(key='base_search_url', value=base_search_url)
+                                            ])
+                        metrics.OBJECTS_CREATED.inc(source=harvest_job.source.id, status='new')
+                    obj.save()
+                    ids.append(obj.id)
 
         except ValueError as e:
             msg = 'Error parsing file: {0}'.format(str(e))
@@ -170,12 +192,35 @@ class PackageSearchHarvester(CustomHarvester):
 
         # Check datasets that need to be deleted
         guids_to_delete = set(guids_in_db) - set(guids_in_source)
+        profile.snapshot('gather: before deleting datasets')
+        with timings.phase('gather: delete datasets'):
+            if self.config.get('deferred_indexing', False) and guids_to_delete:
+                index_queue = indexing.DeferredIndexQueue(harvest_job.id)
+                with indexing.automatic_indexing_suspended(index_queue):
+                    ids.extend(self._delete_datasets(harvest_job, guids_to_delete,
+                                                     guid_to_package_id))
+                for guid in guids_to_delete:
+                    index_queue.add(guid_to_package_id[guid])
+                index_queue.commit()
+            else:
+                ids.extend(self._delete_datasets(harvest_job, guids_to_delete,
+                                                 guid_to_package_id))
+
+        return ids
+
+    def _delete_datasets(self, harvest_job, guids_to_delete, guid_to_package_id):
+        '''
+        Creates the harvest objects for the datasets no longer present in the
+        source and renames them so that their urls can be reused
+        '''
+        ids = []
         for guid in guids_to_delete:
             obj = HarvestObject(
                 guid=guid, job=harvest_job,
                 package_id=guid_to_package_id[guid],
                 extras=[HarvestObjectExtra(key='status', value='delete')])
             ids.append(obj.id)
+            metrics.OBJECTS_CREATED.inc(source=harvest_job.source.id, status='delete')
             model.Session.query(HarvestObject).\
                 filter_by(guid=guid).\
                 update({'current': False}, False)
@@ -191,7 +236,9 @@ class PackageSearchHarvester(CustomHarvester):
 
         return ids
 
-    def _search_for_datasets(self, base_search_url, query=None, fq_terms=None, ext_bbox=None):
+    def _search_for_datasets(self, base_search_url, query=None, fq_terms=None, ext_bbox=None,
+                             timings=timing.NULL_TIMINGS, source_id=None,
+                             profile=memory_profiling.NULL_PROFILE):
         '''Does a dataset search on a remote CKAN and returns the results.
 
         Deals with paging to return all the results, not just the first page.
@@ -214,12 +261,14 @@ class PackageSearchHarvester(CustomHarvester):
             url = base_search_url + '?' + urlencode(params)
             log.info('Searching for CKAN datasets: %s', url)
             try:
-                content = self._get_content(url)
+                with timings.phase('gather: fetch page'):
+                    content = self._get_content(url, source_id)
             except ContentFetchError as e:
                 raise SearchError(
                     'Error sending request to search remote '
                     'CKAN instance %s using URL %r. Error: %s' %
                     (base_search_url, url, e))
+            metrics.PAGES_FETCHED.inc(source=source_id)
 
             if previous_content and content == previous_content:
                 raise SearchError('The paging doesn\'t seem to work. URL: %s' %
@@ -246,6 +295,7 @@ class PackageSearchHarvester(CustomHarvester):
             pkg_ids |= ids_in_page
 
             pkg_dicts.extend(pkg_dicts_page)
+            profile.page_fetched()
 
             if len(pkg_dicts_page) == 0:
                 break
@@ -262,12 +312,70 @@ class PackageSearchHarvester(CustomHarvester):
     def import_stage(self, harvest_object):
         log.debug('In PackageSearchHarvester import_stage')
 
-        context = {'model': model, 'session': model.Session,
-                   'user': self._get_user_name()}
         if not harvest_object:
             log.error('No harvest object received')
             return False
 
+        # Everything specific to this object is kept out of the harvester
+        # instance, so several objects can be imported at the same time
+        import_context = harvest_import_context.get_import_context(
+            self, harvest_object.job)
+
+        timings = import_context.timings
+        profile = memory_profiling.get_job_profile(harvest_object.harvest_job_id)
+
+        index_queue = indexing.get_scoped_index_queue()
+        job_index_queue = index_queue is None and \
+            import_context.config.get('deferred_indexing', False)
+        if job_index_queue:
+            # Datasets are indexed in batches, committing once the job has no
+            # more objects waiting to be imported
+            index_queue = indexing.get_index_queue(
+                harvest_object.harvest_job_id, import_context.source_id)
+            # Also tracked in the database, as other fetch consumers may
+            # import the last object of the job
+            indexing.mark_pending(harvest_object)
+
+        import_started = time.perf_counter()
+        with profile.track_import(), timings.phase('import: total'):
+            if index_queue is None:
+                result = self._import_object(harvest_object, import_context)
+            else:
+                with indexing.automatic_indexing_suspended(index_queue):
+                    result = self._import_object(harvest_object, import_context)
+                if result:
+                    index_queue.add(harvest_object.package_id, harvest_object.id)
+                elif job_index_queue:
+                    index_queue.add(None, harvest_object.id)
+        metrics.IMPORT_DURATION.observe(time.perf_counter() - import_started,
+                                        source=import_context.source_id)
+
+        write_metrics = bool(metrics.get_metrics_file())
+        if (job_index_queue or timings.enabled or profile.enabled or write_metrics) and \
+                not self._job_has_pending_objects(harvest_object):
+            # This was the last object of the job
+            if job_index_queue:
+                indexing.release_index_queue(harvest_object.harvest_job_id)
+            harvest_import_context.release_import_context(harvest_object.harvest_job_id)
+            timing.release_job_timings(harvest_object.harvest_job_id)
+            memory_profiling.release_job_profile(harvest_object.harvest_job_id)
+            metrics.write_metrics()
+        elif write_metrics:
+            metrics.write_metrics(force=False)
+        return result
+
+    def _job_has_pending_objects(self, harvest_object):
+        pending_object = model.Session.query(HarvestObject.id) \
+            .filter(HarvestObject.harvest_job_id == harvest_object.harvest_job_id) \
+            .filter(HarvestObject.id != harvest_object.id) \
+            .filter(HarvestObject.state.in_(['WAITING', 'FETCH'])) \
+            .first()
+        return pending_object is not None
+
+    def _import_object(self, harvest_object, import_context):
+        context = import_context.action_context()
+        timings = import_context.timings
+
         base_search_url = self._get_object_extra(harvest_object, 'base_search_url')
         status = self._get_object_extra(harvest_object, 'status')
         if status == 'delete':
@@ -295,10 +403,10 @@ class PackageSearchHarvester(CustomHarvester):
             previous_object.current = False
             previous_object.add()
 
-        self._set_config(harvest_object.job.source.config)
-
         source_dict = json.loads(harvest_object.content)
-        package_dict = converter.package_search_to_ckan(source_dict)
+        with timings.phase('import: convert'):
+            package_dict = converter.package_search_to_ckan(
+                source_dict, import_context.format_classifier)
 
         if source_dict.get('type') != 'dataset':
             log.warning('Remote dataset is not a dataset, ignoring...')
@@ -308,9 +416,10 @@ class PackageSearchHarvester(CustomHarvester):
             # copy across ids from the existing dataset, otherwise they'll
             # be recreated with new ids
             if status == 'change':
-                existing_dataset = self._get_existing_dataset(harvest_object.guid)
+                with timings.phase('import: get existing dataset'):
+                    existing_dataset = self._get_existing_dataset(harvest_object.guid)
                 if existing_dataset:
-                    copy_across_resource_ids(existing_dataset, package_dict, self.config)
+                    copy_across_resource_ids(existing_dataset, package_dict, import_context.config)
                     package_dict['name'] = existing_dataset.get('name')
                     # Copy across private status
                     if 'private' in existing_dataset.keys():
@@ -320,30 +429,23 @@ class PackageSearchHarvester(CustomHarvester):
             if not package_dict.get('name'):
                 package_dict['name'] = self._gen_new_name(source_dict.get('name'))
 
-            package_dict = self.modify_package_dict(package_dict, source_dict, harvest_object)
+            with timings.phase('import: config processors'), \
+                    group_index_scope(import_context.group_index):
+                package_dict = self.modify_package_dict(package_dict, source_dict, harvest_object)
 
             # Get owner organization from the harvest source dataset
-            harvest_source_dataset = model.Package.get(harvest_object.source.id)
-            if harvest_source_dataset.owner_org:
-                package_dict['owner_org'] = harvest_source_dataset.owner_org
+            if import_context.owner_org:
+                package_dict['owner_org'] = import_context.owner_org
 
             # Flag this object as the current one
             harvest_object.current = True
             harvest_object.add()
 
-            context = {
-                'user': self._get_user_name(),
-                'return_id_only': True,
-                'ignore_auth': True,
-            }
-
             if status == 'new':
-                package_schema = logic.schema.default_create_package_schema()
-                context['schema'] = package_schema
+                context = import_context.create_context()
 
                 # We need to explicitly provide a package ID
                 package_dict['id'] = str(uuid.uuid4())
-                package_schema['id'] = [unicode_safe]
 
                 # Save reference to the package on the object
                 harvest_object.package_id = package_dict['id']
@@ -357,21 +459,24 @@ class PackageSearchHarvester(CustomHarvester):
                 model.Session.flush()
 
             elif status == 'change':
+                context = import_context.update_context()
                 package_dict['id'] = harvest_object.package_id
 
             if status in ['new', 'change']:
                 action = 'package_create' if status == 'new' else 'package_update'
                 message_status = 'Created' if status == 'new' else 'Updated'
 
-                package_id = p.toolkit.get_action(action)(context, package_dict)
+                with timings.phase('import: %s' % action):
+                    package_id = p.toolkit.get_action(action)(context, package_dict)
                 log.info('%s dataset with id %s', message_status, package_id)
 
                 # Upload tabular resources to datastore
-                upload_to_datastore = self.config.get('upload_to_datastore', True)
+                upload_to_datastore = import_context.config.get('upload_to_datastore', True)
                 if upload_to_datastore and p.get_plugin('xloader'):
                     # Get package dict again in case there's new resource ids
                     pkg_dict = p.toolkit.get_action('package_show')(context, {'id': package_id})
-                    upload_resources_to_datastore(context, pkg_dict, source_dict, base_search_url)
+                    upload_resources_to_datastore(context, pkg_dict, source_dict, base_search_url,
+                                                  timings, import_context.format_classifier)
         except Exception as e:
             dataset = json.loads(harvest_object.content)
             dataset_name = dataset.get('name', '')
@@ -391,9 +496,10 @@ def copy_across_resource_ids(existing_dataset, harvested_dataset, config=None):
     the same, copy the resource ID into the harvested_dataset dict.
     '''
     # take a copy of the existing_resources so we can remove them when they are
-    # matched - we don't want to match them more than once.
-    existing_resources_still_to_match = \
-        [r for r in existing_dataset.get('resources')]
+    # matched - we don't want to match them more than once. They are kept by
+    # object id, in order, so that removing one doesn't scan the others.
+    existing_resources_still_to_match = dict(
+        (id(r), r) for r in existing_dataset.get('resources'))
 
     # we match resources a number of ways. we'll compute an 'identity' of a
     # resource in both datasets and see if they match.
@@ -414,7 +520,7 @@ def copy_across_resource_ids(existing_dataset, harvested_dataset, config=None):
     for resource_identity_function in resource_identity_functions:
         # calculate the identities of the existing_resources
         existing_resource_identities = {}
-        for r in existing_resources_still_to_match:
+        for r in existing_resources_still_to_match.values():
             try:
                 identity = resource_identity_function(r)
                 existing_resource_identities[identity] = r
@@ -438,8 +544,7 @@ def copy_across_resource_ids(existing_dataset, harvested_dataset, config=None):
                         resource[field] = matching_existing_resource.get(field)
                 # make sure we don't match this existing_resource again
                 del existing_resource_identities[identity]
-                existing_resources_still_to_match.remove(
-                    matching_existing_resource)
+                del existing_resources_still_to_match[id(matching_existing_resource)]
         if not existing_resources_still_to_match:
             break
 
@@ -447,18 +552,30 @@ def copy_across_resource_ids(existing_dataset, harvested_dataset, config=None):
     try:
         keep_existing_resources = config.get('keep_existing_resources', False)
         if keep_existing_resources and harvested_dataset.get('resources'):
-            for existing_resource in existing_resources_still_to_match:
+            for existing_resource in existing_resources_still_to_match.values():
                 if existing_resource.get('url'):
                     harvested_dataset['resources'].append(existing_resource)
     except Exception:
         pass
 
 
-def upload_resources_to_datastore(context, package_dict, source_dict, base_search_url):
+def upload_resources_to_datastore(context, package_dict, source_dict, base_search_url,
+                                  timings=timing.NULL_TIMINGS, format_classifier=None):
+    if format_classifier is None:
+        format_classifier = FormatClassifier(xloader_formats=utils.get_xloader_formats())
+
+    # Source resources with a data dictionary, by url and name
+    datastore_resources = {}
+    for source_resource in source_dict.get('resources') or []:
+        if source_resource.get('datastore_active'):
+            datastore_resources.setdefault(
+                (source_resource.get('url'), source_resource.get('name')), []).append(source_resource)
+
     for resource in package_dict.get('resources'):
-        if utils.is_xloader_format(resource.get('format')) and resource.get('id'):
+        if format_classifier.classify(resource.get('format')).xloader and resource.get('id'):
             # Get data dictionary if available and push to datastore
-            push_data_dictionary(context, resource, source_dict, base_search_url)
+            with timings.phase('import: push_data_dictionary'):
+                push_data_dictionary(context, resource, datastore_resources, base_search_url)
 
             # Submit the resource to be pushed to the datastore
             try:
@@ -467,31 +584,31 @@ def upload_resources_to_datastore(context, package_dict, source_dict, base_searc
                     'resource_id': resource.get('id'),
                     'ignore_hash': False
                 }
-                p.toolkit.get_action('xloader_submit')(context, xloader_dict)
+                with timings.phase('import: xloader_submit'):
+                    p.toolkit.get_action('xloader_submit')(context, xloader_dict)
             except p.toolkit.ValidationError as e:
                 log.debug(e)
                 pass
 
 
-def push_data_dictionary(context, resource, source_dict, base_search_url):
-    # Check for resource's data dictionary
+def push_data_dictionary(context, resource, datastore_resources, base_search_url):
+    # Check for resource's data dictionary in the source resources with the
+    # same url and name
     fields = []
-    for source_resource in source_dict.get('resources'):
-        if (resource.get('url') == source_resource.get('url') and
-                resource.get('title') == source_resource.get('name') and
-                source_resource.get('datastore_active')):
-            try:
-                query_url = base_search_url + '/api/action/datastore_search?limit=0&resource_id=' + source_resource.get('id')
-                datastore_response = requests.get(query_url, timeout=30)
-                data = datastore_response.json()
-                result = data.get('result', {})
-                fields = result.get('fields', [])
-                if len(fields) > 0 and fields[0].get('id') == '_id':
-                    del fields[0]  # Remove the first dictionary which is only for ckan row number
-                break
-            except Exception as e:
-                log.debug(e)
-                pass
+    for source_resource in datastore_resources.get(
+            (resource.get('url'), resource.get('title')), []):
+        try:
+            query_url = base_search_url + '/api/action/datastore_search?limit=0&resource_id=' + source_resource.get('id')
+            datastore_response = requests.get(query_url, timeout=30)
+            data = datastore_response.json()
+            result = data.get('result', {})
+            fields = result.get('fields', [])
+            if len(fields) > 0 and fields[0].get('id') == '_id':
+                del fields[0]  # Remove the first dictionary which is only for ckan row number
+            break
+        except Exception as e:
+            log.debug(e)
+            pass
     # If fields are defined push the data dictionary to datastore
     if fields:
         log.info('Pushing data dictionary for resource '.format(resource.get('id')))
@@ -0,0 +1,112 @@
+import logging
+from collections import namedtuple
+
+from ckan import model
+from ckan import logic
+from ckanext.harvest.logic.schema import unicode_safe
+
+from ckanext.custom_harvest import converter
+from ckanext.custom_harvest import timing
+from ckanext.custom_harvest import utils
+from ckanext.custom_harvest.configuration_processors import GroupIndex
+from ckanext.custom_harvest.harvest_config import config_digest, get_harvest_config
+
+
+log = logging.getLogger(__name__)
+
+# Import contexts by harvest job id
+_import_contexts = {}
+
+
+SourceFingerprint = namedtuple(
+    'SourceFingerprint', ['config_digest', 'url', 'type', 'active', 'owner_org'])
+
+
+def source_fingerprint(source):
+    '''
+    Identifies the state of a harvest source, so that editing it invalidates
+    the import contexts built from it in any process
+    '''
+    # The organization is kept on the dataset of the harvest source
+    owner_org = model.Session.query(model.Package.owner_org) \
+        .filter(model.Package.id == source.id) \
+        .scalar()
+    return SourceFingerprint(config_digest(source.config), source.url,
+                             source.type, source.active, owner_org)
+
+
+class ImportContext(object):
+    '''
+    Values that don't change during a harvest job, computed once and shared
+    by the import of all of its objects
+    '''
+
+    def __init__(self, harvester, harvest_job, fingerprint=None):
+        source = harvest_job.source
+        self.job_id = harvest_job.id
+        self.source_id = source.id
+        self.fingerprint = fingerprint or source_fingerprint(source)
+        self.timings = timing.get_job_timings(harvest_job.id)
+
+        try:
+            self.config = get_harvest_config(source.config, source.id)
+        except ValueError:
+            self.config = get_harvest_config('')
+
+        self.user_name = harvester._get_user_name()
+
+        # Local groups matched by RemoteGroups, loaded on first use
+        self.group_index = GroupIndex()
+
+        # Resource formats classified once for the converter and the upload
+        # to the datastore
+        self.format_classifier = converter.get_format_classifier(
+            xloader_formats=utils.get_xloader_formats())
+
+        # Owner organization of the harvest source dataset
+        self.owner_org = self.fingerprint.owner_org
+
+        # We need to explicitly provide a package ID for new datasets
+        self.create_package_schema = logic.schema.default_create_package_schema()
+        self.create_package_schema['id'] = [unicode_safe]
+
+    def action_context(self, **kwargs):
+        '''
+        Returns a new context for the actions called while importing, as
+        actions modify the context they are given
+        '''
+        context = {
+            'model': model,
+            'session': model.Session,
+            'user': self.user_name,
+        }
+        context.update(kwargs)
+        return context
+
+    def create_context(self):
+        return self.action_context(
+            return_id_only=True,
+            ignore_auth=True,
+            schema=dict(self.create_package_schema))
+
+    def update_context(self):
+        return self.action_context(return_id_only=True, ignore_auth=True)
+
+
+def get_import_context(harvester, harvest_job):
+    fingerprint = source_fingerprint(harvest_job.source)
+    import_context = _import_contexts.get(harvest_job.id)
+    if import_context is None:
+        # Jobs imported at the same time keep their own context, the ones
+        # of finished jobs are dropped
+        for finished_job_id in utils.get_finished_jobs(_import_contexts):
+            release_import_context(finished_job_id)
+    if import_context is None or import_context.fingerprint != fingerprint:
+        import_context = _import_contexts[harvest_job.id] = \
+            ImportContext(harvester, harvest_job, fingerprint)
+        log.debug('Built import context for job %s', harvest_job.id)
+    return import_context
+
+
+def release_import_context(job_id):
+    return _import_contexts.pop(job_id, None)
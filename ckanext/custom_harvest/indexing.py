@@ -0,0 +1,260 @@
+import logging
+import functools
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from ckan import model
+from ckan.common import config
+from ckan.lib import search
+from ckanext.harvest.model import HarvestObject, HarvestObjectExtra
+
+from ckanext.custom_harvest import utils
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 100
+
+# Deferred index queues, one per harvest job handled by this process
+_index_queues = {}
+
+# Extra of the harvest objects whose dataset waits in a deferred index queue.
+# Queues live in the memory of each fetch consumer, so the datasets are also
+# tracked in the database and the consumer importing the last object of a
+# job indexes the ones left in the queues of the others.
+PENDING_EXTRA_KEY = 'custom_harvest_index_pending'
+
+# Queue collecting every dataset imported within a deferred_indexing block
+_scoped_index_queue = None
+
+# Queue of the datasets changed while automatic indexing is suspended in the
+# current thread, see automatic_indexing_suspended
+_suspended_index_queue = ContextVar('suspended_index_queue', default=None)
+
+
+@contextmanager
+def automatic_indexing_suspended(queue):
+    '''
+    Stops CKAN from indexing synchronously the datasets created or updated
+    within the block, adding them to the given queue instead so that they
+    can be reindexed later in batches.
+
+    Only the changes made by the current thread are deferred, the rest of
+    the process keeps indexing datasets as they change.
+    '''
+    token = _suspended_index_queue.set(queue)
+    try:
+        yield queue
+    finally:
+        _suspended_index_queue.reset(token)
+
+
+def defer_when_suspended(notify):
+    '''
+    Wraps the notify method of CKAN's synchronous search plugin, so that the
+    datasets created or updated while automatic indexing is suspended are
+    queued rather than indexed. Deleted datasets are still removed from the
+    index at once.
+    '''
+    if getattr(notify, 'defers_indexing', False):
+        return notify
+
+    @functools.wraps(notify)
+    def wrapper(plugin, entity, operation):
+        queue = _suspended_index_queue.get()
+        if queue is not None and isinstance(entity, model.Package) and \
+                operation != model.DomainObjectOperation.deleted:
+            # Notified while the session commits, the dataset is indexed
+            # with the next batch of the queue
+            queue.defer(entity.id)
+            return
+        return notify(plugin, entity, operation)
+
+    wrapper.defers_indexing = True
+    return wrapper
+
+
+def setup_automatic_indexing():
+    '''
+    Lets automatic_indexing_suspended defer the indexing done by CKAN on
+    every change to a dataset
+    '''
+    search.SynchronousSearchPlugin.notify = defer_when_suspended(
+        search.SynchronousSearchPlugin.notify)
+
+
+def get_batch_size():
+    try:
+        batch_size = int(config.get('ckanext.custom_harvest.index_batch_size',
+                                    DEFAULT_BATCH_SIZE))
+    except (TypeError, ValueError):
+        batch_size = DEFAULT_BATCH_SIZE
+    return max(batch_size, 1)
+
+
+def reindex_packages(package_ids, batch_size=None):
+    '''
+    Reindexes the given datasets in batches without committing to Solr.
+    Datasets that fail to index are logged and skipped.
+
+    Returns the number of datasets indexed.
+    '''
+    batch_size = batch_size or get_batch_size()
+    package_ids = list(package_ids)
+    indexed = 0
+    for start in range(0, len(package_ids), batch_size):
+        batch = package_ids[start:start + batch_size]
+        try:
+            search.rebuild(package_ids=batch, defer_commit=True)
+            indexed += len(batch)
+        except Exception as e:
+            log.warning('Error indexing batch of %s datasets, '
+                        'retrying one by one: %r', len(batch), e)
+            for package_id in batch:
+                try:
+                    search.rebuild(package_ids=[package_id], defer_commit=True)
+                    indexed += 1
+                except Exception as e:
+                    log.error('Error indexing dataset %s: %r', package_id, e)
+    return indexed
+
+
+def commit():
+    search.commit()
+
+
+def mark_pending(harvest_object):
+    '''
+    Records in the database that the dataset of a harvest object is to be
+    indexed, saved along with the import of the object
+    '''
+    harvest_object.extras.append(
+        HarvestObjectExtra(key=PENDING_EXTRA_KEY, value='true'))
+
+
+def clear_pending(harvest_object_ids):
+    if harvest_object_ids:
+        model.Session.query(HarvestObjectExtra) \
+            .filter(HarvestObjectExtra.harvest_object_id.in_(list(harvest_object_ids))) \
+            .filter(HarvestObjectExtra.key == PENDING_EXTRA_KEY) \
+            .delete(synchronize_session=False)
+
+
+def index_pending(source_id, batch_size=None):
+    '''
+    Indexes the datasets of a harvest source still waiting in a deferred
+    index queue, whichever process imported them, without committing to
+    Solr. This includes the ones of a process that stopped before sending
+    them to the index.
+
+    Returns the number of datasets indexed.
+    '''
+    pending = model.Session.query(HarvestObject.id, HarvestObject.package_id) \
+        .join(HarvestObjectExtra, HarvestObjectExtra.harvest_object_id == HarvestObject.id) \
+        .filter(HarvestObject.harvest_source_id == source_id) \
+        .filter(HarvestObjectExtra.key == PENDING_EXTRA_KEY) \
+        .all()
+    if not pending:
+        return 0
+    package_ids = list(dict.fromkeys(
+        package_id for object_id, package_id in pending if package_id))
+    indexed = reindex_packages(package_ids, batch_size)
+    clear_pending(set(object_id for object_id, package_id in pending))
+    model.Session.commit()
+    return indexed
+
+
+class DeferredIndexQueue(object):
+    '''
+    Collects the ids of the datasets touched during a harvest job and sends
+    them to the search index in batches, committing once at the end
+    '''
+
+    def __init__(self, job_id=None, batch_size=None, source_id=None):
+        self.job_id = job_id
+        self.source_id = source_id
+        self.batch_size = batch_size or get_batch_size()
+        self._pending = []
+        self._queued = set()
+        # Harvest objects marked as pending in the database
+        self._object_ids = []
+        self.indexed_count = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def defer(self, package_id):
+        '''
+        Queues a dataset without sending a batch to the index
+        '''
+        if package_id and package_id not in self._queued:
+            self._queued.add(package_id)
+            self._pending.append(package_id)
+
+    def add(self, package_id, harvest_object_id=None):
+        if harvest_object_id:
+            self._object_ids.append(harvest_object_id)
+        self.defer(package_id)
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        object_ids, self._object_ids = self._object_ids, []
+        if self._pending:
+            pending, self._pending = self._pending, []
+            self._queued.clear()
+            reindex_packages(pending, self.batch_size)
+            self.indexed_count += len(pending)
+        # Saved with the import of the next object, or when committing
+        clear_pending(object_ids)
+
+    def commit(self):
+        self.flush()
+        if self.source_id:
+            # Datasets left in the queues of other processes
+            self.indexed_count += index_pending(self.source_id, self.batch_size)
+        if self.indexed_count:
+            commit()
+            log.info('Committed %s deferred dataset index updates for job %s',
+                     self.indexed_count, self.job_id)
+        self.indexed_count = 0
+
+
+def get_index_queue(job_id, source_id=None):
+    queue = _index_queues.get(job_id)
+    if queue is None:
+        # Jobs imported at the same time keep their own queue. The queues
+        # of the jobs finished by other processes are dropped, their
+        # datasets having been indexed along with the pending ones.
+        for finished_job_id in utils.get_finished_jobs(_index_queues):
+            del _index_queues[finished_job_id]
+        queue = _index_queues[job_id] = DeferredIndexQueue(job_id, source_id=source_id)
+    return queue
+
+
+def release_index_queue(job_id):
+    queue = _index_queues.pop(job_id, None)
+    if queue is not None:
+        queue.commit()
+
+
+@contextmanager
+def deferred_indexing(batch_size=None):
+    '''
+    Defers the indexing of every dataset imported within the block, whatever
+    the config of its harvest source. The datasets are sent to the index in
+    batches when the block exits, leaving the commit to the caller.
+    '''
+    global _scoped_index_queue
+    queue = DeferredIndexQueue(batch_size=batch_size)
+    previous_queue, _scoped_index_queue = _scoped_index_queue, queue
+    try:
+        with automatic_indexing_suspended(queue):
+            yield queue
+    finally:
+        _scoped_index_queue = previous_queue
+        queue.flush()
+
+
+def get_scoped_index_queue():
+    return _scoped_index_queue
@@ -0,0 +1,193 @@
+import logging
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+from ckantoolkit import asbool, config
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PAGE_INTERVAL = 10
+DEFAULT_OBJECT_INTERVAL = 100
+DEFAULT_TOP_COUNT = 10
+
+MB = 1024.0 * 1024.0
+
+# Memory profiles by harvest job id
+_job_profiles = {}
+
+# Allocations made by the profiling itself or by the import machinery are
+# left out of the reports
+_SNAPSHOT_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    tracemalloc.Filter(False, '<unknown>'),
+)
+
+
+def is_enabled():
+    return asbool(config.get('ckanext.custom_harvest.memory_profile', False))
+
+
+def _get_int_option(name, default):
+    try:
+        return max(int(config.get(name, default)), 1)
+    except (TypeError, ValueError):
+        return default
+
+
+def get_page_interval():
+    return _get_int_option('ckanext.custom_harvest.memory_profile_pages',
+                           DEFAULT_PAGE_INTERVAL)
+
+
+def get_object_interval():
+    return _get_int_option('ckanext.custom_harvest.memory_profile_objects',
+                           DEFAULT_OBJECT_INTERVAL)
+
+
+def get_top_count():
+    return _get_int_option('ckanext.custom_harvest.memory_profile_top',
+                           DEFAULT_TOP_COUNT)
+
+
+class MemoryProfile(object):
+    '''
+    Traces the memory allocated during a harvest job with tracemalloc,
+    logging the allocation sites that grew the most between snapshots and
+    the peak of traced memory of the job
+    '''
+    enabled = True
+
+    def __init__(self, job_id=None):
+        self.job_id = job_id
+        self.page_interval = get_page_interval()
+        self.object_interval = get_object_interval()
+        self.top_count = get_top_count()
+        self.pages = 0
+        self.objects = 0
+        self.import_growth = 0
+        self.peak = 0
+        self._last_snapshot = None
+
+        self._started_tracing = not tracemalloc.is_tracing()
+        if self._started_tracing:
+            tracemalloc.start()
+        else:
+            # The peak is measured for this job only
+            tracemalloc.reset_peak()
+
+    def _update_peak(self):
+        current, peak = tracemalloc.get_traced_memory()
+        self.peak = max(self.peak, peak)
+        return current
+
+    def snapshot(self, label):
+        '''
+        Logs the traced memory and the allocation sites that grew the most
+        since the previous snapshot of the job
+        '''
+        current = self._update_peak()
+        snapshot = tracemalloc.take_snapshot().filter_traces(_SNAPSHOT_FILTERS)
+        if self._last_snapshot is None:
+            stats = snapshot.statistics('lineno')
+        else:
+            stats = snapshot.compare_to(self._last_snapshot, 'lineno')
+        # Only the last snapshot is kept, as they can be big
+        self._last_snapshot = snapshot
+
+        log.info('Job %s memory %s: current=%.1fMB peak=%.1fMB',
+                 self.job_id, label, current / MB, self.peak / MB)
+        for stat in stats[:self.top_count]:
+            log.info('Job %s memory %s: %s', self.job_id, label, stat)
+
+    def page_fetched(self):
+        self.pages += 1
+        if self.pages % self.page_interval == 0:
+            self.snapshot('gather: after %s pages' % self.pages)
+
+    @contextmanager
+    def track_import(self):
+        '''
+        Measures the memory kept after importing an object, taking a
+        snapshot every N objects
+        '''
+        before = tracemalloc.get_traced_memory()[0]
+        try:
+            yield
+        finally:
+            self.import_growth += self._update_peak() - before
+            self.objects += 1
+            if self.objects % self.object_interval == 0:
+                self.snapshot('import: after %s objects' % self.objects)
+
+    def log_summary(self):
+        self._update_peak()
+        if self.objects:
+            log.info('Job %s memory: %s objects imported, %.1fMB kept in total',
+                     self.job_id, self.objects, self.import_growth / MB)
+        self.snapshot('end of job')
+        log.info('Job %s memory: peak=%.1fMB', self.job_id, self.peak / MB)
+
+    def stop(self):
+        self._last_snapshot = None
+        if self._started_tracing:
+            tracemalloc.stop()
+
+
+class NullMemoryProfile(object):
+    '''
+    Used when memory profiling is disabled, so that it costs next to nothing
+    '''
+    enabled = False
+    job_id = None
+
+    _null_context = nullcontext()
+
+    def snapshot(self, label):
+        pass
+
+    def page_fetched(self):
+        pass
+
+    def track_import(self):
+        return self._null_context
+
+    def log_summary(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+NULL_PROFILE = NullMemoryProfile()
+
+
+def get_job_profile(job_id):
+    '''
+    Returns the memory profile of a harvest job, or NULL_PROFILE if memory
+    profiling is disabled
+    '''
+    if not is_enabled():
+        return NULL_PROFILE
+    profile = _job_profiles.get(job_id)
+    if profile is None:
+        # Profiles left over from a previous job are reported before
+        # starting a new one
+        for previous_job_id in list(_job_profiles):
+            release_job_profile(previous_job_id)
+        profile = _job_profiles[job_id] = MemoryProfile(job_id)
+    return profile
+
+
+def release_job_profile(job_id):
+    '''
+    Logs the memory summary of a harvest job and stops tracing its
+    allocations
+    '''
+    profile = _job_profiles.pop(job_id, None)
+    if profile is not None:
+        profile.log_summary()
+        profile.stop()
+    return profile
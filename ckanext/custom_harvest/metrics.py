@@ -0,0 +1,211 @@
+import os
+import time
+import bisect
+import logging
+import tempfile
+import threading
+
+from ckantoolkit import config
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_WRITE_INTERVAL = 60
+
+# Upper bounds in seconds of the buckets of latency histograms
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0
+)
+
+_lock = threading.Lock()
+
+
+def _escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(label_names, label_values, extra=None):
+    pairs = list(zip(label_names, label_values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(
+        '%s="%s"' % (name, _escape_label_value(value)) for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter(object):
+    metric_type = 'counter'
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.label_names)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        for key, value in sorted(self._values.items()):
+            yield self.name, _format_labels(self.label_names, key), value
+
+
+class Histogram(object):
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.label_names)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with _lock:
+            state = self._values.get(key)
+            if state is None:
+                # Bucket counts (the last one being +Inf), sum and count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    def get_count(self, **labels):
+        state = self._values.get(self._key(labels))
+        return state[2] if state else 0
+
+    def samples(self):
+        for key, (bucket_counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for upper_bound, bucket_count in zip(
+                    self.buckets + (float('inf'),), bucket_counts):
+                cumulative += bucket_count
+                yield (self.name + '_bucket',
+                       _format_labels(self.label_names, key,
+                                      ('le', _format_value(upper_bound))),
+                       cumulative)
+            yield self.name + '_sum', _format_labels(self.label_names, key), total
+            yield self.name + '_count', _format_labels(self.label_names, key), count
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def clear(self):
+        with _lock:
+            for metric in self.metrics:
+                metric._values.clear()
+
+    def to_text(self):
+        '''
+        Returns the metrics in the Prometheus text exposition format
+        '''
+        lines = []
+        with _lock:
+            for metric in self.metrics:
+                lines.append('# HELP %s %s' % (metric.name, metric.documentation))
+                lines.append('# TYPE %s %s' % (metric.name, metric.metric_type))
+                for name, labels, value in metric.samples():
+                    lines.append('%s%s %s' % (name, labels, _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+PAGES_FETCHED = REGISTRY.register(Counter(
+    'ckan_harvest_pages_fetched_total',
+    'Result pages fetched from remote CKAN instances.',
+    ['source']))
+BYTES_DOWNLOADED = REGISTRY.register(Counter(
+    'ckan_harvest_bytes_downloaded_total',
+    'Bytes downloaded from remote CKAN instances.',
+    ['source']))
+OBJECTS_CREATED = REGISTRY.register(Counter(
+    'ckan_harvest_objects_created_total',
+    'Harvest objects created by the gather stage, by status.',
+    ['source', 'status']))
+IMPORT_DURATION = REGISTRY.register(Histogram(
+    'ckan_harvest_import_duration_seconds',
+    'Time taken to import a harvest object.',
+    ['source']))
+ERRORS = REGISTRY.register(Counter(
+    'ckan_harvest_errors_total',
+    'Errors saved while harvesting, by stage.',
+    ['source', 'stage']))
+
+
+def get_metrics_file():
+    metrics_file = config.get('ckanext.custom_harvest.metrics_file')
+    if metrics_file:
+        # Each process should write its own file
+        metrics_file = metrics_file.replace('{pid}', str(os.getpid()))
+    return metrics_file
+
+
+def get_write_interval():
+    try:
+        return float(config.get('ckanext.custom_harvest.metrics_write_interval',
+                                DEFAULT_WRITE_INTERVAL))
+    except (TypeError, ValueError):
+        return DEFAULT_WRITE_INTERVAL
+
+
+_last_write = 0.0
+
+
+def write_metrics(force=True):
+    '''
+    Writes the metrics to the configured file, replacing it atomically so
+    that collectors never read a partial file. Unless forced, the file is
+    written at most once per write interval.
+    '''
+    global _last_write
+    metrics_file = get_metrics_file()
+    if not metrics_file:
+        return False
+    now = time.monotonic()
+    if not force and now - _last_write < get_write_interval():
+        return False
+    _last_write = now
+
+    directory = os.path.dirname(os.path.abspath(metrics_file))
+    tmp_path = None
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.metrics-')
+        with os.fdopen(fd, 'w') as f:
+            f.write(REGISTRY.to_text())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, metrics_file)
+    except (IOError, OSError) as e:
+        log.warning('Could not write harvest metrics to %s: %s', metrics_file, e)
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+    return True
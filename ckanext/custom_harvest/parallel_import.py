@@ -0,0 +1,265 @@
+import os
+import logging
+import multiprocessing
+import zlib
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from itertools import islice
+
+from ckan import model
+from ckanext.harvest.model import HarvestJob, HarvestObject
+from ckanext.harvest.queue import fetch_and_import_stages, get_harvester
+
+from ckanext.custom_harvest import indexing
+
+
+log = logging.getLogger(__name__)
+
+# Number of partitions given to each worker, so that workers which finish
+# early can pick up more work
+PARTITIONS_PER_WORKER = 4
+
+# Number of batches sent to each reindexing worker ahead of time
+BATCHES_PER_WORKER = 2
+
+
+def get_default_workers():
+    return os.cpu_count() or 1
+
+
+def get_job_objects(job_id):
+    '''
+    Returns the (id, guid) of the objects of a finished harvest job that
+    were not imported. Jobs are finished when stopped, which makes the fetch
+    consumers skip the objects still in the fetch queue.
+    '''
+    return model.Session.query(HarvestObject.id, HarvestObject.guid) \
+        .join(HarvestJob, HarvestJob.id == HarvestObject.harvest_job_id) \
+        .filter(HarvestObject.harvest_job_id == job_id) \
+        .filter(HarvestJob.status == 'Finished') \
+        .filter(HarvestObject.state != 'COMPLETE') \
+        .all()
+
+
+def get_source_objects(source_id):
+    '''
+    Returns the (id, guid) of the current objects of a harvest source, to
+    import them again
+    '''
+    return model.Session.query(HarvestObject.id, HarvestObject.guid) \
+        .filter(HarvestObject.harvest_source_id == source_id) \
+        .filter(HarvestObject.current == True) \
+        .all()
+
+
+def partition_by_guid(objects, partitions):
+    '''
+    Splits (id, guid) pairs in disjoint sets of guids, so that all the
+    objects for a dataset are imported by the same worker, in order
+    '''
+    result = [[] for _ in range(max(partitions, 1))]
+    for object_id, guid in objects:
+        result[zlib.crc32((guid or '').encode('utf-8')) % len(result)].append(object_id)
+    return [object_ids for object_ids in result if object_ids]
+
+
+def _init_worker():
+    # Database connections can't be shared with the parent process, each
+    # worker opens its own
+    model.Session.remove()
+    model.meta.engine.dispose()
+
+
+def reimport_object(harvester, harvest_object):
+    '''
+    Imports a current harvest object again, updating its dataset. The
+    harvester is only forced to import for the duration of the call, as it
+    is shared by every import of the process.
+    '''
+    if harvest_object.package_id:
+        # Objects gathered as new already have a dataset, which is updated
+        # rather than created again
+        for extra in harvest_object.extras:
+            if extra.key == 'status' and extra.value == 'new':
+                extra.value = 'change'
+    if not hasattr(harvester, 'force_import'):
+        return harvester.import_stage(harvest_object)
+    force_import = harvester.force_import
+    harvester.force_import = True
+    try:
+        return harvester.import_stage(harvest_object)
+    finally:
+        harvester.force_import = force_import
+
+
+def import_partition(object_ids, reimport=False):
+    '''
+    Imports the given harvest objects one after the other, returning the
+    number of objects imported and the number of errors.
+
+    New objects go through the fetch and import stages as they would from
+    the queue, while current objects are imported again. Their datasets
+    are sent to the search index at the end, without committing.
+    '''
+    imported = errored = 0
+    with indexing.deferred_indexing():
+        for object_id in object_ids:
+            harvest_object = model.Session.query(HarvestObject).get(object_id)
+            if harvest_object is None:
+                continue
+            harvester = get_harvester(harvest_object.source.type)
+            try:
+                if reimport:
+                    success = reimport_object(harvester, harvest_object)
+                else:
+                    fetch_and_import_stages(harvester, harvest_object)
+                    success = harvest_object.state == 'COMPLETE'
+            except Exception as e:
+                log.exception('Error importing harvest object %s: %r',
+                              object_id, e)
+                model.Session.rollback()
+                success = False
+            if success:
+                imported += 1
+            else:
+                errored += 1
+    model.Session.remove()
+    return imported, errored
+
+
+def _import_partition(args):
+    return import_partition(*args)
+
+
+def import_objects(objects, workers=None, reimport=False):
+    '''
+    Imports harvest objects with a bounded pool of worker processes, each
+    with its own database session and working on a disjoint set of guids.
+    The search index is committed once at the end.
+
+    Returns the number of objects imported and the number of errors.
+    '''
+    workers = workers or get_default_workers()
+    partitions = partition_by_guid(objects, workers * PARTITIONS_PER_WORKER)
+    tasks = [(object_ids, reimport) for object_ids in partitions]
+    log.info('Importing %s harvest objects with %s workers',
+             len(objects), workers)
+
+    if workers == 1 or len(partitions) <= 1:
+        results = [_import_partition(task) for task in tasks]
+    else:
+        # Connections opened so far must not be inherited by the workers
+        model.Session.remove()
+        model.meta.engine.dispose()
+        pool_context = multiprocessing.get_context('fork')
+        with pool_context.Pool(processes=min(workers, len(partitions)),
+                               initializer=_init_worker) as pool:
+            results = list(pool.imap_unordered(_import_partition, tasks))
+
+    indexing.commit()
+
+    imported = sum(result[0] for result in results)
+    errored = sum(result[1] for result in results)
+    log.info('Imported %s harvest objects, %s errors', imported, errored)
+    return imported, errored
+
+
+def iter_source_package_ids(source_id, chunk_size=1000):
+    '''
+    Streams the ids of the datasets of the current objects of a harvest
+    source, fetching them from the database in chunks.
+
+    A session of its own is used, so that the datasets can be indexed with
+    the usual one while the ids are streamed.
+    '''
+    session = model.meta.create_local_session()
+    try:
+        query = session.query(HarvestObject.package_id) \
+            .filter(HarvestObject.harvest_source_id == source_id) \
+            .filter(HarvestObject.current == True) \
+            .filter(HarvestObject.package_id != None) \
+            .yield_per(chunk_size)
+        for package_id, in query:
+            yield package_id
+    finally:
+        session.close()
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def reindex_batch(package_ids):
+    '''
+    Sends a batch of datasets to the search index without committing,
+    returning the number of datasets indexed
+    '''
+    indexed = indexing.reindex_packages(package_ids, len(package_ids))
+    model.Session.remove()
+    return indexed
+
+
+def reindex_source(source_id, workers=None, batch_size=None):
+    '''
+    Reindexes the datasets of a harvest source in batches, with a bounded
+    pool of worker processes, and commits the search index once at the end.
+
+    Package ids are streamed from the database and only a few batches per
+    worker are queued at a time, so sources of any size can be reindexed.
+
+    Returns the number of datasets indexed and the number of errors.
+    '''
+    workers = workers or get_default_workers()
+    batch_size = batch_size or indexing.get_batch_size()
+    log.info('Reindexing the datasets of harvest source %s with %s workers',
+             source_id, workers)
+
+    results = []
+    if workers == 1:
+        for batch in batched(iter_source_package_ids(source_id), batch_size):
+            results.append((len(batch), reindex_batch(batch)))
+    else:
+        model.Session.remove()
+        model.meta.engine.dispose()
+        pending = {}
+
+        def collect(return_when):
+            done, _ = wait(pending, return_when=return_when)
+            for future in done:
+                size = pending.pop(future)
+                try:
+                    results.append((size, future.result()))
+                except Exception as e:
+                    log.error('Error reindexing a batch of %s datasets: %r', size, e)
+                    results.append((size, 0))
+
+        # Unlike multiprocessing.Pool, which silently loses the task of a
+        # killed worker and waits for it forever, the executor fails all the
+        # pending batches when a worker dies
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 mp_context=multiprocessing.get_context('fork')) as executor:
+            # The workers are forked before the package ids are queried, so
+            # that they don't inherit the connection used to stream them
+            executor.submit(os.getpid).result()
+            for batch in batched(iter_source_package_ids(source_id), batch_size):
+                if len(pending) >= workers * BATCHES_PER_WORKER:
+                    collect(FIRST_COMPLETED)
+                try:
+                    pending[executor.submit(reindex_batch, batch)] = len(batch)
+                except BrokenProcessPool as e:
+                    log.error('Error reindexing a batch of %s datasets: %r', len(batch), e)
+                    results.append((len(batch), 0))
+            collect(ALL_COMPLETED)
+
+    indexing.commit()
+
+    indexed = sum(result[1] for result in results)
+    errored = sum(result[0] for result in results) - indexed
+    log.info('Reindexed %s datasets of harvest source %s, %s errors',
+             indexed, source_id, errored)
+    return indexed, errored
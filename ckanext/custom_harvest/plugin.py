@@ -1,14 +1,35 @@
 import ckan.plugins as plugins
+from ckanext.custom_harvest import cli
+from ckanext.custom_harvest import configuration_processors
+from ckanext.custom_harvest import converter
+from ckanext.custom_harvest import harvest_config
+from ckanext.custom_harvest import indexing
 from ckanext.custom_harvest import utils
 
 
 class CustomHarvestPlugin(plugins.SingletonPlugin):
     plugins.implements(plugins.IPackageController, inherit=True)
+    plugins.implements(plugins.IClick)
+    plugins.implements(plugins.IConfigurable)
+
+    # IConfigurable
+    def configure(self, config):
+        converter.configure(config)
+        utils.clear_xloader_formats()
+        configuration_processors.clear_schema_fields()
+        indexing.setup_automatic_indexing()
+
+    # IClick
+    def get_commands(self):
+        return cli.get_commands()
 
     # IPackageController
     def before_index(self, dataset_dict):
         return self.before_dataset_index(dataset_dict)
 
+    def after_update(self, context, pkg_dict):
+        return self.after_dataset_update(context, pkg_dict)
+
     def before_dataset_index(self, pkg_dict):
         source_modified = utils.parse_date_iso_format(pkg_dict.get('extras_source_metadata_modified'))
         if source_modified:
@@ -23,3 +44,8 @@ class CustomHarvestPlugin(plugins.SingletonPlugin):
             pkg_dict['metadata_created'] = source_created
 
         return pkg_dict
+
+    def after_dataset_update(self, context, pkg_dict):
+        # Drop what has been cached for the jobs of an edited harvest source
+        if pkg_dict.get('type') == 'harvest':
+            harvest_config.clear_cache(pkg_dict.get('id'))
@@ -0,0 +1,130 @@
+import mimetypes
+from collections import namedtuple
+from functools import lru_cache
+
+
+# Formats of the mimetypes of data most often found on CKAN sites, so that
+# guessing them doesn't depend on the mimetypes known to the host
+MIMETYPE_FORMATS = {
+    'text/csv': 'csv',
+    'application/csv': 'csv',
+    'text/comma-separated-values': 'csv',
+    'text/tab-separated-values': 'tsv',
+    'application/json': 'json',
+    'application/geo+json': 'geojson',
+    'application/vnd.geo+json': 'geojson',
+    'application/ld+json': 'jsonld',
+    'application/xml': 'xml',
+    'text/xml': 'xml',
+    'application/rdf+xml': 'rdf',
+    'text/turtle': 'ttl',
+    'application/rss+xml': 'rss',
+    'application/atom+xml': 'atom',
+    'application/vnd.ms-excel': 'xls',
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet': 'xlsx',
+    'application/vnd.oasis.opendocument.spreadsheet': 'ods',
+    'application/msword': 'doc',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document': 'docx',
+    'application/vnd.ms-powerpoint': 'ppt',
+    'application/vnd.openxmlformats-officedocument.presentationml.presentation': 'pptx',
+    'application/pdf': 'pdf',
+    'text/html': 'html',
+    'application/xhtml+xml': 'html',
+    'text/plain': 'txt',
+    'application/zip': 'zip',
+    'application/x-zip-compressed': 'zip',
+    'application/gzip': 'gz',
+    'application/x-gzip': 'gz',
+    'application/x-tar': 'tar',
+    'application/vnd.google-earth.kml+xml': 'kml',
+    'application/vnd.google-earth.kmz': 'kmz',
+    'application/gml+xml': 'gml',
+    'application/x-esri-shape': 'shp',
+    'application/geopackage+sqlite3': 'gpkg',
+    'application/x-netcdf': 'nc',
+    'application/netcdf': 'nc',
+    'application/x-hdf5': 'hdf5',
+    'application/vnd.apache.parquet': 'parquet',
+    'application/sql': 'sql',
+    'image/png': 'png',
+    'image/jpeg': 'jpg',
+    'image/gif': 'gif',
+    'image/tiff': 'tif',
+    'image/svg+xml': 'svg',
+}
+
+
+def clean_format(resource_format):
+    '''
+    Normalizes a resource format to compare it with lists of formats,
+    removing any whitespace and lower-casing it
+    '''
+    return ''.join((resource_format or '').split()).lower()
+
+
+@lru_cache(maxsize=512)
+def guess_format(mimetype):
+    '''
+    Returns the format of a resource with the given mimetype, or an empty
+    string if it isn't known
+    '''
+    mimetype = (mimetype or '').split(';')[0].strip().lower()
+    if not mimetype:
+        return ''
+    resource_format = MIMETYPE_FORMATS.get(mimetype)
+    if resource_format is None:
+        # Mimetypes outside of the table are looked up in the ones known to
+        # the host
+        ext = mimetypes.guess_extension(mimetype)
+        resource_format = ext[1:] if ext else ''
+    return resource_format
+
+
+class FormatClass(namedtuple('FormatClass', 'format disallowed rank xloader')):
+    '''
+    What the import needs to know about a resource format: the cleaned
+    format, whether the converter drops it, its rank in the configured
+    format order and whether it is pushed to the datastore
+    '''
+
+
+class FormatClassifier(object):
+    '''
+    Classifies the formats of the resources of the datasets imported with
+    the same settings. Formats repeat a lot across resources, so each
+    distinct format is classified once and every stage of the import that
+    looks at resource formats does a single lookup per resource.
+    '''
+
+    def __init__(self, disallow_file_format=None, format_rank=None,
+                 xloader_formats=frozenset()):
+        self.disallow_file_format = disallow_file_format
+        self.format_rank = format_rank or {}
+        self.xloader_formats = xloader_formats
+        self._classes = {}
+
+    def classify(self, resource_format):
+        format_class = self._classes.get(resource_format)
+        if format_class is None:
+            cleaned_format = clean_format(resource_format)
+            format_class = self._classes[resource_format] = FormatClass(
+                cleaned_format,
+                bool(self.disallow_file_format and self.disallow_file_format(cleaned_format)),
+                # Unspecified formats are ranked last
+                self.format_rank.get((resource_format or '').strip().lower(),
+                                     len(self.format_rank)),
+                bool(cleaned_format) and cleaned_format in self.xloader_formats,
+            )
+        return format_class
+
+    def order(self, resources):
+        '''
+        Returns the resources ordered by the rank of their format, keeping
+        the order of resources of the same rank
+        '''
+        if not self.format_rank:
+            return resources
+        buckets = [[] for _ in range(len(self.format_rank) + 1)]
+        for resource in resources:
+            buckets[self.classify(resource.get('format')).rank].append(resource)
+        return [resource for bucket in buckets for resource in bucket]
@@ -0,0 +1,47 @@
+'''
+Micro-benchmarks for the harvester, run as modules, e.g.:
+
+    python -m ckanext.custom_harvest.tests.benchmarks.bench_pipeline
+
+They are not collected by pytest. The load test in load_harvest.py needs a
+CKAN database and is run with pytest instead, see its docstring.
+'''
+import os
+import copy
+import json
+import time
+import timeit
+
+
+def get_example(file_name):
+    path = os.path.join(os.path.dirname(__file__), '..', 'examples', file_name)
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def measure(func, number=1000, repeat=5):
+    '''Returns the best time per call of func, in microseconds'''
+    timings = timeit.repeat(func, number=number, repeat=repeat)
+    return min(timings) / number * 1e6
+
+
+def measure_on_copies(func, item, number=1000, repeat=5):
+    '''
+    Returns the best time per call of func on a deep copy of item, in
+    microseconds, for functions that modify their argument. Copies are made
+    before timing starts.
+    '''
+    best = None
+    for _ in range(repeat):
+        copies = [copy.deepcopy(item) for _ in range(number)]
+        start = time.perf_counter()
+        for item_copy in copies:
+            func(item_copy)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best / number * 1e6
+
+
+def report(name, microseconds):
+    print('{0:<50} {1:>12.2f} us'.format(name, microseconds))
@@ -0,0 +1,47 @@
+'''
+Time spent by the plugin on each dataset sent to the search index, e.g.
+during a search-index rebuild, and by the date parsing it relies on
+'''
+import datetime
+
+from dateutil.parser import parse as parse_date
+
+from ckanext.custom_harvest.plugin import CustomHarvestPlugin
+from ckanext.custom_harvest.utils import parse_date_iso_format
+from ckanext.custom_harvest.tests.benchmarks import measure, report
+
+
+SOURCE_DATE = '2023-09-19T21:52:05.662367'
+
+INDEXED_DATASETS = {
+    'harvested dataset': {
+        'extras_source_metadata_created': '2023-09-19T21:52:05.510577',
+        'extras_source_metadata_modified': SOURCE_DATE,
+    },
+    'harvested, non ISO dates': {
+        'extras_source_metadata_created': 'Tue Sep 19 21:52:05 2023',
+        'extras_source_metadata_modified': 'Tue Sep 19 21:52:05 2023',
+    },
+    'local dataset': {},
+}
+
+
+def parse_with_dateutil(date):
+    default_datetime = datetime.datetime(1, 1, 1, 0, 0, 0)
+    return parse_date(date, default=default_datetime).isoformat()[:19]
+
+
+def main():
+    report('parse_date_iso_format', measure(
+        lambda: parse_date_iso_format(SOURCE_DATE), number=10000))
+    report('dateutil parse', measure(
+        lambda: parse_with_dateutil(SOURCE_DATE), number=10000))
+
+    plugin = CustomHarvestPlugin()
+    for name, pkg_dict in INDEXED_DATASETS.items():
+        report('before_dataset_index: %s' % name, measure(
+            lambda: plugin.before_dataset_index(dict(pkg_dict)), number=10000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+'''
+Per-dataset time of converting result pages of remote datasets, one
+dataset at a time or as a batch
+'''
+from ckanext.custom_harvest.converter import (
+    package_search_to_ckan, package_search_to_ckan_batch)
+from ckanext.custom_harvest.tests.benchmarks import measure, report
+from ckanext.custom_harvest.tests.benchmarks.corpus import CorpusGenerator
+
+
+PAGE_SIZE = 100
+
+
+def main():
+    page = [source_dict for rng, size_class, source_dict
+            in CorpusGenerator(PAGE_SIZE, seed=0)]
+
+    one_by_one_time = measure(
+        lambda: [package_search_to_ckan(source_dict) for source_dict in page],
+        number=20)
+    batch_time = measure(lambda: list(package_search_to_ckan_batch(page)),
+                         number=20)
+
+    report('page of %s: one dataset at a time, per dataset' % PAGE_SIZE,
+           one_by_one_time / PAGE_SIZE)
+    report('page of %s: batch, per dataset' % PAGE_SIZE, batch_time / PAGE_SIZE)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+'''
+Per-dataset overhead of applying the config processors, comparing a loop
+over every processor with the pipeline of active processors
+'''
+from ckanext.custom_harvest.converter import package_search_to_ckan
+from ckanext.custom_harvest.harvest_config import HarvestConfig
+from ckanext.custom_harvest.harvesters.base import CustomHarvester
+from ckanext.custom_harvest.configuration_processors import build_pipeline
+from ckanext.custom_harvest.tests.benchmarks import (
+    get_example, measure_on_copies, report)
+
+
+CONFIGS = {
+    'empty config': {},
+    'typical config': {
+        'clean_tags': True,
+        'default_extras': {'encoding': 'utf8'},
+        'map_fields': [
+            {'source': 'notes', 'target': 'description', 'default': ''}
+        ],
+        'resource_format_order': ['CSV', 'JSON'],
+        'organizations_filter_include': ['org1'],
+        'keep_existing_resources': True,
+        'upload_to_datastore': False
+    }
+}
+
+EXTRAS_COUNT = 500
+
+# Config of datasets with hundreds of extras, most of them also in the source
+EXTRAS_CONFIGS = {
+    'extras config, %s extras' % EXTRAS_COUNT: {
+        'default_extras': dict(('default_%s' % i, 'value') for i in range(100)),
+        'override_extras': True,
+        'copy_extras': True
+    }
+}
+
+
+def run_all_processors(processors, package_dict, config, source_dict):
+    for processor in processors:
+        processor.modify_package_dict(package_dict, config, source_dict)
+    return package_dict
+
+
+def main():
+    source_dict = get_example('package_search.json')
+    package_dict = package_search_to_ckan(source_dict)
+    processors = CustomHarvester.config_processors
+    compare(processors, CONFIGS, package_dict, source_dict)
+
+    many_extras = [{'key': 'extra_%s' % i, 'value': str(i)}
+                   for i in range(EXTRAS_COUNT)]
+    source_dict = dict(source_dict, extras=source_dict.get('extras', []) + many_extras)
+    package_dict = dict(package_dict, extras=package_dict['extras'] + many_extras[::2])
+    compare(processors, EXTRAS_CONFIGS, package_dict, source_dict)
+
+
+def compare(processors, configs, package_dict, source_dict):
+    for config_name, config in configs.items():
+        config = HarvestConfig(config)
+        pipeline = build_pipeline(processors, config)
+
+        all_processors_time = measure_on_copies(
+            lambda package: run_all_processors(
+                processors, package, config, source_dict), package_dict)
+        pipeline_time = measure_on_copies(
+            lambda package: pipeline(package, source_dict), package_dict)
+
+        report('%s: all %s processors' % (config_name, len(processors)),
+               all_processors_time)
+        report('%s: pipeline of %s processors' % (config_name, len(pipeline.steps)),
+               pipeline_time)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+'''
+Times the conversion of remote datasets, each config processor and the
+matching of existing resources on a synthetic corpus, and compares the
+results with stored baselines to catch regressions:
+
+    python -m ckanext.custom_harvest.tests.benchmarks.bench_suite --size 10000
+    python -m ckanext.custom_harvest.tests.benchmarks.bench_suite --save-baselines
+
+Times are divided by the time of a fixed calibration workload before being
+compared, so that baselines stay meaningful on a slower or faster machine.
+The command exits with status 1 if any benchmark regressed by more than the
+tolerance.
+
+RemoteGroups is left out as it looks up groups in the database.
+'''
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+from array import array
+from collections import Counter
+
+from ckanext.custom_harvest.converter import package_search_to_ckan
+from ckanext.custom_harvest.harvest_config import HarvestConfig
+from ckanext.custom_harvest.harvesters.base import CustomHarvester
+from ckanext.custom_harvest.harvesters.package_search import copy_across_resource_ids
+from ckanext.custom_harvest.configuration_processors import RemoteGroups
+from ckanext.custom_harvest.tests.benchmarks import get_example, measure
+from ckanext.custom_harvest.tests.benchmarks.corpus import CorpusGenerator
+
+
+DEFAULT_BASELINES = os.path.join(os.path.dirname(__file__), 'baselines.json')
+DEFAULT_TOLERANCE = 0.25
+
+# Config activating every processor that doesn't need the database
+BENCH_CONFIG = {
+    'default_tags': [{'name': 'geo'}, {'name': 'climate'}],
+    'clean_tags': True,
+    'default_groups': ['climate'],
+    'default_group_dicts': [{'id': 'group-climate', 'name': 'climate'}],
+    'default_extras': {'encoding': 'utf8', 'extra_1': 'overridden'},
+    'override_extras': True,
+    'copy_extras': True,
+    'default_values': [{'language': 'en'}],
+    'map_fields': [
+        {'source': 'notes', 'target': 'description', 'default': ''},
+        {'source': 'extras.extra_2', 'target': 'mapped_extra', 'extras': True},
+        {'source': 'organization.title', 'target': 'publisher'},
+    ],
+    'composite_field_mapping': [
+        {'spatial_info': {'srs': 'extras.spatial-reference-system',
+                          'version': 'version'}}
+    ],
+    'contact_point': {
+        'source_name': 'maintainer', 'target_name': 'contact_name',
+        'source_email': 'maintainer_email', 'target_email': 'contact_email',
+    },
+    'resource_format_order': ['CSV', 'JSON', 'XLSX'],
+    'keep_existing_resources': True,
+    'upload_to_datastore': False,
+    'deferred_indexing': False,
+}
+
+
+def calibrate():
+    '''
+    Returns the time in microseconds of a fixed workload close to the one
+    being measured
+    '''
+    source_dict = get_example('package_search.json')
+    return measure(lambda: copy.deepcopy(source_dict), number=200, repeat=20)
+
+
+class Results(object):
+
+    def __init__(self):
+        self.durations = {}
+
+    def timed(self, name, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        durations = self.durations.get(name)
+        if durations is None:
+            durations = self.durations[name] = array('d')
+        durations.append(elapsed)
+        return result
+
+    def summary(self):
+        summary = {}
+        for name, durations in self.durations.items():
+            ordered = sorted(durations)
+            summary[name] = {
+                'mean_us': sum(ordered) / len(ordered) * 1e6,
+                'p95_us': ordered[int(0.95 * (len(ordered) - 1))] * 1e6,
+                'max_us': ordered[-1] * 1e6,
+                'total_s': sum(ordered),
+            }
+        return summary
+
+
+def run(size, seed):
+    config = HarvestConfig(BENCH_CONFIG)
+    processors = [processor for processor in CustomHarvester.config_processors
+                  if processor is not RemoteGroups]
+    corpus = CorpusGenerator(size, seed)
+    results = Results()
+    size_classes = Counter()
+
+    for rng, size_class, source_dict in corpus:
+        size_classes[size_class] += 1
+        package_dict = results.timed(
+            'package_search_to_ckan', package_search_to_ckan, source_dict)
+
+        for processor in processors:
+            # Each processor starts from the converted dataset, as they
+            # would otherwise work on the output of the previous ones
+            processed_dict = copy.deepcopy(package_dict)
+            results.timed('processor: %s' % processor.__name__,
+                          processor.modify_package_dict,
+                          processed_dict, config, source_dict)
+
+        existing_dataset = corpus.existing_dataset(package_dict, rng)
+        results.timed('copy_across_resource_ids', copy_across_resource_ids,
+                      existing_dataset, package_dict, config)
+
+    return results.summary(), size_classes
+
+
+def compare(summary, calibration, baselines, tolerance):
+    '''
+    Returns the names of the benchmarks slower than their baseline by more
+    than the tolerance, comparing times relative to the calibration
+    '''
+    regressions = []
+    for name, stats in sorted(summary.items()):
+        baseline = baselines['results'].get(name)
+        if not baseline:
+            continue
+        ratio = (stats['mean_us'] / calibration) / \
+            (baseline['mean_us'] / baselines['calibration_us'])
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+        print('{0:<40} {1:>7.2f}x baseline{2}'.format(
+            name, ratio, '  REGRESSION' if ratio > 1 + tolerance else ''))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--size', type=int, default=10000,
+                        help='Number of datasets in the corpus')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baselines', default=DEFAULT_BASELINES,
+                        help='Path of the baselines file')
+    parser.add_argument('--save-baselines', action='store_true',
+                        help='Store the results as the new baselines')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='Slowdown allowed before reporting a regression')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    summary, size_classes = run(args.size, args.seed)
+    elapsed = time.perf_counter() - start
+    # Calibrated once the machine is warmed up by the run
+    calibration = calibrate()
+
+    print('{0} datasets ({1}) in {2:.1f}s, calibration {3:.1f} us'.format(
+        args.size, ', '.join('%s %s' % (count, name)
+                             for name, count in size_classes.most_common()),
+        elapsed, calibration))
+    print('{0:<40} {1:>12} {2:>12} {3:>12}'.format(
+        'benchmark', 'mean us', 'p95 us', 'max us'))
+    for name, stats in sorted(summary.items()):
+        print('{0:<40} {1:>12.2f} {2:>12.2f} {3:>12.2f}'.format(
+            name, stats['mean_us'], stats['p95_us'], stats['max_us']))
+
+    if args.save_baselines:
+        with open(args.baselines, 'w') as f:
+            json.dump({'size': args.size, 'seed': args.seed,
+                       'calibration_us': calibration, 'results': summary},
+                      f, indent=2, sort_keys=True)
+        print('Saved baselines to %s' % args.baselines)
+        return 0
+
+    if not os.path.exists(args.baselines):
+        print('No baselines found at %s, run with --save-baselines to '
+              'store them' % args.baselines)
+        return 0
+
+    with open(args.baselines, 'r') as f:
+        baselines = json.load(f)
+    if (baselines.get('size'), baselines.get('seed')) != (args.size, args.seed):
+        print('Warning: baselines were measured on a corpus of %s datasets '
+              'with seed %s' % (baselines.get('size'), baselines.get('seed')))
+    regressions = compare(summary, calibration, baselines, args.tolerance)
+    if regressions:
+        print('%s benchmarks regressed by more than %d%%' % (
+            len(regressions), args.tolerance * 100))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,123 @@
+'''
+Synthetic corpora for the benchmarks, generated from the examples in
+tests/examples so that they keep the shape of real remote datasets.
+
+Corpora are generated lazily and deterministically from a seed, so that
+runs with the same size and seed measure the same datasets.
+'''
+import copy
+import random
+
+from ckanext.custom_harvest.tests.benchmarks import get_example
+
+
+# Share of the datasets in each size class, with the ranges of their number
+# of resources and extras. Most remote datasets are small but a few are big
+# enough to dominate the time spent on a source.
+SIZE_CLASSES = (
+    ('small', 0.70, (1, 5), (0, 5)),
+    ('medium', 0.25, (6, 50), (6, 40)),
+    ('large', 0.049, (51, 500), (41, 200)),
+    ('extreme', 0.001, (501, 5000), (201, 1000)),
+)
+
+FORMATS = ('CSV', 'csv', 'JSON', 'XLSX', 'PDF', 'HTML', 'Zip', 'GeoJSON',
+           'KML', 'XML', ' text / csv ', '')
+MIMETYPES = ('text/csv', 'application/json', 'application/pdf',
+             'application/vnd.ms-excel', 'text/html', None)
+
+# Share of the resources of an existing dataset that changed since the
+# last harvest, so that copy_across_resource_ids has to fall back on its
+# looser identities
+CHANGED_RESOURCES = 0.2
+
+
+def _pick_size_class(rng):
+    value = rng.random()
+    for name, share, resources_range, extras_range in SIZE_CLASSES:
+        if value < share:
+            return name, resources_range, extras_range
+        value -= share
+    return SIZE_CLASSES[0][0], SIZE_CLASSES[0][2], SIZE_CLASSES[0][3]
+
+
+class CorpusGenerator(object):
+    '''
+    Generates remote datasets as returned by package_search, based on
+    package_search.json, and the matching local datasets as returned by
+    package_show, based on ckan_dataset.json
+    '''
+
+    def __init__(self, size, seed=0):
+        self.size = size
+        self.seed = seed
+        self.source_seed = get_example('package_search.json')
+        self.existing_seed = get_example('ckan_dataset.json')
+
+    def _make_resource(self, rng, index, dataset_name):
+        resource = copy.copy(
+            self.source_seed['resources'][index % len(self.source_seed['resources'])])
+        resource['id'] = '%s-resource-%d' % (dataset_name, index)
+        resource['url'] = 'https://example.com/%s/file-%d' % (dataset_name, index)
+        resource['name'] = 'Resource %d of %s' % (index, dataset_name)
+        resource['position'] = index
+        resource['format'] = rng.choice(FORMATS)
+        resource['mimetype'] = rng.choice(MIMETYPES)
+        resource['size'] = rng.choice((None, '', str(rng.randint(1, 10 ** 9))))
+        return resource
+
+    def _make_extras(self, rng, count, dataset_name):
+        extras = [dict(extra) for extra in self.source_seed['extras']]
+        extras[0] = {'key': 'guid', 'value': dataset_name}
+        for index in range(count):
+            extras.append({'key': 'extra_%d' % index,
+                           'value': 'value %d' % rng.randint(0, 1000)})
+        return extras
+
+    def source_dict(self, index, rng):
+        size_class, resources_range, extras_range = _pick_size_class(rng)
+        name = 'dataset-%07d' % index
+        source_dict = dict(self.source_seed)
+        source_dict.update({
+            'id': 'source-%07d' % index,
+            'name': name,
+            'title': '%s (%s)' % (self.source_seed['title'], name),
+            'tags': list(self.source_seed['tags']),
+            'groups': list(self.source_seed['groups']),
+            'extras': self._make_extras(rng, rng.randint(*extras_range), name),
+            'resources': [self._make_resource(rng, resource_index, name)
+                          for resource_index in range(rng.randint(*resources_range))],
+        })
+        source_dict['num_resources'] = len(source_dict['resources'])
+        return size_class, source_dict
+
+    def existing_dataset(self, package_dict, rng):
+        '''
+        Returns a local copy of the given harvested dataset, as it would have
+        been saved by a previous harvest, with some of its resources changed
+        '''
+        existing_dataset = dict(self.existing_seed)
+        existing_dataset['resources'] = []
+        for index, resource in enumerate(package_dict.get('resources', [])):
+            resource = dict(resource)
+            resource['id'] = 'existing-resource-%d' % index
+            if rng.random() < CHANGED_RESOURCES:
+                resource['name'] = '%s (renamed)' % resource['name']
+            if rng.random() < 0.1:
+                resource['datastore_active'] = True
+            existing_dataset['resources'].append(resource)
+        rng.shuffle(existing_dataset['resources'])
+        return existing_dataset
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        '''
+        Yields (rng, size_class, source_dict) for each dataset, the rng
+        being the one to use for anything else generated for that dataset
+        '''
+        rng = random.Random(self.seed)
+        for index in range(self.size):
+            size_class, source_dict = self.source_dict(index, rng)
+            yield rng, size_class, source_dict
@@ -0,0 +1,109 @@
+'''
+End to end load test of the gather and import stages of the package_search
+harvester, against a mock CKAN serving synthetic datasets. As it needs a
+CKAN database, it is run with pytest, naming the file so that it is
+collected:
+
+    LOAD_TEST_DATASETS=10000 pytest --ckan-ini=test.ini -s \
+        ckanext/custom_harvest/tests/benchmarks/load_harvest.py
+
+It is configured with environment variables:
+
+    LOAD_TEST_DATASETS  number of datasets served by the mock CKAN (1000)
+    LOAD_TEST_IMPORT    number of them to import, 0 to only gather (all)
+    LOAD_TEST_SEED      seed of the synthetic datasets (0)
+    LOAD_TEST_CONFIG    harvest source config, as JSON ('')
+    LOAD_TEST_FAULTS    faults injected by the mock CKAN, as a JSON object
+                        of mock_ckan.Faults arguments, e.g.
+                        '{"latency": 0.05, "error_rate": 0.1, "churn": 5}'
+'''
+import os
+import sys
+import json
+import time
+import resource
+
+import pytest
+
+from ckantoolkit.tests.factories import Organization
+from ckanext.harvest.model import HarvestObject
+from ckanext.harvest.tests.factories import HarvestSourceObj, HarvestJobObj
+
+from ckanext.custom_harvest import metrics
+from ckanext.custom_harvest.harvesters.package_search import PackageSearchHarvester
+from ckanext.custom_harvest.tests.harvesters import mock_ckan
+
+
+def get_setting(name, default):
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+def get_peak_rss_mb():
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and in kilobytes elsewhere
+    if sys.platform == 'darwin':
+        peak_rss /= 1024.0
+    return peak_rss / 1024.0
+
+
+def report(name, value, unit):
+    print('{0:<40} {1:>12.2f} {2}'.format(name, value, unit))
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'clean_index')
+def test_load_harvest():
+    datasets = get_setting('LOAD_TEST_DATASETS', 1000)
+    import_limit = get_setting('LOAD_TEST_IMPORT', datasets)
+    seed = get_setting('LOAD_TEST_SEED', 0)
+    faults = None
+    if os.environ.get('LOAD_TEST_FAULTS'):
+        faults = mock_ckan.Faults(seed=seed, **json.loads(os.environ['LOAD_TEST_FAULTS']))
+
+    server = mock_ckan.serve_catalog_process(datasets, seed, faults=faults)
+    try:
+        org = Organization()
+        source = HarvestSourceObj(
+            url='http://localhost:%s/api/action/package_search' % mock_ckan.LOAD_TEST_PORT,
+            config=os.environ.get('LOAD_TEST_CONFIG', ''),
+            owner_org=org['id'])
+        job = HarvestJobObj(source=source)
+        harvester = PackageSearchHarvester()
+
+        pages_before = metrics.PAGES_FETCHED.get(source=source.id)
+        start = time.perf_counter()
+        object_ids = harvester.gather_stage(job)
+        gather_seconds = time.perf_counter() - start
+        pages = metrics.PAGES_FETCHED.get(source=source.id) - pages_before
+        gather_rss = get_peak_rss_mb()
+
+        if faults is None:
+            assert job.gather_errors == []
+            assert len(object_ids) == datasets
+        object_ids = object_ids or []
+
+        imported = errored = 0
+        start = time.perf_counter()
+        for object_id in object_ids[:import_limit]:
+            harvest_object = HarvestObject.get(object_id)
+            harvester.fetch_stage(harvest_object)
+            if harvester.import_stage(harvest_object):
+                imported += 1
+            else:
+                errored += 1
+        import_seconds = time.perf_counter() - start
+    finally:
+        server.terminate()
+        server.join()
+
+    print('\nHarvested %s of %s synthetic datasets, %s gather errors' % (
+        len(object_ids), datasets, len(job.gather_errors)))
+    report('gather', gather_seconds, 's')
+    report('gather datasets/sec', len(object_ids) / gather_seconds, '')
+    report('gather pages/sec', pages / gather_seconds, '(%s pages)' % pages)
+    report('peak RSS after gather', gather_rss, 'MB')
+    if imported or errored:
+        report('import', import_seconds, 's')
+        report('import datasets/sec', (imported + errored) / import_seconds,
+               '(%s errors)' % errored)
+        report('peak RSS after import', get_peak_rss_mb(), 'MB')
@@ -3,15 +3,28 @@ from __future__ import print_function
 import json
 import re
 import copy
-from urllib.parse import unquote_plus
+import time
+import random
+import multiprocessing
+from datetime import datetime, timedelta
+from urllib.parse import parse_qsl, unquote_plus
 
-from threading import Thread
+from threading import Lock, Thread
 
 from http.server import SimpleHTTPRequestHandler
-from socketserver import TCPServer
+from socketserver import ThreadingMixIn, TCPServer
+
+from ckanext.custom_harvest.tests.benchmarks.corpus import CorpusGenerator
 
 
 PORT = 8998
+LOAD_TEST_PORT = 8999
+
+# Largest page returned by package_search, as in CKAN
+MAX_ROWS = 1000
+
+# Modification date of the datasets created by churn, after the others
+CHURN_MODIFIED = datetime(2030, 1, 1)
 
 
 class MockCkanHandler(SimpleHTTPRequestHandler):
@@ -122,6 +135,11 @@ class MockCkanHandler(SimpleHTTPRequestHandler):
         self.wfile.close()
 
 
+class MockCkanServer(ThreadingMixIn, TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
 def serve(port=PORT):
     '''Runs a CKAN-alike app (over HTTP) that is used for harvesting tests'''
 
@@ -129,16 +147,356 @@ def serve(port=PORT):
     # os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)),
     #                      'mock_ckan_files'))
 
-    class TestServer(TCPServer):
-        allow_reuse_address = True
+    httpd = MockCkanServer(('', port), MockCkanHandler)
+
+    print('Serving test HTTP server at port {}'.format(port))
+
+    httpd_thread = Thread(target=httpd.serve_forever)
+    httpd_thread.daemon = True
+    httpd_thread.start()
+    return httpd
+
+
+FQ_TERM = re.compile(r'(OR|AND)\s|(-?)([\w.]+):(\[[^\]]*\]|"[^"]*"|\S+)')
+RANGE = re.compile(r'^\[(\S+) TO (\S+)\]$')
+
+
+def parse_fq(fq):
+    '''
+    Parses a Solr filter query in the forms sent by the harvester into a
+    list of groups of (negated, field, value) terms. A dataset matches if
+    it matches a term of every group.
+    '''
+    groups = []
+    join_next = False
+    for match in FQ_TERM.finditer(fq or ''):
+        operator, negated, field, value = match.groups()
+        if operator:
+            join_next = operator == 'OR'
+            continue
+        term = (bool(negated), field, value.strip('"'))
+        if join_next and groups:
+            groups[-1].append(term)
+        else:
+            groups.append([term])
+        join_next = False
+    return groups
+
+
+def _field_values(dataset, field):
+    if field == 'organization':
+        return [(dataset.get('organization') or {}).get('name')]
+    if field in ('groups', 'tags'):
+        return [item.get('name') for item in dataset.get(field) or []]
+    return [dataset.get(field)]
+
+
+def _term_matches(dataset, negated, field, value):
+    range_match = RANGE.match(value)
+    if range_match:
+        lower, upper = [bound.rstrip('Z') for bound in range_match.groups()]
+        matched = any(
+            field_value and (lower == '*' or field_value >= lower) and
+            (upper == '*' or field_value <= upper)
+            for field_value in _field_values(dataset, field))
+    elif value == '*':
+        matched = any(_field_values(dataset, field))
+    else:
+        matched = value in [str(field_value) for field_value
+                            in _field_values(dataset, field)]
+    return matched != negated
+
+
+def _sort_key(field):
+    def key(dataset):
+        value = dataset.get(field)
+        # Missing values sort first, as datasets can't be compared to None
+        return (value is not None, value if value is not None else '')
+    return key
+
+
+class SyntheticCatalog(object):
+    '''
+    A remote CKAN catalog of synthetic datasets, generated from the
+    benchmark corpus, searched with the semantics of package_search for the
+    parameters used by the harvester: q, fq, sort, rows and start
+    '''
+
+    def __init__(self, size, seed=0, organizations=10):
+        self.datasets = []
+        first_modified = datetime(2020, 1, 1)
+        for rng, size_class, dataset in CorpusGenerator(size, seed):
+            org_number = rng.randrange(organizations)
+            dataset['organization'] = {
+                'id': 'org%s-id' % org_number,
+                'name': 'org%s' % org_number,
+                'title': 'Test Org%s' % org_number,
+            }
+            dataset['owner_org'] = dataset['organization']['id']
+            dataset['metadata_modified'] = (
+                first_modified + timedelta(minutes=rng.randrange(size * 10))
+            ).isoformat()
+            self.datasets.append(dataset)
+        self.datasets_by_ref = {}
+        for dataset in self.datasets:
+            self.datasets_by_ref[dataset['id']] = dataset
+            self.datasets_by_ref[dataset['name']] = dataset
+
+        # Datasets are serialized once, so that serving a page costs little
+        # compared to harvesting it
+        self.serialized = dict(
+            (dataset['id'], json.dumps(dataset)) for dataset in self.datasets)
+
+        # Search results by query, as the harvester requests every page of
+        # the same query
+        self._results = {}
+        self._lock = Lock()
+
+        # Datasets deleted and created by churn. Deleted datasets are kept
+        # serialized for the pages computed before they were deleted.
+        self.deleted_ids = []
+        self.created_ids = []
+        self._churned = 0
+
+    def churn(self, rng, count):
+        '''
+        Deletes count random datasets and creates as many new ones, as if
+        the remote catalog was edited while being harvested, shifting the
+        pages of any search in progress
+        '''
+        with self._lock:
+            if not self.datasets:
+                return
+            template = rng.choice(self.datasets)
+            for _ in range(min(count, len(self.datasets))):
+                deleted = self.datasets.pop(rng.randrange(len(self.datasets)))
+                del self.datasets_by_ref[deleted['id']]
+                del self.datasets_by_ref[deleted['name']]
+                self.deleted_ids.append(deleted['id'])
+            for _ in range(count):
+                self._churned += 1
+                dataset = dict(rng.choice(self.datasets) if self.datasets else template)
+                dataset['id'] = '%08x-churned-%d' % (rng.getrandbits(32), self._churned)
+                dataset['name'] = 'churned-dataset-%07d' % self._churned
+                dataset['metadata_modified'] = (
+                    CHURN_MODIFIED + timedelta(seconds=self._churned)).isoformat()
+                self.datasets.append(dataset)
+                self.datasets_by_ref[dataset['id']] = dataset
+                self.datasets_by_ref[dataset['name']] = dataset
+                self.serialized[dataset['id']] = json.dumps(dataset)
+                self.created_ids.append(dataset['id'])
+            self._results.clear()
+
+    def _search(self, q, fq, tags, sort):
+        datasets = self.datasets
+        if q and q != '*:*':
+            words = q.lower().split()
+            datasets = [
+                dataset for dataset in datasets
+                if all(word in (dataset.get('title') or '').lower() or
+                       word in (dataset.get('notes') or '').lower()
+                       for word in words)]
+        for group in parse_fq(fq):
+            datasets = [dataset for dataset in datasets
+                        if any(_term_matches(dataset, *term) for term in group)]
+        if tags:
+            datasets = [dataset for dataset in datasets
+                        if _term_matches(dataset, False, 'tags', tags)]
+        # Sorting on each field from the last one, as sorts are stable
+        for sort_term in reversed((sort or 'score desc').split(',')):
+            field, _, direction = sort_term.strip().partition(' ')
+            if field == 'score':
+                continue
+            datasets = sorted(datasets, key=_sort_key(field),
+                              reverse=direction.strip() == 'desc')
+        return [dataset['id'] for dataset in datasets]
 
-    httpd = TestServer(('', PORT), MockCkanHandler)
+    def search(self, params):
+        '''
+        Returns the total number of datasets matching the search params and
+        the ids of the ones in the requested page
+        '''
+        key = tuple(params.get(name) for name in ('q', 'fq', 'tags', 'sort'))
+        with self._lock:
+            dataset_ids = self._results.get(key)
+            if dataset_ids is None:
+                dataset_ids = self._results[key] = self._search(*key)
+        start = max(int(params.get('start') or 0), 0)
+        rows = min(max(int(params.get('rows') or 10), 0), MAX_ROWS)
+        return len(dataset_ids), dataset_ids[start:start + rows]
 
-    print('Serving test HTTP server at port {}'.format(PORT))
 
+class Faults(object):
+    '''
+    Faults injected in the responses of the LoadTestHandler, reproducing
+    the conditions of a slow or overloaded remote CKAN:
+
+    * latency: seconds waited before responding to each request, plus a
+      random extra of up to jitter seconds
+    * chunk_size and chunk_delay: the body is sent in chunks of chunk_size
+      bytes, waiting chunk_delay seconds between them
+    * error_rate: share of the requests answered with one of error_statuses,
+      with a Retry-After header of retry_after seconds
+    * truncate_rate: share of the responses whose JSON body is cut short
+    * churn: number of datasets deleted and created before serving each page
+      of a search after the first one
+
+    Faults are drawn from random generators seeded with seed, so that the
+    same sequence of requests gets the same faults on every run.
+    '''
+
+    def __init__(self, latency=0.0, jitter=0.0, chunk_size=0, chunk_delay=0.0,
+                 error_rate=0.0, error_statuses=(429, 503), retry_after=1,
+                 truncate_rate=0.0, churn=0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.error_rate = error_rate
+        self.error_statuses = tuple(error_statuses)
+        self.retry_after = retry_after
+        self.truncate_rate = truncate_rate
+        self.churn = churn
+        self._random = random.Random(seed)
+        self._churn_random = random.Random(seed + 1)
+        self._lock = Lock()
+
+    def next_request(self):
+        '''
+        Returns the faults of the next request, as the seconds to wait, the
+        error status to respond with, or None, and the share of the body to
+        send, or None to send all of it
+        '''
+        with self._lock:
+            # The same number of values is drawn for every request, so that
+            # changing a rate doesn't change the other faults
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            error = self._random.random() < self.error_rate
+            error_status = self._random.choice(self.error_statuses)
+            truncate = self._random.random() < self.truncate_rate
+            truncate_at = self._random.uniform(0.1, 0.9)
+        return (delay, error_status if error else None,
+                truncate_at if truncate else None)
+
+    def apply_churn(self, catalog):
+        if self.churn:
+            with self._lock:
+                catalog.churn(self._churn_random, self.churn)
+
+
+class LoadTestHandler(MockCkanHandler):
+    '''
+    Serves the datasets of the SyntheticCatalog set on the server, injecting
+    the Faults set on the server if any
+    '''
+    truncate_at = None
+
+    def do_GET(self):
+        catalog = self.server.catalog
+        faults = self.server.faults
+        path, _, query_string = self.path.partition('?')
+        path = re.sub(r'^/api/(\d/)?', '/api/', path)
+        params = dict(parse_qsl(query_string))
+
+        if faults:
+            delay, error_status, truncate_at = faults.next_request()
+            if delay:
+                time.sleep(delay)
+            if error_status:
+                return self.respond(
+                    '{"success": false, "error": {"message": "Try again later"}}',
+                    status=error_status,
+                    headers={'Retry-After': str(faults.retry_after)})
+            self.truncate_at = truncate_at
+
+        if path == '/api/action/package_search':
+            if faults and params.get('start', '0') != '0':
+                faults.apply_churn(catalog)
+            try:
+                count, dataset_ids = catalog.search(params)
+            except ValueError as e:
+                return self.respond('Bad search params: %s' % e, status=400)
+            return self.respond(
+                '{"success": true, "result": {"count": %d, "results": [%s]}}' % (
+                    count, ', '.join(catalog.serialized[dataset_id]
+                                     for dataset_id in dataset_ids)))
+        if path == '/api/action/package_show':
+            dataset = catalog.datasets_by_ref.get(params.get('id'))
+            if dataset:
+                return self.respond('{"success": true, "result": %s}' %
+                                    catalog.serialized[dataset['id']])
+            return self.respond('{"success": false}', status=404)
+        if path == '/api/action/package_list':
+            return self.respond_action(
+                [dataset['name'] for dataset in catalog.datasets])
+
+        self.respond('Mock CKAN doesnt recognize that call', status=400)
+
+    def respond(self, content, status=200, content_type='application/json',
+                headers=None):
+        content = content.encode('utf-8')
+        if self.truncate_at is not None:
+            content = content[:int(len(content) * self.truncate_at)]
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+
+        faults = self.server.faults
+        if faults and faults.chunk_size:
+            for start in range(0, len(content), faults.chunk_size):
+                self.wfile.write(content[start:start + faults.chunk_size])
+                self.wfile.flush()
+                time.sleep(faults.chunk_delay)
+        else:
+            self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        # Logging every request would slow down the server
+        pass
+
+
+def serve_catalog(catalog, port=LOAD_TEST_PORT, faults=None):
+    '''
+    Serves a SyntheticCatalog in a background thread, returning the server
+    so that it can be shut down
+    '''
+    httpd = MockCkanServer(('', port), LoadTestHandler)
+    httpd.catalog = catalog
+    httpd.faults = faults
     httpd_thread = Thread(target=httpd.serve_forever)
-    httpd_thread.setDaemon(True)
+    httpd_thread.daemon = True
     httpd_thread.start()
+    return httpd
+
+
+def _serve_catalog_forever(size, seed, port, faults, ready):
+    httpd = MockCkanServer(('', port), LoadTestHandler)
+    httpd.catalog = SyntheticCatalog(size, seed)
+    httpd.faults = faults
+    ready.set()
+    httpd.serve_forever()
+
+
+def serve_catalog_process(size, seed=0, port=LOAD_TEST_PORT, faults=None):
+    '''
+    Generates and serves a SyntheticCatalog of the given size in a separate
+    process, so that it doesn't compete with the harvester being measured
+    for the CPU and doesn't count in its memory usage. The process must be
+    terminated by the caller.
+    '''
+    context = multiprocessing.get_context('fork')
+    ready = context.Event()
+    process = context.Process(target=_serve_catalog_forever,
+                              args=(size, seed, port, faults, ready))
+    process.daemon = True
+    process.start()
+    while not ready.wait(1):
+        if not process.is_alive():
+            raise RuntimeError('Mock CKAN server failed to start on port %s' % port)
+    return process
 
 
 def convert_dataset_to_restful_form(dataset):
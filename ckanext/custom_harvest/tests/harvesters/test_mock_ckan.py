@@ -0,0 +1,127 @@
+import random
+
+import requests
+
+from ckanext.custom_harvest.tests.harvesters.mock_ckan import (
+    LOAD_TEST_PORT, Faults, SyntheticCatalog, parse_fq, serve_catalog)
+
+
+class TestParseFq(object):
+
+    def test_terms_are_grouped_by_or(self):
+        assert parse_fq('organization:org1 OR organization:org2 -groups:group1') == [
+            [(False, 'organization', 'org1'), (False, 'organization', 'org2')],
+            [(True, 'groups', 'group1')],
+        ]
+
+    def test_range(self):
+        assert parse_fq('metadata_modified:[2020-01-01T00:00:00Z TO *]') == [
+            [(False, 'metadata_modified', '[2020-01-01T00:00:00Z TO *]')]
+        ]
+
+
+class TestSyntheticCatalog(object):
+
+    catalog = SyntheticCatalog(50, organizations=3)
+
+    def test_pages_cover_every_dataset_once(self):
+        dataset_ids = []
+        start = 0
+        while True:
+            count, page = self.catalog.search(
+                {'rows': '20', 'start': str(start), 'sort': 'id asc'})
+            if not page:
+                break
+            dataset_ids.extend(page)
+            start += 20
+        assert count == 50
+        assert dataset_ids == sorted(dataset['id'] for dataset in self.catalog.datasets)
+
+    def test_sort_desc(self):
+        count, page = self.catalog.search(
+            {'rows': '50', 'start': '0', 'sort': 'metadata_modified desc'})
+        modified = [self.catalog.datasets_by_ref[dataset_id]['metadata_modified']
+                    for dataset_id in page]
+        assert modified == sorted(modified, reverse=True)
+
+    def test_fq_organizations(self):
+        count, page = self.catalog.search(
+            {'rows': '50', 'start': '0', 'fq': 'organization:org0 OR organization:org1'})
+        expected = [dataset for dataset in self.catalog.datasets
+                    if dataset['organization']['name'] in ('org0', 'org1')]
+        assert count == len(expected)
+
+        count, page = self.catalog.search(
+            {'rows': '50', 'start': '0', 'fq': '-organization:org0 -organization:org1'})
+        assert count == 50 - len(expected)
+
+    def test_fq_metadata_modified(self):
+        middle = sorted(dataset['metadata_modified'] for dataset in self.catalog.datasets)[25]
+        count, page = self.catalog.search(
+            {'rows': '50', 'start': '0', 'fq': 'metadata_modified:[%sZ TO *]' % middle})
+        assert count == 25
+
+    def test_rows_larger_than_catalog(self):
+        count, page = self.catalog.search({'rows': '5000', 'start': '0'})
+        assert len(page) == 50
+
+    def test_churn_shifts_pages(self):
+        catalog = SyntheticCatalog(50)
+        count, first_page = catalog.search({'rows': '20', 'start': '0', 'sort': 'id asc'})
+
+        catalog.churn(random.Random(0), 5)
+
+        count, second_page = catalog.search({'rows': '20', 'start': '20', 'sort': 'id asc'})
+        assert count == 50
+        assert len(catalog.deleted_ids) == len(catalog.created_ids) == 5
+        # Created datasets sort first, so the second page starts with
+        # datasets already returned by the first one
+        assert set(first_page) & set(second_page)
+
+
+class TestFaults(object):
+
+    def test_faults_are_reproducible(self):
+        first = Faults(jitter=0.5, error_rate=0.3, truncate_rate=0.3, seed=1)
+        second = Faults(jitter=0.5, error_rate=0.3, truncate_rate=0.3, seed=1)
+        assert [first.next_request() for _ in range(20)] == \
+            [second.next_request() for _ in range(20)]
+
+    def test_no_faults_by_default(self):
+        faults = Faults()
+        assert set(faults.next_request() for _ in range(20)) == set([(0, None, None)])
+
+    def test_errors_and_truncation(self):
+        faults = Faults(latency=0.1, error_rate=1, truncate_rate=1)
+        delay, error_status, truncate_at = faults.next_request()
+        assert delay == 0.1
+        assert error_status in (429, 503)
+        assert 0.1 <= truncate_at <= 0.9
+
+
+class TestLoadTestHandler(object):
+
+    def test_injected_faults(self):
+        faults = Faults(error_rate=0.5, truncate_rate=0.5, chunk_size=4096, seed=3)
+        httpd = serve_catalog(SyntheticCatalog(20), port=LOAD_TEST_PORT + 1, faults=faults)
+        try:
+            url = 'http://localhost:%s/api/3/action/package_search' % (LOAD_TEST_PORT + 1)
+            statuses = set()
+            truncated = 0
+            for _ in range(20):
+                response = requests.get(url, params={'rows': '10', 'start': '0'})
+                statuses.add(response.status_code)
+                if response.status_code != 200:
+                    assert response.headers['Retry-After'] == '1'
+                    continue
+                try:
+                    assert response.json()['result']['count'] == 20
+                except ValueError:
+                    truncated += 1
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+
+        assert 200 in statuses
+        assert statuses - set([200])
+        assert truncated
@@ -3,6 +3,8 @@ from __future__ import absolute_import
 import json
 import pytest
 
+from ckan import model
+from ckantoolkit import toolkit
 from ckantoolkit.tests.factories import Organization
 
 from ckanext.harvest.tests.factories import (HarvestSourceObj, HarvestJobObj,
@@ -10,7 +12,10 @@ from ckanext.harvest.tests.factories import (HarvestSourceObj, HarvestJobObj,
 from ckanext.harvest.tests.lib import run_harvest_job
 import ckanext.harvest.model as harvest_model
 
+from ckanext.custom_harvest import indexing
+from ckanext.custom_harvest import parallel_import
 from ckanext.custom_harvest.harvesters.package_search import copy_across_resource_ids, PackageSearchHarvester
+from ckanext.custom_harvest.import_context import get_import_context
 from ckanext.custom_harvest.tests.harvesters  import mock_ckan
 
 
@@ -67,6 +72,51 @@ class TestPackageSearchHarvester(object):
         assert result is True
         assert harvest_object.guid
 
+    def test_import_context_is_reused_within_job(self):
+        org = Organization()
+        harvest_object = HarvestObjectObj(
+            guid=mock_ckan.DATASETS[0]['name'],
+            content=json.dumps(mock_ckan.DATASETS[0]),
+            job__source__owner_org=org['id'])
+
+        harvester = PackageSearchHarvester()
+        harvester.import_stage(harvest_object)
+
+        import_context = get_import_context(harvester, harvest_object.job)
+        assert import_context.owner_org == org['id']
+        assert get_import_context(harvester, harvest_object.job) is import_context
+
+    def test_import_context_is_rebuilt_when_source_is_edited(self):
+        harvest_object = HarvestObjectObj(
+            guid=mock_ckan.DATASETS[0]['name'],
+            content=json.dumps(mock_ckan.DATASETS[0]))
+
+        harvester = PackageSearchHarvester()
+        import_context = get_import_context(harvester, harvest_object.job)
+        harvest_object.job.source.config = json.dumps({'clean_tags': True})
+
+        edited_import_context = get_import_context(harvester, harvest_object.job)
+        assert edited_import_context is not import_context
+        assert edited_import_context.config['clean_tags'] is True
+
+    def test_import_context_is_rebuilt_when_source_changes_organization(self):
+        org = Organization()
+        harvest_object = HarvestObjectObj(
+            guid=mock_ckan.DATASETS[0]['name'],
+            content=json.dumps(mock_ckan.DATASETS[0]),
+            job__source__owner_org=org['id'])
+
+        harvester = PackageSearchHarvester()
+        import_context = get_import_context(harvester, harvest_object.job)
+        other_org = Organization()
+        source_dataset = model.Package.get(harvest_object.job.source.id)
+        source_dataset.owner_org = other_org['id']
+        model.Session.commit()
+
+        edited_import_context = get_import_context(harvester, harvest_object.job)
+        assert edited_import_context is not import_context
+        assert edited_import_context.owner_org == other_org['id']
+
     def test_harvest(self):
         source = HarvestSourceObj(
             url='http://localhost:%s/api/action/package_search?tags=test-tag' % mock_ckan.PORT,
@@ -84,6 +134,68 @@ class TestPackageSearchHarvester(object):
         assert result['state'] == 'COMPLETE'
         assert result['errors'] == []
 
+    def test_deferred_indexing_with_several_consumers(self):
+        org = Organization()
+        source = HarvestSourceObj(
+            url='http://localhost:%s/api/action/package_search' % mock_ckan.PORT,
+            config=json.dumps({'deferred_indexing': True}),
+            owner_org=org['id'])
+        job = HarvestJobObj(source=source)
+        harvest_objects = [
+            HarvestObjectObj(guid=dataset['name'], content=json.dumps(dataset), job=job,
+                             status='new')
+            for dataset in mock_ckan.DATASETS[:2]]
+
+        harvester = PackageSearchHarvester()
+        assert harvester.import_stage(harvest_objects[0]) is True
+        # The consumer that imported the first object is not the one
+        # importing the last one
+        indexing._index_queues.clear()
+        assert harvester.import_stage(harvest_objects[1]) is True
+
+        result = toolkit.get_action('package_search')({}, {'fq': 'owner_org:%s' % org['id']})
+        assert result['count'] == 2
+        assert harvest_model.Session.query(harvest_model.HarvestObjectExtra) \
+            .filter_by(key=indexing.PENDING_EXTRA_KEY).count() == 0
+
+    def test_reimport_new_object_updates_its_dataset(self, monkeypatch):
+        source = HarvestSourceObj(
+            url='http://localhost:%s/api/action/package_search?tags=test-tag' % mock_ckan.PORT,
+            config='',
+            source_type='test'
+        )
+        job = HarvestJobObj(source=source, run=False)
+        harvester = PackageSearchHarvester()
+        results_by_guid = run_harvest_job(job, harvester)
+        harvest_object = harvest_model.HarvestObject.get(
+            results_by_guid[mock_ckan.DATASETS[0]['name']]['obj_id'])
+        package_id = harvest_object.package_id
+        dataset_count = harvest_model.Session.query(model.Package).count()
+        monkeypatch.setattr(parallel_import, 'get_harvester', lambda source_type: harvester)
+
+        imported, errored = parallel_import.import_partition([harvest_object.id], reimport=True)
+
+        harvest_object = harvest_model.HarvestObject.get(harvest_object.id)
+        assert (imported, errored) == (1, 0)
+        assert harvest_object.package_id == package_id
+        assert harvest_model.Session.query(model.Package).count() == dataset_count
+        assert harvester.force_import is False
+
+    def test_job_objects_are_taken_from_finished_jobs(self):
+        job = HarvestJobObj()
+        harvest_object = HarvestObjectObj(
+            guid=mock_ckan.DATASETS[0]['name'],
+            content=json.dumps(mock_ckan.DATASETS[0]),
+            job=job)
+
+        # The objects of a running job are in the fetch queue
+        assert parallel_import.get_job_objects(job.id) == []
+
+        job.status = 'Finished'
+        job.save()
+        objects = parallel_import.get_job_objects(job.id)
+        assert [object_id for object_id, guid in objects] == [harvest_object.id]
+
 
 class TestCopyAcrossResourceIds(object):
     def test_copied_because_same_name_url_format(self):
@@ -1,16 +1,27 @@
+import copy
+
 from ckantoolkit.tests import factories
 
+from ckanext.custom_harvest import configuration_processors
 from ckanext.custom_harvest.configuration_processors import (
+    BaseConfigProcessor,
+    build_pipeline,
+    ExtrasIndex,
+    GroupIndex,
+    group_index_scope,
     DefaultTags, CleanTags,
     DefaultExtras, CopyExtras,
     DefaultGroups, DefaultValues,
     MappingFields, CompositeMapping,
     ContactPoint,
     RemoteGroups,
+    OrganizationFilter,
     ResourceFormatOrder,
     KeepExistingResources,
-    UploadToDatastore
+    UploadToDatastore,
+    DeferredIndexing
 )
+from ckanext.custom_harvest.harvest_config import HarvestConfig
 
 
 class TestDefaultTags:
@@ -70,6 +81,38 @@ class TestDefaultTags:
         tag_names = sorted([tag_dict["name"] for tag_dict in package["tags"]])
         assert tag_names == ["geo", "namibia", "russian", "tolstoy"]
 
+    def test_modify_package_tags_duplicates(self):
+        package = {
+            "title": "Test Dataset",
+            "name": "test-dataset",
+            "tags": [{"name": "geo", "vocabulary_id": None}, {"name": "tolstoy"}]
+        }
+        config = {
+            "default_tags": [{"name": "Geo"}, {"name": "namibia"}, {"name": "namibia "}]
+        }
+        source_dict = {}
+
+        self.processor.modify_package_dict(package, config, source_dict)
+
+        assert package["tags"] == [
+            {"name": "geo", "vocabulary_id": None},
+            {"name": "tolstoy"},
+            {"name": "namibia"}
+        ]
+
+    def test_default_tags_are_not_changed_by_the_next_processors(self):
+        config = HarvestConfig({
+            "default_tags": [{"name": "Geo Data!"}],
+            "clean_tags": True
+        })
+        pipeline = build_pipeline([DefaultTags, CleanTags], config)
+
+        for name in ("dataset-1", "dataset-2"):
+            package = {"name": name, "tags": []}
+            pipeline(package, {})
+            assert package["tags"] == [{"name": "geo data"}]
+        assert config.default_tags_by_key["geo data!"] == {"name": "Geo Data!"}
+
 
 class TestCleanTags:
 
@@ -91,6 +134,36 @@ class TestCleanTags:
         tag_names = sorted([tag_dict["name"] for tag_dict in package["tags"]])
         assert tag_names == ["tolstoy"]
 
+    def test_modify_package_clean_tags_duplicates(self):
+        package = {
+            "title": "Test Dataset",
+            "name": "test-dataset",
+            "tags": [{"name": "Tolstoy!"}, {"name": "war"}, {"name": "tolstoy"}]
+        }
+        config = {
+            "clean_tags": True
+        }
+        source_dict = {}
+
+        self.processor.modify_package_dict(package, config, source_dict)
+
+        assert package["tags"] == [{"name": "tolstoy"}, {"name": "war"}]
+
+    def test_modify_package_clean_tags_strings(self):
+        package = {
+            "title": "Test Dataset",
+            "name": "test-dataset",
+            "tags": ["Tolstoy!", "war", "tolstoy"]
+        }
+        config = {
+            "clean_tags": True
+        }
+        source_dict = {}
+
+        self.processor.modify_package_dict(package, config, source_dict)
+
+        assert package["tags"] == ["tolstoy", "war"]
+
 
 class TestDefaultGroups:
 
@@ -132,6 +205,29 @@ class TestDefaultGroups:
         group_names = sorted([group_dict["name"] for group_dict in package["groups"]])
         assert group_names == ["science", "spend-data"]
 
+    def test_validation_resolves_groups(self):
+        science = factories.Group(name="science", title="Science")
+        factories.Group(name="spend-data", title="Spend Data")
+        config = {
+            "default_groups": ["spend-data", science["id"], "science"]
+        }
+
+        self.processor.check_config(config)
+
+        assert [group["name"] for group in config["default_group_dicts"]] == \
+            ["spend-data", "science", "science"]
+        assert config["default_group_dicts"][1]["id"] == science["id"]
+
+    def test_validation_group_not_found(self):
+        config = {
+            "default_groups": ["not-a-group"]
+        }
+        try:
+            self.processor.check_config(config)
+            assert False
+        except ValueError:
+            assert True
+
 
 class TestDefaultExtras:
 
@@ -556,6 +652,31 @@ class TestMappingFields:
 
         assert package["modified_time"] == "11:16:25.000000Z"
 
+    def test_modify_package_mapping_values_compiled_once(self):
+        config = HarvestConfig({
+            "map_fields": [
+                {"source": "issued_date", "target": "issued_date"},
+                {"source": "issued_time", "target": "issued_time"},
+                {"source": "tags_string", "target": "keywords", "default": "none"}
+            ]
+        })
+        source_dicts = [
+            {"issued": "2021-08-01T20:05:31.000Z", "tags_string": ["geo", "water"]},
+            {"issued_date": "2021-08-02"}
+        ]
+        packages = [{}, {}]
+
+        for package, source_dict in zip(packages, source_dicts):
+            self.processor.modify_package_dict(package, config, source_dict)
+
+        assert packages[0]["issued_date"] == "2021-08-01"
+        assert packages[0]["issued_time"] == "20:05:31.000000Z"
+        assert packages[0]["keywords"] == "geo, water"
+        assert packages[1]["issued_date"] == "2021-08-02"
+        assert packages[1]["issued_time"] is None
+        assert packages[1]["keywords"] == "none"
+        assert list(config.compiled) == ["map_fields"]
+
     def test_modify_package_mapping_values_from_extras(self):
         package = {
             "title": "Test Dataset",
@@ -676,6 +797,24 @@ class TestCompositeMapping:
 
         assert package["idInfoCitation"] == "{}"
 
+    def test_validation_schema_fields(self, monkeypatch):
+        monkeypatch.setitem(configuration_processors._schema_fields, "dataset", {
+            "idInfoCitation": {"field_name": "idInfoCitation", "preset": "composite"},
+            "title": {"field_name": "title", "preset": "title"}
+        })
+
+        self.processor.check_config({
+            "composite_field_mapping": [{"idInfoCitation": {"publicationDate": "metadataPubDate"}}]
+        })
+        for field_name in ("title", "notAField"):
+            try:
+                self.processor.check_config({
+                    "composite_field_mapping": [{field_name: {"date": "metadataPubDate"}}]
+                })
+                assert False
+            except ValueError:
+                assert True
+
 
 class TestContactPoint:
 
@@ -959,6 +1098,67 @@ class TestRemoteGroups:
         group_names = sorted([group_dict.get("name") for group_dict in package["groups"]])
         assert group_names == ["climate", "science"]
 
+    def test_modify_package_remote_groups_index(self):
+        group_index = GroupIndex([
+            {"id": "climate-id", "name": "climate", "title": "Climate"},
+            {"id": "science-id", "name": "science", "title": "Science"}
+        ])
+        package = {
+            "title": "Test Dataset",
+            "name": "test-dataset"
+        }
+        config = {
+            "remote_groups": "only_local"
+        }
+        source_dict = {
+            "groups": [
+                {"name": "remote-climate", "title": "CLIMATE"},
+                {"name": "science", "title": "Natural Sciences"},
+                {"name": "water", "title": "Water"}
+            ]
+        }
+
+        with group_index_scope(group_index):
+            self.processor.modify_package_dict(package, config, source_dict)
+
+        assert package["groups"] == [
+            {"id": "climate-id", "name": "climate"},
+            {"id": "science-id", "name": "science"}
+        ]
+
+    def test_modify_package_remote_groups_created_meanwhile(self):
+        # the index is loaded before another process creates the group
+        group_index = GroupIndex([])
+        group = factories.Group(name="water", title="Water")
+        package = {
+            "title": "Test Dataset",
+            "name": "test-dataset"
+        }
+        config = {
+            "remote_groups": "create"
+        }
+        source_dict = {
+            "groups": [
+                {"name": "water", "title": "Water"}
+            ]
+        }
+
+        with group_index_scope(group_index):
+            self.processor.modify_package_dict(package, config, source_dict)
+
+        assert package["groups"] == [{"id": group["id"], "name": "water"}]
+        assert group_index.match({"name": "water"}) == {"id": group["id"], "name": "water"}
+
+    def test_group_index_add(self):
+        group_index = GroupIndex([])
+
+        group_index.add({"id": "water-id", "name": "water", "title": "Water"})
+
+        assert group_index.match({"name": "water"}) == {"id": "water-id", "name": "water"}
+        assert group_index.match({"name": "other", "title": "WATER"}) == \
+            {"id": "water-id", "name": "water"}
+        assert group_index.match({"name": "other", "title": ""}) is None
+
 
 class TestResourceFormatOrder:
 
@@ -1062,4 +1262,179 @@ class UploadToDatastore:
             self.processor.check_config(config)
             assert False
         except ValueError:
-            assert True
\ No newline at end of file
+            assert True
+
+
+class TestDeferredIndexing:
+
+    processor = DeferredIndexing
+
+    def test_validation_correct_format(self):
+        config = {
+            "deferred_indexing": True
+        }
+        try:
+            self.processor.check_config(config)
+        except ValueError:
+            assert False
+
+    def test_validation_wrong_format(self):
+        config = {
+            "deferred_indexing": "true"
+        }
+        try:
+            self.processor.check_config(config)
+            assert False
+        except ValueError:
+            assert True
+
+
+class TestProcessorPipeline:
+
+    processors = [
+        DefaultTags, CleanTags,
+        DefaultExtras, CopyExtras,
+        OrganizationFilter,
+        ResourceFormatOrder,
+        KeepExistingResources,
+        DeferredIndexing
+    ]
+
+    def test_only_active_processors(self):
+        config = {
+            "default_tags": [{"name": "geo"}],
+            "clean_tags": False,
+            "organizations_filter_include": ["org1"],
+            "keep_existing_resources": True,
+            "deferred_indexing": True
+        }
+
+        pipeline = build_pipeline(self.processors, config)
+
+        assert pipeline.processors == [DefaultTags]
+
+    def test_processors_without_config_keys_always_run(self):
+
+        class AddNote(BaseConfigProcessor):
+
+            @staticmethod
+            def check_config(config_obj):
+                pass
+
+            @staticmethod
+            def modify_package_dict(package_dict, config, source_dict):
+                package_dict["notes"] = "Harvested"
+
+        package = {"name": "test-dataset"}
+
+        build_pipeline(self.processors + [AddNote], {})(package, {})
+
+        assert package["notes"] == "Harvested"
+
+    def test_pipeline_is_built_once_per_config(self):
+        config = build_pipeline(self.processors, {"clean_tags": True}).config
+
+        assert build_pipeline(self.processors, config) is \
+            build_pipeline(self.processors, config)
+
+    def test_modify_package(self):
+        package = {
+            "title": "Test Dataset",
+            "name": "test-dataset",
+            "tags": [{"name": "tolstoy!"}]
+        }
+        config = {
+            "default_tags": [{"name": "geo"}],
+            "clean_tags": True
+        }
+        source_dict = {}
+
+        build_pipeline(self.processors, config)(package, source_dict)
+
+        tag_names = sorted([tag_dict["name"] for tag_dict in package["tags"]])
+        assert tag_names == ["geo", "tolstoy"]
+        assert package["extras"] == []
+
+    def test_modify_package_extras(self):
+        package = {
+            "title": "Test Dataset",
+            "name": "test-dataset",
+            "extras": [
+                {"key": "encoding", "value": "latin1"},
+                {"key": "language", "value": "en"}
+            ]
+        }
+        config = {
+            "default_extras": {"encoding": "utf8", "theme": "geo"},
+            "override_extras": True,
+            "copy_extras": True
+        }
+        source_dict = {
+            "extras": [
+                {"key": "language", "value": "fr"},
+                {"key": "guid", "value": "remote-guid"}
+            ]
+        }
+
+        build_pipeline([DefaultExtras, CopyExtras], config)(package, source_dict)
+
+        assert package["extras"] == [
+            {"key": "encoding", "value": "utf8"},
+            {"key": "theme", "value": "geo"},
+            {"key": "language", "value": "fr"}
+        ]
+        # The source dict is left as is
+        assert isinstance(source_dict["extras"], list)
+
+    def test_modify_package_repeated_extras(self):
+        config = {
+            "default_extras": {"theme": "geo"},
+            "override_extras": True,
+            "copy_extras": True
+        }
+        source_dict = {
+            "extras": [
+                {"key": "language", "value": "en"},
+                {"key": "language", "value": "fr"}
+            ]
+        }
+        package = {
+            "extras": [
+                {"key": "theme", "value": "a"},
+                {"key": "theme", "value": "b"}
+            ]
+        }
+        list_package = copy.deepcopy(package)
+
+        build_pipeline([DefaultExtras, CopyExtras], config)(package, source_dict)
+        DefaultExtras.modify_package_dict(list_package, config, source_dict)
+        CopyExtras.modify_package_dict(list_package, config, source_dict)
+
+        # The last source extra of a key wins, as without the index
+        assert package["extras"] == list_package["extras"] == [
+            {"key": "theme", "value": "b"},
+            {"key": "theme", "value": "geo"},
+            {"key": "language", "value": "fr"}
+        ]
+
+
+class TestExtrasIndex:
+
+    extras = [
+        {"key": "encoding", "value": "utf8"},
+        {"key": "language", "value": "en"},
+        {"key": "encoding", "value": "latin1"}
+    ]
+
+    def test_repeated_keys_are_kept(self):
+        extras_index = ExtrasIndex.from_list(self.extras)
+
+        assert extras_index.get("encoding")["value"] == "utf8"
+        assert extras_index.to_list() == self.extras
+
+    def test_first_extra_of_a_key_is_removed(self):
+        extras_index = ExtrasIndex.from_list(self.extras)
+
+        assert extras_index.pop("encoding")["value"] == "utf8"
+        assert extras_index.get("encoding")["value"] == "latin1"
+        assert extras_index.to_list() == self.extras[1:]
@@ -1,7 +1,12 @@
 import os
 import json
+import types
 import difflib
-from ckanext.custom_harvest.converter import package_search_to_ckan
+import pytest
+
+from ckanext.custom_harvest.converter import (
+    ConverterSettings, LicenseIndex, clear_license_index, get_converter_settings,
+    get_license_index, package_search_to_ckan, package_search_to_ckan_batch)
 
 
 def _get_file_as_dict(file_name):
@@ -29,3 +34,109 @@ def test_package_search_to_ckan():
 
     assert ckan_dict == expected_ckan_dict,_poor_mans_dict_diff(
         expected_ckan_dict, ckan_dict)
+
+
+def test_package_search_to_ckan_batch():
+    package_search_dicts = [_get_file_as_dict('package_search.json') for _ in range(3)]
+    package_search_dicts[1]['name'] = 'another-dataset'
+    package_search_dicts[2]['license_id'] = 'cc-by'
+
+    ckan_dicts = package_search_to_ckan_batch(package_search_dicts)
+
+    assert isinstance(ckan_dicts, types.GeneratorType)
+    assert list(ckan_dicts) == [package_search_to_ckan(package_search_dict)
+                                for package_search_dict in package_search_dicts]
+
+
+LICENSES = [
+    {'id': 'cc-by', 'title': 'Creative Commons Attribution',
+     'url': 'http://www.opendefinition.org/licenses/cc-by'},
+    {'id': 'other-open', 'title': 'Other (Open)', 'url': ''},
+    {'id': 'cc-by-copy', 'title': 'Creative Commons Attribution',
+     'url': 'http://www.opendefinition.org/licenses/cc-by'},
+]
+
+
+class TestLicenseIndex(object):
+
+    def test_match_license_url_or_title(self):
+        index = LicenseIndex(LICENSES)
+        assert index.match({'license': 'http://www.opendefinition.org/licenses/cc-by'}) == 'cc-by'
+        assert index.match({'license': 'Other (Open)'}) == 'other-open'
+
+    def test_match_license_id_and_license_url(self):
+        index = LicenseIndex(LICENSES)
+        assert index.match({'license_id': 'other-open'}) == 'other-open'
+        assert index.match({'license_url': 'http://www.opendefinition.org/licenses/cc-by'}) == 'cc-by'
+        assert index.match({'license': 'Unknown', 'license_id': 'cc-by'}) == 'cc-by'
+
+    def test_no_match(self):
+        index = LicenseIndex(LICENSES)
+        assert index.match({'license': 'Unknown'}) is None
+        assert index.match({'license_url': ''}) is None
+
+    def test_expired(self):
+        assert not LicenseIndex(LICENSES).expired()
+        assert LicenseIndex(LICENSES, ttl=0).expired()
+
+
+def test_license_index_is_reused():
+    clear_license_index()
+    index = get_license_index()
+    assert get_license_index() is index
+    clear_license_index()
+    assert get_license_index() is not index
+
+
+def test_package_search_to_ckan_license_id():
+    package_search_dict = _get_file_as_dict('package_search.json')
+    package_search_dict['license_id'] = 'cc-by'
+
+    ckan_dict = package_search_to_ckan(package_search_dict)
+
+    assert ckan_dict['license_id'] == 'cc-by'
+
+
+class TestConverterSettings(object):
+
+    def test_plugins(self):
+        settings = ConverterSettings({'ckan.plugins': 'harvest scheming_datasets fluent'})
+        assert settings.fluent
+        assert 'harvest' in settings.plugins
+
+        settings = ConverterSettings({'ckan.plugins': 'harvest scheming_fluent_extra'})
+        assert not settings.fluent
+
+    def test_whitelist(self):
+        settings = ConverterSettings({
+            'ckanext.format_filter.filter_type': 'whitelist',
+            'ckanext.format_filter.whitelist': 'CSV json'})
+        assert settings.whitelist == frozenset(['csv', 'json'])
+        assert not settings.disallow_file_format('csv')
+        assert settings.disallow_file_format('pdf')
+
+    def test_blacklist(self):
+        settings = ConverterSettings({
+            'ckanext.format_filter.filter_type': 'blacklist',
+            'ckanext.format_filter.blacklist': 'PDF'})
+        assert settings.disallow_file_format('pdf')
+        assert not settings.disallow_file_format('csv')
+
+    def test_no_filter(self):
+        assert not ConverterSettings({}).disallow_file_format('pdf')
+
+
+def test_converter_settings_are_reused():
+    settings = get_converter_settings()
+    assert get_converter_settings() is settings
+
+
+@pytest.mark.ckan_config('ckanext.format_filter.filter_type', 'blacklist')
+@pytest.mark.ckan_config('ckanext.format_filter.blacklist', 'pdf')
+def test_package_search_to_ckan_format_blacklist():
+    package_search_dict = _get_file_as_dict('package_search.json')
+
+    ckan_dict = package_search_to_ckan(package_search_dict)
+
+    assert len(ckan_dict['resources']) == len(package_search_dict['resources']) - 1
+    assert 'PDF' not in [resource['format'] for resource in ckan_dict['resources']]
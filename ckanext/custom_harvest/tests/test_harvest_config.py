@@ -0,0 +1,69 @@
+import json
+
+from ckanext.custom_harvest.harvest_config import (
+    HarvestConfig,
+    as_harvest_config,
+    clear_cache,
+    get_harvest_config
+)
+
+
+class TestHarvestConfig(object):
+
+    def setup_method(self):
+        clear_cache()
+
+    def test_empty_config(self):
+        config = get_harvest_config('')
+        assert config == {}
+        assert config.resource_format_order == []
+
+    def test_config_is_cached_per_source(self):
+        config_str = json.dumps({"default_tags": [{"name": "geo"}]})
+
+        config = get_harvest_config(config_str, 'source-id')
+
+        assert config["default_tags"] == [{"name": "geo"}]
+        assert get_harvest_config(config_str, 'source-id') is config
+
+    def test_config_is_compiled_again_when_edited(self):
+        config = get_harvest_config(
+            json.dumps({"clean_tags": True}), 'source-id')
+        edited_config = get_harvest_config(
+            json.dumps({"clean_tags": False}), 'source-id')
+
+        assert edited_config is not config
+        assert edited_config["clean_tags"] is False
+
+    def test_normalized_values(self):
+        config = HarvestConfig({
+            "resource_format_order": [" CSV", "json ", "csv"],
+            "map_fields": [
+                {"source": "language", "target": "language", "default": "English"}
+            ]
+        })
+
+        assert config.resource_format_order == ["csv", "json", "csv"]
+        assert config.resource_format_rank == {"csv": 0, "json": 1}
+        assert config.map_fields == [("language", "language", "English", False)]
+
+    def test_repeated_formats_are_ranked_densely(self):
+        config = HarvestConfig({"resource_format_order": ["CSV", "csv", "ZIP"]})
+
+        assert config.resource_format_rank == {"csv": 0, "zip": 1}
+
+    def test_default_tags_by_key(self):
+        config = HarvestConfig({
+            "default_tags": [{"name": "Geo"}, {"name": "namibia"}, {"name": "geo "}]
+        })
+
+        assert config.default_tags_by_key == {
+            "geo": {"name": "Geo"},
+            "namibia": {"name": "namibia"}
+        }
+
+    def test_as_harvest_config(self):
+        config = HarvestConfig({"clean_tags": True})
+
+        assert as_harvest_config(config) is config
+        assert isinstance(as_harvest_config({"clean_tags": True}), HarvestConfig)
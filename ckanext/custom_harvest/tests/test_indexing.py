@@ -0,0 +1,65 @@
+import threading
+
+import pytest
+
+from ckan import model
+from ckanext.harvest.tests.factories import HarvestJobObj, HarvestObjectObj
+
+from ckanext.custom_harvest import indexing
+
+
+class TestAutomaticIndexingSuspended(object):
+
+    def test_only_current_thread_is_deferred(self):
+        indexed = []
+        notify = indexing.defer_when_suspended(
+            lambda plugin, entity, operation: indexed.append(entity.id))
+        queue = indexing.DeferredIndexQueue()
+
+        with indexing.automatic_indexing_suspended(queue):
+            notify(None, model.Package(id='dataset-1'), model.DomainObjectOperation.changed)
+            thread = threading.Thread(target=notify, args=(
+                None, model.Package(id='dataset-2'), model.DomainObjectOperation.changed))
+            thread.start()
+            thread.join()
+        notify(None, model.Package(id='dataset-3'), model.DomainObjectOperation.new)
+
+        assert len(queue) == 1
+        assert indexed == ['dataset-2', 'dataset-3']
+
+    def test_deleted_datasets_are_not_deferred(self):
+        indexed = []
+        notify = indexing.defer_when_suspended(
+            lambda plugin, entity, operation: indexed.append(entity.id))
+        queue = indexing.DeferredIndexQueue()
+
+        with indexing.automatic_indexing_suspended(queue):
+            notify(None, model.Package(id='dataset-1'), model.DomainObjectOperation.deleted)
+
+        assert len(queue) == 0
+        assert indexed == ['dataset-1']
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db')
+class TestIndexQueues(object):
+
+    def test_jobs_keep_their_own_queue(self):
+        job = HarvestJobObj()
+        HarvestObjectObj(guid='dataset-1', job=job)
+        queue = indexing.get_index_queue(job.id)
+        queue.defer('dataset-1')
+
+        assert indexing.get_index_queue('other-job-id') is not queue
+        assert indexing.get_index_queue(job.id) is queue
+        assert len(queue) == 1
+
+        indexing._index_queues.clear()
+
+    def test_queues_of_finished_jobs_are_dropped(self):
+        queue = indexing.get_index_queue('finished-job-id')
+
+        indexing.get_index_queue('other-job-id')
+
+        assert indexing.get_index_queue('finished-job-id') is not queue
+
+        indexing._index_queues.clear()
@@ -0,0 +1,72 @@
+import logging
+import tracemalloc
+
+import pytest
+
+from ckanext.custom_harvest.memory_profiling import (
+    NULL_PROFILE,
+    MemoryProfile,
+    get_job_profile,
+    release_job_profile
+)
+
+
+class TestMemoryProfile(object):
+
+    def test_tracing_is_stopped(self):
+        profile = MemoryProfile('job-id')
+        assert tracemalloc.is_tracing()
+
+        profile.stop()
+        assert not tracemalloc.is_tracing()
+
+    def test_import_growth_and_peak(self):
+        profile = MemoryProfile('job-id')
+        kept = []
+        try:
+            with profile.track_import():
+                kept.append(bytearray(1024 * 1024))
+            profile.log_summary()
+        finally:
+            profile.stop()
+
+        assert profile.objects == 1
+        assert profile.import_growth >= 1024 * 1024
+        assert profile.peak >= 1024 * 1024
+
+    def test_snapshots_log_allocation_sites(self, caplog):
+        profile = MemoryProfile('job-id')
+        profile.page_interval = 2
+        kept = []
+        try:
+            with caplog.at_level(logging.INFO):
+                for _ in range(2):
+                    kept.append(bytearray(1024 * 1024))
+                    profile.page_fetched()
+        finally:
+            profile.stop()
+
+        messages = [record.getMessage() for record in caplog.records]
+        assert any('gather: after 2 pages: current=' in message for message in messages)
+        assert any('test_memory_profiling.py' in message for message in messages)
+
+
+class TestJobProfiles(object):
+
+    def test_disabled_by_default(self):
+        profile = get_job_profile('job-id')
+
+        with profile.track_import():
+            pass
+
+        assert profile is NULL_PROFILE
+        assert not tracemalloc.is_tracing()
+
+    @pytest.mark.ckan_config('ckanext.custom_harvest.memory_profile', 'true')
+    def test_enabled(self):
+        profile = get_job_profile('job-id')
+
+        assert profile.enabled
+        assert get_job_profile('job-id') is profile
+        assert release_job_profile('job-id') is profile
+        assert not tracemalloc.is_tracing()
@@ -0,0 +1,79 @@
+import os
+from types import SimpleNamespace
+
+from ckanext.harvest.harvesters import HarvesterBase
+
+from ckanext.custom_harvest.harvesters.base import CustomHarvester
+from ckanext.custom_harvest.metrics import (
+    ERRORS,
+    Counter,
+    Histogram,
+    Registry,
+    write_metrics
+)
+
+
+class TestMetrics(object):
+
+    def test_counter(self):
+        registry = Registry()
+        counter = registry.register(Counter(
+            'harvest_objects_total', 'Harvest objects.', ['source', 'status']))
+
+        counter.inc(source='source-1', status='new')
+        counter.inc(2, source='source-1', status='new')
+        counter.inc(source='source-"2"', status='delete')
+
+        assert counter.get(source='source-1', status='new') == 3
+        assert registry.to_text() == (
+            '# HELP harvest_objects_total Harvest objects.\n'
+            '# TYPE harvest_objects_total counter\n'
+            'harvest_objects_total{source="source-\\"2\\"",status="delete"} 1\n'
+            'harvest_objects_total{source="source-1",status="new"} 3\n'
+        )
+
+    def test_histogram(self):
+        registry = Registry()
+        histogram = registry.register(Histogram(
+            'import_seconds', 'Import time.', ['source'], buckets=(0.1, 1.0)))
+
+        histogram.observe(0.05, source='source-1')
+        histogram.observe(0.5, source='source-1')
+        histogram.observe(5, source='source-1')
+
+        assert histogram.get_count(source='source-1') == 3
+        assert registry.to_text() == (
+            '# HELP import_seconds Import time.\n'
+            '# TYPE import_seconds histogram\n'
+            'import_seconds_bucket{source="source-1",le="0.1"} 1\n'
+            'import_seconds_bucket{source="source-1",le="1"} 2\n'
+            'import_seconds_bucket{source="source-1",le="+Inf"} 3\n'
+            'import_seconds_sum{source="source-1"} 5.55\n'
+            'import_seconds_count{source="source-1"} 3\n'
+        )
+
+    def test_write_metrics(self, ckan_config, monkeypatch, tmp_path):
+        metrics_file = str(tmp_path / 'harvest.prom')
+        monkeypatch.setitem(
+            ckan_config, 'ckanext.custom_harvest.metrics_file', metrics_file)
+
+        assert write_metrics()
+
+        with open(metrics_file) as f:
+            assert '# TYPE ckan_harvest_import_duration_seconds histogram' in f.read()
+        assert os.listdir(str(tmp_path)) == ['harvest.prom']
+
+    def test_write_metrics_not_configured(self):
+        assert not write_metrics()
+
+    def test_errors_saved_from_the_harvester_class(self, monkeypatch):
+        saved = []
+        monkeypatch.setattr(HarvesterBase, '_save_object_error', classmethod(
+            lambda cls, message, obj, stage='Fetch', line=None: saved.append(message)))
+        errors = ERRORS.get(source='error-source', stage='import')
+
+        CustomHarvester._save_object_error(
+            'Import error', SimpleNamespace(harvest_source_id='error-source'), 'Import')
+
+        assert saved == ['Import error']
+        assert ERRORS.get(source='error-source', stage='import') == errors + 1
@@ -0,0 +1,62 @@
+import os
+
+from ckanext.custom_harvest import parallel_import
+from ckanext.custom_harvest.parallel_import import batched, partition_by_guid
+
+
+class TestPartitionByGuid(object):
+
+    def test_partitions_are_disjoint_by_guid(self):
+        objects = [
+            ('object-%s' % i, 'dataset-%s' % (i % 10)) for i in range(100)
+        ]
+
+        partitions = partition_by_guid(objects, 4)
+
+        assert len(partitions) <= 4
+        assert sorted(sum(partitions, [])) == sorted(o[0] for o in objects)
+        guids = dict(objects)
+        partition_guids = [set(guids[o] for o in p) for p in partitions]
+        for i, guids_in_partition in enumerate(partition_guids):
+            for other_guids in partition_guids[i + 1:]:
+                assert not guids_in_partition & other_guids
+
+    def test_objects_keep_their_order(self):
+        objects = [('object-1', 'dataset'), ('object-2', 'dataset')]
+
+        assert partition_by_guid(objects, 8) == [['object-1', 'object-2']]
+
+    def test_no_objects(self):
+        assert partition_by_guid([], 4) == []
+
+
+class TestBatched(object):
+
+    def test_batches(self):
+        assert list(batched(iter(range(7)), 3)) == [[0, 1, 2], [3, 4, 5], [6]]
+
+    def test_no_items(self):
+        assert list(batched([], 3)) == []
+
+
+class TestReindexSource(object):
+
+    def test_killed_worker(self, monkeypatch):
+
+        def reindex_batch(package_ids):
+            if 'dataset-killed' in package_ids:
+                os._exit(1)
+            return len(package_ids)
+
+        package_ids = ['dataset-%s' % i for i in range(20)] + ['dataset-killed']
+        monkeypatch.setattr(parallel_import, 'iter_source_package_ids', lambda source_id: iter(package_ids))
+        monkeypatch.setattr(parallel_import, 'reindex_batch', reindex_batch)
+        monkeypatch.setattr(parallel_import, '_init_worker', lambda: None)
+        monkeypatch.setattr(parallel_import.model.Session, 'remove', lambda: None)
+        monkeypatch.setattr(parallel_import.model.meta.engine, 'dispose', lambda: None)
+        monkeypatch.setattr(parallel_import.indexing, 'commit', lambda: None)
+
+        indexed, errored = parallel_import.reindex_source('source-id', workers=2, batch_size=5)
+
+        assert errored >= 1
+        assert indexed + errored == len(package_ids)
@@ -0,0 +1,78 @@
+from ckanext.custom_harvest.harvest_config import HarvestConfig
+from ckanext.custom_harvest.resource_formats import (
+    FormatClassifier, clean_format, guess_format)
+
+
+class TestGuessFormat(object):
+
+    def test_data_mimetypes(self):
+        assert guess_format('text/csv') == 'csv'
+        assert guess_format('application/json') == 'json'
+        assert guess_format('application/vnd.ms-excel') == 'xls'
+        assert guess_format(
+            'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet') == 'xlsx'
+        assert guess_format('application/vnd.geo+json') == 'geojson'
+
+    def test_mimetype_is_normalized(self):
+        assert guess_format(' Text/CSV; charset=utf-8') == 'csv'
+
+    def test_unknown_mimetype(self):
+        assert guess_format('application/x-unknown-format') == ''
+
+    def test_empty_mimetype(self):
+        assert guess_format('') == ''
+        assert guess_format(None) == ''
+
+
+class TestCleanFormat(object):
+
+    def test_clean_format(self):
+        assert clean_format(' Esri REST ') == 'esrirest'
+        assert clean_format('CSV') == 'csv'
+
+    def test_empty_format(self):
+        assert clean_format('') == ''
+        assert clean_format(None) == ''
+
+
+class TestFormatClassifier(object):
+
+    def test_classify(self):
+        classifier = FormatClassifier(
+            disallow_file_format=lambda file_format: file_format == 'html',
+            format_rank={'csv': 0, 'json': 1},
+            xloader_formats=frozenset(['csv', 'xlsx']))
+
+        assert classifier.classify(' CSV') == ('csv', False, 0, True)
+        assert classifier.classify('HTML') == ('html', True, 2, False)
+        assert classifier.classify(None) == ('', False, 2, False)
+        assert classifier.classify(' CSV') is classifier.classify(' CSV')
+
+    def test_order(self):
+        classifier = FormatClassifier(format_rank={'csv': 0, 'json': 1})
+        resources = [
+            {'name': 'a', 'format': 'PDF'},
+            {'name': 'b', 'format': 'json'},
+            {'name': 'c', 'format': 'CSV'},
+            {'name': 'd', 'format': 'csv'}
+        ]
+
+        ordered = classifier.order(resources)
+
+        assert [resource['name'] for resource in ordered] == ['c', 'd', 'b', 'a']
+        assert FormatClassifier().order(resources) is resources
+
+    def test_order_repeated_formats(self):
+        config = HarvestConfig({"resource_format_order": ["csv", "CSV", "csv", "json", "xml"]})
+        classifier = FormatClassifier(format_rank=config.resource_format_rank)
+        resources = [
+            {'name': 'a', 'format': 'PDF'},
+            {'name': 'b', 'format': 'xml'},
+            {'name': 'c', 'format': 'json'},
+            {'name': 'd', 'format': 'csv'}
+        ]
+
+        ordered = classifier.order(resources)
+
+        assert config.resource_format_rank == {'csv': 0, 'json': 1, 'xml': 2}
+        assert [resource['name'] for resource in ordered] == ['d', 'c', 'b', 'a']
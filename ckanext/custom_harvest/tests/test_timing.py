@@ -0,0 +1,113 @@
+import json
+
+import pytest
+
+from ckan import model
+from ckanext.harvest.model import HarvestLog
+from ckanext.harvest.tests.factories import HarvestJobObj, HarvestObjectObj
+
+from ckanext.custom_harvest.timing import (
+    NULL_TIMINGS,
+    PhaseTimings,
+    get_job_timings,
+    release_job_timings
+)
+
+
+class TestPhaseTimings(object):
+
+    def test_summary(self):
+        timings = PhaseTimings('job-id')
+        for milliseconds in range(1, 101):
+            timings.add('import: convert', milliseconds / 1000.0)
+
+        stats = timings.summary()['import: convert']
+
+        assert stats['count'] == 100
+        assert stats['sum'] == pytest.approx(5.05)
+        assert stats['p50'] == pytest.approx(0.050)
+        assert stats['p95'] == pytest.approx(0.095)
+        assert stats['max'] == pytest.approx(0.100)
+
+    def test_phase(self):
+        timings = PhaseTimings('job-id')
+
+        with timings.phase('gather: search'):
+            pass
+
+        assert timings.summary()['gather: search']['count'] == 1
+
+    def test_phase_is_timed_on_error(self):
+        timings = PhaseTimings('job-id')
+
+        with pytest.raises(ValueError):
+            with timings.phase('import: package_create'):
+                raise ValueError()
+
+        assert timings.summary()['import: package_create']['count'] == 1
+
+
+class TestJobTimings(object):
+
+    def test_disabled_by_default(self):
+        timings = get_job_timings('job-id')
+
+        with timings.phase('import: convert'):
+            pass
+
+        assert timings is NULL_TIMINGS
+        assert timings.summary() == {}
+
+    @pytest.mark.ckan_config('ckanext.custom_harvest.timing', 'true')
+    def test_enabled(self):
+        timings = get_job_timings('job-id')
+
+        assert timings.enabled
+        assert get_job_timings('job-id') is timings
+        assert release_job_timings('job-id') is timings
+        assert get_job_timings('job-id') is not timings
+
+    @pytest.mark.usefixtures('with_plugins', 'clean_db')
+    @pytest.mark.ckan_config('ckanext.custom_harvest.timing', 'true')
+    def test_summary_is_stored(self):
+        timings = get_job_timings('job-id')
+        timings.add('import: convert', 0.5)
+
+        release_job_timings('job-id')
+
+        harvest_log = model.Session.query(HarvestLog) \
+            .filter(HarvestLog.content.like('Job job-id phase timings: %')).one()
+        stored = json.loads(harvest_log.content.split(': ', 1)[1])
+        assert stored['job_id'] == 'job-id'
+        assert stored['phases']['import: convert']['count'] == 1
+
+    @pytest.mark.usefixtures('with_plugins', 'clean_db')
+    @pytest.mark.ckan_config('ckanext.custom_harvest.timing', 'true')
+    def test_jobs_keep_their_own_timings(self):
+        job = HarvestJobObj()
+        HarvestObjectObj(guid='dataset', job=job)
+        timings = get_job_timings(job.id)
+        timings.add('import: convert', 0.5)
+
+        get_job_timings('other-job-id')
+
+        assert get_job_timings(job.id) is timings
+        assert model.Session.query(HarvestLog) \
+            .filter(HarvestLog.content.like('Job % phase timings: %')).count() == 0
+
+        release_job_timings(job.id)
+        release_job_timings('other-job-id')
+
+    @pytest.mark.usefixtures('with_plugins', 'clean_db')
+    @pytest.mark.ckan_config('ckanext.custom_harvest.timing', 'true')
+    def test_finished_jobs_are_stored_once(self):
+        get_job_timings('job-id').add('import: convert', 0.5)
+
+        # The job has no objects left to import
+        get_job_timings('other-job-id')
+
+        assert release_job_timings('job-id') is None
+        assert model.Session.query(HarvestLog) \
+            .filter(HarvestLog.content.like('Job job-id phase timings: %')).count() == 1
+
+        release_job_timings('other-job-id')
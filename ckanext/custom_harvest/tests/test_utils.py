@@ -1,3 +1,5 @@
+import pytest
+
 from ckanext.custom_harvest.utils import (
     parse_date_iso_format,
     is_xloader_format
@@ -31,6 +33,21 @@ class TestDateIsoFormat(object):
         _date = parse_date_iso_format(date)
         assert _date == '2020-09-25T10:49:41'
 
+    def test_iso_datetime_utc(self):
+        date = '2020-02-27T21:26:01.123Z'
+        _date = parse_date_iso_format(date)
+        assert _date == '2020-02-27T21:26:01'
+
+    def test_iso_datetime_with_offset(self):
+        date = '2020-02-27T21:26:01+02:00'
+        _date = parse_date_iso_format(date)
+        assert _date == '2020-02-27T21:26:01'
+
+    def test_invalid_iso_date(self):
+        date = '2020-02-30T00:00:00'
+        _date = parse_date_iso_format(date)
+        assert _date is None
+
     def test_date_with_slash(self):
         date = '2020/09/25'
         _date = parse_date_iso_format(date)
@@ -53,3 +70,19 @@ class TestIsXloaderFormat(object):
         resource_format = 'xls'
         xloader_format = is_xloader_format(resource_format)
         assert xloader_format
+
+    def test_format_is_cleaned(self):
+        resource_format = ' XLSX '
+        xloader_format = is_xloader_format(resource_format)
+        assert xloader_format
+
+    def test_other_format(self):
+        resource_format = 'pdf'
+        xloader_format = is_xloader_format(resource_format)
+        assert not xloader_format
+
+    @pytest.mark.ckan_config('ckanext.xloader.formats', 'CSV json')
+    def test_configured_formats(self):
+        assert is_xloader_format('json')
+        assert is_xloader_format('csv')
+        assert not is_xloader_format('xls')
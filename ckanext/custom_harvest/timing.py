@@ -0,0 +1,160 @@
+import os
+import json
+import math
+import time
+import logging
+from array import array
+from contextlib import contextmanager, nullcontext
+
+from ckan import model
+from ckantoolkit import asbool, config
+from ckanext.harvest.model import HarvestLog
+
+from ckanext.custom_harvest import utils
+
+
+log = logging.getLogger(__name__)
+
+# Phase timings by harvest job id
+_job_timings = {}
+
+
+def is_enabled():
+    return asbool(config.get('ckanext.custom_harvest.timing', False))
+
+
+def _percentile(ordered_values, percent):
+    index = int(math.ceil(percent / 100.0 * len(ordered_values))) - 1
+    return ordered_values[max(index, 0)]
+
+
+class PhaseTimings(object):
+    '''
+    Durations of the phases of a harvest job, measured with a monotonic
+    clock and aggregated per phase
+    '''
+    enabled = True
+
+    def __init__(self, job_id=None):
+        self.job_id = job_id
+        self._durations = {}
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        durations = self._durations.get(name)
+        if durations is None:
+            durations = self._durations[name] = array('d')
+        durations.append(seconds)
+
+    def summary(self):
+        '''
+        Returns the count, sum, p50, p95 and max duration in seconds of each
+        phase
+        '''
+        result = {}
+        for name, durations in self._durations.items():
+            ordered_durations = sorted(durations)
+            result[name] = {
+                'count': len(ordered_durations),
+                'sum': sum(ordered_durations),
+                'p50': _percentile(ordered_durations, 50),
+                'p95': _percentile(ordered_durations, 95),
+                'max': ordered_durations[-1],
+            }
+        return result
+
+    def log_summary(self):
+        for name, stats in sorted(self.summary().items()):
+            log.info('Job %s phase %s: count=%d sum=%.3fs p50=%.1fms '
+                     'p95=%.1fms max=%.1fms',
+                     self.job_id, name, stats['count'], stats['sum'],
+                     stats['p50'] * 1000, stats['p95'] * 1000,
+                     stats['max'] * 1000)
+
+
+class NullPhaseTimings(object):
+    '''
+    Used when timing is disabled, so that timing a phase costs next to
+    nothing
+    '''
+    enabled = False
+    job_id = None
+
+    _null_phase = nullcontext()
+
+    def phase(self, name):
+        return self._null_phase
+
+    def add(self, name, seconds):
+        pass
+
+    def summary(self):
+        return {}
+
+    def log_summary(self):
+        pass
+
+
+NULL_TIMINGS = NullPhaseTimings()
+
+
+def get_job_timings(job_id):
+    '''
+    Returns the phase timings of a harvest job, or NULL_TIMINGS if timing
+    is disabled
+    '''
+    if not is_enabled():
+        return NULL_TIMINGS
+    timings = _job_timings.get(job_id)
+    if timings is None:
+        # Jobs handled at the same time keep their own timings. The ones of
+        # the jobs finished by other processes are reported and stored
+        # before starting a new one.
+        for finished_job_id in utils.get_finished_jobs(_job_timings):
+            release_job_timings(finished_job_id)
+        timings = _job_timings[job_id] = PhaseTimings(job_id)
+    return timings
+
+
+def store_summary(job_id, summary):
+    '''
+    Saves the aggregated timings of a harvest job in the harvest log, as
+    harvest jobs have nowhere to keep them. Each process handling the job
+    saves the timings of the phases it ran once the job is finished, in its
+    own transaction so that the import isn't affected.
+    '''
+    if not summary:
+        return
+    content = 'Job %s phase timings: %s' % (job_id, json.dumps({
+        'job_id': job_id,
+        'pid': os.getpid(),
+        'phases': summary,
+    }, sort_keys=True))
+    session = model.meta.create_local_session()
+    try:
+        session.add(HarvestLog(content=content, level='INFO'))
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        log.warning('Could not store the phase timings of job %s: %r', job_id, e)
+    finally:
+        session.close()
+
+
+def release_job_timings(job_id):
+    '''
+    Logs and stores the aggregated timings of a harvest job and stops
+    keeping them
+    '''
+    timings = _job_timings.pop(job_id, None)
+    if timings is not None:
+        timings.log_summary()
+        store_summary(job_id, timings.summary())
+    return timings
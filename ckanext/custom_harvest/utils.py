@@ -3,7 +3,24 @@
 import datetime
 from dateutil.parser import parse as parse_date
 
+from ckan import model
 from ckantoolkit import config
+from ckanext.harvest.model import HarvestObject
+
+from ckanext.custom_harvest.resource_formats import clean_format
+
+
+DEFAULT_XLOADER_FORMATS = (
+    'csv', 'application/csv',
+    'xls', 'xlsx', 'tsv',
+    'application/vnd.ms-excel',
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'ods', 'application/vnd.oasis.opendocument.spreadsheet',
+)
+
+# The xloader formats, as the config value they were built from and the
+# set of cleaned formats
+_xloader_formats = None
 
 
 def parse_date_iso_format(date):
@@ -13,6 +30,13 @@ def parse_date_iso_format(date):
     if not date:
         return None
     try:
+        if date[4:5] == '-' and date[7:8] == '-':
+            # Fast path for ISO 8601 timestamps like the ones written by
+            # CKAN, which are most of the dates parsed here
+            try:
+                return datetime.datetime.fromisoformat(date).isoformat()[:19]
+            except ValueError:
+                pass
         default_datetime = datetime.datetime(1, 1, 1, 0, 0, 0)
         _date = parse_date(date, default=default_datetime)
         date_modified = _date.isoformat()
@@ -22,22 +46,48 @@ def parse_date_iso_format(date):
         pass
     return None
 
+
+def get_xloader_formats():
+    '''
+    Returns the set of formats accepted by ckanext-xloader, built again
+    only if ckanext.xloader.formats changed
+    '''
+    global _xloader_formats
+    formats_option = config.get('ckanext.xloader.formats')
+    if _xloader_formats is None or _xloader_formats[0] != formats_option:
+        if formats_option is not None:
+            xloader_formats = formats_option.split()
+        else:
+            xloader_formats = DEFAULT_XLOADER_FORMATS
+        _xloader_formats = (formats_option, frozenset(
+            clean_format(xloader_format) for xloader_format in xloader_formats))
+    return _xloader_formats[1]
+
+
+def clear_xloader_formats():
+    global _xloader_formats
+    _xloader_formats = None
+
+
 def is_xloader_format(resource_format):
     '''
     Determines if the supplied format is accepted by ckanext-xloader
     '''
-    DEFAULT_FORMATS = [
-        'csv', 'application/csv',
-        'xls', 'xlsx', 'tsv',
-        'application/vnd.ms-excel',
-        'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        'ods', 'application/vnd.oasis.opendocument.spreadsheet',
-    ]
-    xloader_formats = config.get('ckanext.xloader.formats')
-    if xloader_formats is not None:
-        xloader_formats = xloader_formats.lower().split()
-    else:
-        xloader_formats = DEFAULT_FORMATS
     if not resource_format:
         return False
-    return resource_format.lower() in xloader_formats
\ No newline at end of file
+    return clean_format(resource_format) in get_xloader_formats()
+
+
+def get_finished_jobs(job_ids):
+    '''
+    Returns the ids, among the given ones, of the harvest jobs with no
+    objects left to fetch or import
+    '''
+    job_ids = set(job_ids)
+    if not job_ids:
+        return set()
+    unfinished_jobs = model.Session.query(HarvestObject.harvest_job_id) \
+        .filter(HarvestObject.harvest_job_id.in_(list(job_ids))) \
+        .filter(HarvestObject.state.in_(['WAITING', 'FETCH'])) \
+        .distinct()
+    return job_ids - set(job_id for job_id, in unfinished_jobs)